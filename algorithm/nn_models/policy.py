@@ -33,8 +33,9 @@ class ModelPolicy(ModelBasePolicy):
             self.d_dense = tf.keras.Sequential([
                 tf.keras.layers.Dense(d_dense_n, tf.nn.relu) for _ in range(d_dense_depth)
             ] + [tf.keras.layers.Dense(d_action_dim)], name='d_seq')
+            # Distributions are built in float32 under mixed precision, the inputs are cast automatically
             self.d_tfpd = tfp.layers.DistributionLambda(
-                make_distribution_fn=lambda t: tfp.distributions.Categorical(logits=t))
+                make_distribution_fn=lambda t: tfp.distributions.Categorical(logits=t), dtype=tf.float32)
 
         if self.c_action_dim:
             self.c_dense = tf.keras.Sequential([
@@ -47,7 +48,7 @@ class ModelPolicy(ModelBasePolicy):
                 tf.keras.layers.Dense(logstd_n, tf.nn.relu) for _ in range(logstd_depth)
             ] + [tf.keras.layers.Dense(c_action_dim, name='c_normal_output_dense')], name='c_logstd_seq')
             self.c_tfpd = tfp.layers.DistributionLambda(
-                make_distribution_fn=lambda t: tfp.distributions.Normal(t[0], t[1]))
+                make_distribution_fn=lambda t: tfp.distributions.Normal(t[0], t[1]), dtype=tf.float32)
 
     def call(self, state):
         state = self.dense(state)
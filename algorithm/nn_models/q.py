@@ -62,3 +62,124 @@ class ModelQ(ModelBaseQ):
             c_q = tf.zeros((0,))
 
         return d_q, c_q
+
+
+class EnsembleDense(tf.keras.layers.Layer):
+    """
+    `ensemble` independent Dense layers with [ensemble, in, out] kernels
+    inputs: [Batch, in] shared by all members or [ensemble, Batch, in]
+    outputs: [ensemble, Batch, out]
+    """
+
+    def __init__(self, ensemble, units, activation=None, **kwargs):
+        super().__init__(**kwargs)
+
+        self.ensemble = ensemble
+        self.units = units
+        self.activation = tf.keras.activations.get(activation)
+
+    def build(self, input_shape):
+        dim = input_shape[-1]
+        # The same as glorot_uniform of each [in, out] kernel
+        limit = (6 / (dim + self.units))**0.5
+
+        self.kernel = self.add_weight(name='kernel',
+                                      shape=[self.ensemble, dim, self.units],
+                                      initializer=tf.random_uniform_initializer(-limit, limit),
+                                      trainable=True)
+        self.bias = self.add_weight(name='bias',
+                                    shape=[self.ensemble, 1, self.units],
+                                    initializer=tf.zeros_initializer(),
+                                    trainable=True)
+
+    def call(self, inputs):
+        return self.activation(tf.matmul(inputs, self.kernel) + self.bias)
+
+
+class ModelEnsembleQ(ModelBaseQ):
+    """
+    `ensemble` Qs with the same architecture as `model_q`, computed by batched matmuls
+    Only the Dense layers of ModelQ are supported
+    """
+    _seq_names = ['dense', 'd_dense', 'c_state_model', 'c_action_model', 'c_dense']
+
+    def __init__(self, model_q: ModelQ, ensemble, name=None):
+        super().__init__(model_q.state_dim, model_q.d_action_dim, model_q.c_action_dim, name)
+        self.ensemble = ensemble
+
+        for seq_name in self._seq_names:
+            if hasattr(model_q, seq_name):
+                layers = getattr(model_q, seq_name).layers
+                for l in layers:
+                    if not isinstance(l, tf.keras.layers.Dense):
+                        raise Exception(f'ModelEnsembleQ does not support {l.__class__.__name__}')
+
+                setattr(self, seq_name, [EnsembleDense(ensemble, l.units, l.activation) for l in layers])
+
+    def init(self):
+        self(tf.zeros((1, self.state_dim)),
+             tf.zeros((1, self.c_action_dim)))
+
+    def _through(self, x, layers):
+        for l in layers:
+            x = l(x)
+
+        # Tile inputs that have not passed through any layer
+        if len(x.shape) == 2:
+            x = tf.tile(tf.expand_dims(x, 0), [self.ensemble, 1, 1])
+
+        return x
+
+    def call(self, state, c_action):
+        """
+        state: [Batch, ..., state_dim]
+        c_action: [Batch, ..., c_action_dim]
+
+        Return: [ensemble, Batch, ..., d_action_dim], [ensemble, Batch, ..., 1]
+        """
+        batch_shape = tf.shape(state)[:-1]
+        state = tf.reshape(state, [-1, state.shape[-1]])
+
+        state = self._through(state, self.dense) if self.dense else state
+
+        def reshape_output(x):
+            return tf.reshape(x, tf.concat([[self.ensemble], batch_shape, [x.shape[-1]]], axis=0))
+
+        if self.d_action_dim:
+            d_q = reshape_output(self._through(state, self.d_dense))
+        else:
+            d_q = tf.zeros((0,))
+
+        if self.c_action_dim:
+            c_action = tf.reshape(c_action, [-1, c_action.shape[-1]])
+            c_state = self._through(state, self.c_state_model)
+            c_action = self._through(c_action, self.c_action_model)
+
+            c_q = reshape_output(self._through(tf.concat([c_state, c_action], -1), self.c_dense))
+        else:
+            c_q = tf.zeros((0,))
+
+        return d_q, c_q
+
+    def _get_layer_pairs(self, model_q):
+        for seq_name in self._seq_names:
+            if hasattr(self, seq_name):
+                yield from zip(getattr(self, seq_name), getattr(model_q, seq_name).layers)
+
+    def set_from_models(self, model_q_list):
+        """
+        Assign weights from `ensemble` ModelQ
+        """
+        for layers in zip(*[self._get_layer_pairs(model_q) for model_q in model_q_list]):
+            l = layers[0][0]
+            l.kernel.assign(tf.stack([tf.convert_to_tensor(m_l.kernel) for _, m_l in layers]))
+            l.bias.assign(tf.stack([tf.expand_dims(m_l.bias, 0) for _, m_l in layers]))
+
+    def assign_to_models(self, model_q_list):
+        """
+        Assign weights to `ensemble` ModelQ
+        """
+        for i, model_q in enumerate(model_q_list):
+            for l, m_l in self._get_layer_pairs(model_q):
+                m_l.kernel.assign(l.kernel[i])
+                m_l.bias.assign(l.bias[i, 0])
@@ -18,6 +18,43 @@ class ModelSimpleRep(ModelBaseSimpleRep):
         return obs_list[0]
 
 
+class LSTMAllStatesCell(tf.keras.layers.LSTMCell):
+    """
+    LSTMCell whose outputs are the concatenated states [h, c]
+    """
+
+    def __init__(self, units, **kwargs):
+        super().__init__(units, **kwargs)
+        self.output_size = units * 2
+
+    def call(self, inputs, states, *args, **kwargs):
+        h, (h, c) = super().call(inputs, states, *args, **kwargs)
+        return tf.concat([h, c], axis=-1), [h, c]
+
+
+class AllStatesRNN(tf.keras.layers.RNN):
+    """
+    RNN returning sequences and states, which keeps the states after each timestep
+    [Batch, Step, state_dim] of the last call in `all_states` and counts the calls in `n_calls`.
+    The concatenated outputs of LSTMAllStatesCell are split back to h
+    """
+
+    def __init__(self, cell, **kwargs):
+        super().__init__(cell, return_sequences=True, return_state=True, **kwargs)
+        self.all_states = None
+        self.n_calls = 0
+
+    def __call__(self, *args, **kwargs):
+        outputs, *states = super().__call__(*args, **kwargs)
+
+        self.all_states = outputs
+        self.n_calls += 1
+        if isinstance(self.cell, LSTMAllStatesCell):
+            outputs = outputs[..., :self.cell.units]
+
+        return [outputs, *states]
+
+
 class ModelBaseRNNRep(tf.keras.Model):
     def __init__(self, obs_dims, d_action_dim, c_action_dim, rnn_units):
         super().__init__()
@@ -31,6 +68,48 @@ class ModelBaseRNNRep(tf.keras.Model):
                          tf.keras.Input(shape=(None, self.d_action_dim + self.c_action_dim)),
                          tf.keras.Input(shape=(self.rnn_units,)))
 
+    def __call__(self, *args, return_all_states=False, **kwargs):
+        """
+        If return_all_states, return (state, next_rnn_state, all_rnn_states), where all_rnn_states
+        [Batch, Step, rnn_state_dim] are the rnn states after each timestep of the sequence,
+        or None if the model cannot get them in a single call, e.g. it has no AllStatesRNN
+        or calls it other than once, so that the caller falls back to stepping the model.
+        Raise ValueError if the states of the AllStatesRNN are not the rnn state of the model
+        """
+        if not return_all_states:
+            return super().__call__(*args, **kwargs)
+
+        rnn = self._get_all_states_rnn()
+        if rnn is None:
+            state, next_rnn_state = super().__call__(*args, **kwargs)
+            return state, next_rnn_state, None
+
+        rnn.all_states = None
+        rnn.n_calls = 0
+        state, next_rnn_state = super().__call__(*args, **kwargs)
+        all_rnn_states, rnn.all_states = rnn.all_states, None
+
+        if rnn.n_calls != 1:
+            return state, next_rnn_state, None
+
+        if all_rnn_states.shape[-1] != next_rnn_state.shape[-1]:
+            raise ValueError(f'{self.__class__.__name__} returns an rnn state of dim {next_rnn_state.shape[-1]} '
+                             f'but its {rnn.__class__.__name__} has states of dim {all_rnn_states.shape[-1]}, '
+                             'return the states of the RNN as the rnn state or '
+                             'override `_get_all_states_rnn` to return None')
+
+        all_rnn_states = tf.cast(all_rnn_states, next_rnn_state.dtype)
+
+        return state, next_rnn_state, all_rnn_states
+
+    def _get_all_states_rnn(self):
+        """
+        The AllStatesRNN whose states after each timestep are the rnn states of the model,
+        which has to be called once per model call and whose final states have to be returned
+        unchanged as the rnn state, otherwise None
+        """
+        return None
+
     def call(self, obs_list, pre_action, rnn_state):
         raise Exception("ModelRNNRep not implemented")
 
@@ -42,9 +121,10 @@ class ModelBaseGRURep(ModelBaseRNNRep):
 
         # TODO Disabled temporarily because of the issue
         # https://github.com/tensorflow/tensorflow/issues/39697
-        self.gru = tf.keras.layers.RNN(tf.keras.layers.GRUCell(rnn_units),
-                                       return_sequences=True,
-                                       return_state=True)
+        self.gru = AllStatesRNN(tf.keras.layers.GRUCell(rnn_units))
+
+    def _get_all_states_rnn(self):
+        return self.gru if isinstance(self.gru, AllStatesRNN) else None
 
 
 class ModelBaseLSTMRep(ModelBaseRNNRep):
@@ -54,9 +134,11 @@ class ModelBaseLSTMRep(ModelBaseRNNRep):
 
         # TODO Disabled temporarily because of the issue
         # https://github.com/tensorflow/tensorflow/issues/39697
-        self.lstm = tf.keras.layers.RNN(tf.keras.layers.LSTMCell(rnn_units),
-                                        return_sequences=True,
-                                        return_state=True)
+        # The rnn state is the concatenated [h, c]
+        self.lstm = AllStatesRNN(LSTMAllStatesCell(rnn_units))
+
+    def _get_all_states_rnn(self):
+        return self.lstm if isinstance(self.lstm, AllStatesRNN) else None
 
     def init(self):
         return self.call([tf.keras.Input(shape=(None, *o)) for o in self.obs_dims],
@@ -0,0 +1,116 @@
+import threading
+import time
+
+
+class RateLimiter:
+    """
+    Keep the ratio of samples to inserts around `samples_per_insert`
+
+    `diff = inserts * samples_per_insert - samples` is kept in [-error_buffer, error_buffer]:
+    sampling blocks if it would drop below the lower bound (consumers run ahead of producers)
+    and inserting blocks if it would exceed the upper bound (consumers fall behind).
+    Inserts before the first sample are not counted, so that warming up the replay buffer
+    does not grant consumers a large budget nor block producers before any sampling.
+    The ratio therefore only holds from the first sample on.
+    """
+
+    def __init__(self, samples_per_insert, error_buffer):
+        self.samples_per_insert = samples_per_insert
+        self.error_buffer = max(error_buffer, samples_per_insert)
+
+        self._inserts = 0
+        self._samples = 0
+        self._started = False
+        self._closed = False
+
+        self._insert_blocked_time = 0.
+        self._sample_blocked_time = 0.
+
+        self._cond = threading.Condition()
+
+    def _diff(self):
+        return self._inserts * self.samples_per_insert - self._samples
+
+    def insert(self, n=1, timeout=None):
+        """
+        Block until n inserts are allowed
+        Return False if the limiter is closed or `timeout` seconds elapsed,
+        in which case the inserts are not counted
+        """
+        with self._cond:
+            t = time.time()
+            allowed = self._cond.wait_for(lambda: self._closed
+                                          or not self._started
+                                          or self._diff() + n * self.samples_per_insert <= self.error_buffer,
+                                          timeout)
+            self._insert_blocked_time += time.time() - t
+
+            if self._closed or not allowed:
+                return False
+
+            if self._started:
+                self._inserts += n
+            self._cond.notify_all()
+
+        return True
+
+    def force_insert(self, n=1):
+        """
+        Count n inserts without blocking, for inserts that are made even though `insert` timed out
+        """
+        with self._cond:
+            if self._started:
+                self._inserts += n
+            self._cond.notify_all()
+
+    def sample(self, n=1, timeout=None):
+        """
+        Block until n samples are allowed
+        Return False if the limiter is closed or `timeout` seconds elapsed
+        """
+        with self._cond:
+            self._started = True
+
+            t = time.time()
+            allowed = self._cond.wait_for(lambda: self._closed
+                                          or self._diff() - n >= -self.error_buffer,
+                                          timeout)
+            self._sample_blocked_time += time.time() - t
+
+            if self._closed or not allowed:
+                return False
+
+            self._samples += n
+            self._cond.notify_all()
+
+        return True
+
+    def cancel_sample(self, n=1):
+        """
+        Give back n samples that were allowed but not used
+        """
+        with self._cond:
+            self._samples -= n
+            self._cond.notify_all()
+
+    def close(self):
+        """
+        Wake up all blocked producers and consumers
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def get_blocked_time(self):
+        """
+        Return and reset the seconds that inserts and samples were blocked
+        """
+        with self._cond:
+            blocked_time = (self._insert_blocked_time, self._sample_blocked_time)
+            self._insert_blocked_time = self._sample_blocked_time = 0.
+
+        return blocked_time
@@ -1,19 +1,345 @@
+import json
 import logging
+import lzma
 import math
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from pathlib import Path
 
 import numpy as np
 
 logger = logging.getLogger('replay')
 
 
+class StorageCodec:
+    """
+    Encode data into the dtype stored in DataStorage and decode it back to float32
+    shape: The shape of data without the first dimension
+    """
+    dtype = np.float32
+    decoded_dtype = np.float32
+
+    def __init__(self, shape):
+        self.shape = tuple(shape)
+
+    @property
+    def storage_shape(self):
+        return self.shape
+
+    def encode(self, data):
+        return data
+
+    def decode(self, data):
+        return data
+
+
+class ImageCodec(StorageCodec):
+    """
+    Store uint8 [0, 255] for float [0, 1] images
+    """
+    dtype = np.uint8
+
+    def encode(self, data):
+        return data * 255
+
+    def decode(self, data):
+        return np.divide(data, 255., dtype=np.float32)
+
+
+class UInt8ImageCodec(ImageCodec):
+    """
+    Store uint8 [0, 255] for float [0, 1] images and keep them uint8 when decoding,
+    so that they are cast and scaled in the graph
+    """
+    decoded_dtype = np.uint8
+
+    def decode(self, data):
+        return data
+
+
+class Float16Codec(StorageCodec):
+    dtype = np.float16
+
+    def decode(self, data):
+        return data.astype(np.float32)
+
+
+class BFloat16Codec(StorageCodec):
+    """
+    Store the upper 16 bits of float32 (bfloat16) as uint16, rounding to nearest even
+    """
+    dtype = np.uint16
+
+    def encode(self, data):
+        bits = np.asarray(data, dtype=np.float32).view(np.uint32)
+        bits = bits + (((bits >> 16) & 1) + 0x7FFF)
+        return (bits >> 16).astype(np.uint16)
+
+    def decode(self, data):
+        return (data.astype(np.uint32) << 16).view(np.float32)
+
+
+class OneHotCodec(StorageCodec):
+    """
+    Store the leading `one_hot_dim` one-hot columns as an index, -1 for all-zero rows
+    If there are remaining columns, the index is stored as float32 in front of them,
+    otherwise it is stored as int32
+    """
+
+    def __init__(self, shape, one_hot_dim=None):
+        super().__init__(shape)
+        assert len(self.shape) == 1, 'one_hot codec only supports vectors'
+
+        self.one_hot_dim = self.shape[0] if one_hot_dim is None else int(one_hot_dim)
+        self.rest_dim = self.shape[0] - self.one_hot_dim
+        self.dtype = np.float32 if self.rest_dim else np.int32
+
+        # The last row is for index -1
+        self._eye = np.eye(self.one_hot_dim + 1, self.one_hot_dim, dtype=np.float32)
+
+    @property
+    def storage_shape(self):
+        return (1 + self.rest_dim,) if self.rest_dim else ()
+
+    def encode(self, data):
+        one_hot = data[..., :self.one_hot_dim]
+        idx = np.argmax(one_hot, axis=-1)
+        idx[np.max(one_hot, axis=-1) == 0] = -1
+
+        if self.rest_dim:
+            return np.concatenate([np.expand_dims(idx, -1), data[..., self.one_hot_dim:]], axis=-1)
+        else:
+            return idx
+
+    def decode(self, data):
+        if self.rest_dim:
+            one_hot = self._eye[data[..., 0].astype(np.int64)]
+            return np.concatenate([one_hot, data[..., 1:]], axis=-1)
+        else:
+            return self._eye[data]
+
+
+STORAGE_CODECS = {
+    'float32': StorageCodec,
+    'image': ImageCodec,
+    'uint8_image': UInt8ImageCodec,
+    'float16': Float16Codec,
+    'bfloat16': BFloat16Codec,
+    'one_hot': OneHotCodec
+}
+
+
+def get_storage_codec(name, shape):
+    """
+    name: One of STORAGE_CODECS, `one_hot:N` for N leading one-hot columns,
+          or None for `image` if data is image, otherwise `float32`
+    """
+    if name is None:
+        name = 'image' if len(shape) == 3 else 'float32'
+
+    name, *args = name.split(':')
+    if name not in STORAGE_CODECS:
+        raise ValueError(f'Undefined storage codec: {name}')
+
+    return STORAGE_CODECS[name](shape, *args)
+
+
+def get_key_storage_codec(key, shape, storage_codecs=None, uint8_images=False):
+    """
+    The storage codec of `key` in `storage_codecs`, `uint8_image` for images if `uint8_images`
+    """
+    name = None if storage_codecs is None else storage_codecs.get(key)
+    if name is None and uint8_images and len(shape) == 3:
+        name = 'uint8_image'
+
+    return get_storage_codec(name, shape)
+
+
+class CompressedFrameStore:
+    """
+    Store each frame of a key compressed as a separate chunk addressable by pointer,
+    with a bounded LRU cache of decoded frames serving repeated reads such as `pointers + i`
+    Indexing by an array of pointers works like a [capacity, *shape] ndarray
+    """
+    COMPRESSIONS = {
+        'zlib': (zlib.compress, zlib.decompress),
+        'lzma': (lambda data, level: lzma.compress(data, preset=level), lzma.decompress)
+    }
+    # The number of frames read as one block when loading
+    LOAD_CHUNK_SIZE = 4096
+
+    def __init__(self, capacity, shape, dtype, compression='zlib', level=1, cache_size=1024):
+        """
+        compression: zlib or lzma
+        level: Compression level, 0-9 for both zlib and lzma presets
+        cache_size: The max number of decoded frames in the cache
+        """
+        if compression not in self.COMPRESSIONS:
+            raise ValueError(f'Undefined frame compression: {compression}')
+
+        self.capacity = capacity
+        self.frame_shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.compression = compression
+        self.level = level
+        self.cache_size = cache_size
+        self._compress, self._decompress = self.COMPRESSIONS[compression]
+
+        # Empty chunks are decoded as zeros
+        self._frames = [b''] * capacity
+        self._cache = OrderedDict()
+
+    @property
+    def shape(self):
+        return (self.capacity, *self.frame_shape)
+
+    @property
+    def nbytes(self):
+        """
+        The size of all compressed chunks
+        """
+        return sum(len(f) for f in self._frames)
+
+    def __len__(self):
+        return self.capacity
+
+    def _to_pointers(self, pointers):
+        """
+        Wrap negative pointers like ndarray indexing, without materializing an index array of the whole capacity
+        """
+        pointers = np.asarray(pointers, dtype=np.int64)
+        if np.any((pointers < -self.capacity) | (pointers >= self.capacity)):
+            raise IndexError(f'Pointers out of bounds for capacity {self.capacity}')
+
+        return pointers % self.capacity
+
+    def __setitem__(self, pointers, data):
+        pointers = self._to_pointers(pointers).reshape(-1)
+        data = np.broadcast_to(np.asarray(data, dtype=self.dtype), (len(pointers), *self.frame_shape))
+
+        for p, frame in zip(pointers.tolist(), data):
+            self._frames[p] = self._compress(np.ascontiguousarray(frame).tobytes(), self.level)
+            self._cache.pop(p, None)
+
+    def __getitem__(self, pointers):
+        pointers = self._to_pointers(pointers)
+        # Each frame is decoded once even if it is read several times
+        unique_pointers, inverse = np.unique(pointers, return_inverse=True)
+
+        frames = np.empty([len(unique_pointers), *self.frame_shape], dtype=self.dtype)
+        for i, p in enumerate(unique_pointers.tolist()):
+            frames[i] = self._get_frame(p)
+
+        return frames[inverse.reshape(pointers.shape)]
+
+    def _get_frame(self, pointer):
+        frame = self._cache.get(pointer)
+        if frame is not None:
+            self._cache.move_to_end(pointer)
+            return frame
+
+        chunk = self._frames[pointer]
+        if chunk:
+            frame = np.frombuffer(self._decompress(chunk), dtype=self.dtype).reshape(self.frame_shape)
+        else:
+            frame = np.zeros(self.frame_shape, dtype=self.dtype)
+
+        if self.cache_size > 0:
+            self._cache[pointer] = frame
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+        return frame
+
+    def save(self, path, key):
+        """
+        Save all chunks as `{key}.frames.npy` and their offsets as `{key}.offsets.npy`
+        """
+        offsets = np.zeros(self.capacity + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(f) for f in self._frames])
+        np.save(path.joinpath(f'{key}.frames.npy'), np.frombuffer(b''.join(self._frames), dtype=np.uint8))
+        np.save(path.joinpath(f'{key}.offsets.npy'), offsets)
+
+    def load(self, path, key):
+        frames = np.load(path.joinpath(f'{key}.frames.npy'), mmap_mode='r')
+        offsets = np.load(path.joinpath(f'{key}.offsets.npy'))
+        assert len(offsets) == self.capacity + 1, f'{key} in {path} does not match the capacity'
+
+        # Read LOAD_CHUNK_SIZE frames at a time as one block and split it into chunks without a per-frame read
+        self._frames = []
+        for start in range(0, self.capacity, self.LOAD_CHUNK_SIZE):
+            end = min(start + self.LOAD_CHUNK_SIZE, self.capacity)
+            block = frames[offsets[start]:offsets[end]].tobytes()
+            chunk_offsets = offsets[start:end + 1] - offsets[start]
+            self._frames += map(block.__getitem__, map(slice, chunk_offsets[:-1].tolist(), chunk_offsets[1:].tolist()))
+        self._cache.clear()
+
+
 class DataStorage:
+    # The number of transitions of a chunk, the unit of incremental saving
+    SAVING_CHUNK_SIZE = 4096
+
     _size = 0
     _id = 0
     _buffer = None
+    _saved_path = None
 
-    def __init__(self, capacity):
+    def __init__(self, capacity, memmap_dir=None, storage_codecs=None,
+                 frame_compression=None, frame_compression_level=1, frame_cache_size=1024,
+                 uint8_images=False):
+        """
+        capacity: The max number of transitions
+        memmap_dir: If not None, store data in memory-mapped .npy files under this directory,
+                    so that the OS page cache holds the hot set and the capacity is not limited by RAM
+        storage_codecs: A dict of the storage codec name of each key, see `get_storage_codec`
+        frame_compression: If not None (zlib or lzma), store image frames in `CompressedFrameStore`
+        frame_compression_level: The compression level of frames
+        frame_cache_size: The max number of decoded frames cached for each image key
+        uint8_images: If get images as uint8 [0, 255] by default instead of float [0, 1]
+        """
         self.capacity = capacity
         self.max_id = 10 * capacity
+        self.memmap_dir = None if memmap_dir is None else Path(memmap_dir)
+        self.storage_codecs = dict() if storage_codecs is None else dict(storage_codecs)
+        self._codecs = dict()
+        self.frame_compression = frame_compression
+        self.frame_compression_level = frame_compression_level
+        self.frame_cache_size = frame_cache_size
+        self.uint8_images = uint8_images
+
+        # Chunks modified since the last saving
+        self._dirty_chunks = np.ones(math.ceil(capacity / self.SAVING_CHUNK_SIZE), dtype=bool)
+
+    def _allocate(self, key, shape, dtype):
+        if self.memmap_dir is None:
+            return np.empty(shape, dtype=dtype)
+
+        os.makedirs(self.memmap_dir, exist_ok=True)
+        return np.lib.format.open_memmap(self.memmap_dir.joinpath(f'{key}.npy'), mode='w+',
+                                         dtype=dtype, shape=tuple(shape))
+
+    def _get_codec(self, key, shape):
+        return get_key_storage_codec(key, shape, self.storage_codecs, self.uint8_images)
+
+    def get_codec(self, key, shape):
+        """
+        The storage codec that data of `key` are stored with, or will be if `key` is not added yet
+        """
+        codec = self._codecs.get(key)
+        return self._get_codec(key, shape) if codec is None else codec
+
+    def _init_key(self, key, shape):
+        codec = self._get_codec(key, shape)
+        self._codecs[key] = codec
+        if self.frame_compression is not None and len(codec.storage_shape) == 3:
+            self._buffer[key] = CompressedFrameStore(self.capacity, codec.storage_shape, codec.dtype,
+                                                     self.frame_compression,
+                                                     self.frame_compression_level,
+                                                     self.frame_cache_size)
+        else:
+            self._buffer[key] = self._allocate(key, [self.capacity, *codec.storage_shape], codec.dtype)
 
     def add(self, data: dict):
         """
@@ -24,21 +350,17 @@ class DataStorage:
 
         if self._buffer is None:
             self._buffer = dict()
-            self._buffer['id'] = np.empty(self.capacity, dtype=np.uint64)
+            self._buffer['id'] = self._allocate('id', [self.capacity], np.uint64)
             for k, v in data.items():
-                # Store uint8 if data is image
-                dtype = np.uint8 if len(v.shape[1:]) == 3 else np.float32
-                self._buffer[k] = np.empty([self.capacity] + list(v.shape[1:]), dtype=dtype)
+                self._init_key(k, v.shape[1:])
 
         ids = (np.arange(tmp_len) + self._id) % self.max_id
         pointers = ids % self.capacity
 
         self._buffer['id'][pointers] = ids
+        self._dirty_chunks[pointers // self.SAVING_CHUNK_SIZE] = True
         for k, v in data.items():
-            # Store uint8 [0, 255] if data is image
-            if len(self._buffer[k].shape[1:]) == 3:
-                v = v * 255
-            self._buffer[k][pointers] = v
+            self._buffer[k][pointers] = self._codecs[k].encode(v)
 
         self._size = min(self._size + tmp_len, self.capacity)
 
@@ -49,18 +371,36 @@ class DataStorage:
         return pointers
 
     def update(self, ids, key, data):
-        self._buffer[key][ids % self.capacity] = data
+        pointers = ids % self.capacity
+        self._buffer[key][pointers] = self._codecs[key].encode(data)
+        self._dirty_chunks[pointers // self.SAVING_CHUNK_SIZE] = True
 
     def get(self, ids):
         """
         Get data from buffer without verifying whether ids in buffer
         """
-        data = {k: v[ids % self.capacity] for k, v in self._buffer.items() if k != 'id'}
+        pointers = ids % self.capacity
+        return {k: self._codecs[k].decode(v[pointers]) for k, v in self._buffer.items() if k != 'id'}
 
-        for k in data:
-            # Restore float [0, 1] if data is image
-            if len(self._buffer[k].shape[1:]) == 3:
-                data[k] = data[k].astype(np.float32) / 255.
+    def get_sequences(self, ids, seq_len):
+        """
+        Get `seq_len` consecutive data starting from each id without verifying whether ids in buffer
+        Each key is gathered by one fancy-index into a preallocated [batch, seq_len, ...] array
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        pointers = (np.expand_dims(ids, 1) + np.arange(seq_len)) % self.capacity  # [batch, seq_len]
+
+        data = dict()
+        for k, v in self._buffer.items():
+            if k == 'id':
+                continue
+
+            if isinstance(v, CompressedFrameStore):
+                data[k] = v[pointers]
+            else:
+                data[k] = np.empty([*pointers.shape, *v.shape[1:]], dtype=v.dtype)
+                np.take(v, pointers, axis=0, out=data[k])
+            data[k] = self._codecs[k].decode(data[k])
 
         return data
 
@@ -70,10 +410,95 @@ class DataStorage:
         """
         return self._buffer['id'][ids % self.capacity]
 
+    def save(self, path):
+        """
+        Save all data as .npy files under `path`
+        If the last saving was to the same `path`, only chunks modified since then are written
+        Compressed frames are always written entirely
+        """
+        path = Path(path)
+        assert self.memmap_dir != path, 'Cannot save to memmap_dir'
+        os.makedirs(path, exist_ok=True)
+
+        is_incremental = self._saved_path == path
+        dirty_chunks = np.nonzero(self._dirty_chunks)[0]
+        self._dirty_chunks[:] = False
+
+        keys = []
+        if self._buffer is not None:
+            keys = list(self._buffer.keys())
+            for k, v in self._buffer.items():
+                if isinstance(v, CompressedFrameStore):
+                    v.save(path, k)
+                elif is_incremental:
+                    saved = np.lib.format.open_memmap(path.joinpath(f'{k}.npy'), mode='r+')
+                    for c in dirty_chunks:
+                        chunk = slice(c * self.SAVING_CHUNK_SIZE, (c + 1) * self.SAVING_CHUNK_SIZE)
+                        saved[chunk] = v[chunk]
+                    saved.flush()
+                    del saved
+                else:
+                    np.save(path.joinpath(f'{k}.npy'), v)
+
+        with open(path.joinpath('storage.json'), 'w') as f:
+            json.dump({
+                'size': int(self._size),
+                'id': int(self._id),
+                'keys': keys,
+                'shapes': {k: list(c.shape) for k, c in self._codecs.items()},
+                'storage_codecs': self.storage_codecs,
+                # The compression of each compressed key
+                'compressed_keys': {k: v.compression for k, v in (self._buffer or {}).items()
+                                    if isinstance(v, CompressedFrameStore)}
+            }, f)
+
+        self._saved_path = path if self._buffer is not None else None
+
+    def load(self, path):
+        path = Path(path)
+        assert self.memmap_dir != path, 'Cannot load from memmap_dir'
+
+        with open(path.joinpath('storage.json')) as f:
+            meta = json.load(f)
+
+        self.clear()
+        if meta['keys']:
+            # Storage codecs the data were encoded with
+            self.storage_codecs = meta.get('storage_codecs', dict())
+            self._buffer = dict()
+            compressed_keys = meta.get('compressed_keys', dict())
+            for k in meta['keys']:
+                if k in compressed_keys:
+                    # Compressed chunks are kept as they are, even if frame_compression is changed
+                    codec = self._get_codec(k, meta['shapes'][k])
+                    self._codecs[k] = codec
+                    self._buffer[k] = CompressedFrameStore(self.capacity, codec.storage_shape, codec.dtype,
+                                                           compressed_keys[k],
+                                                           self.frame_compression_level,
+                                                           self.frame_cache_size)
+                    self._buffer[k].load(path, k)
+                    continue
+
+                saved = np.load(path.joinpath(f'{k}.npy'), mmap_mode='r')
+                assert saved.shape[0] == self.capacity, f'{k} in {path} does not match the capacity'
+                if k != 'id':
+                    self._codecs[k] = self._get_codec(k, meta.get('shapes', dict()).get(k, saved.shape[1:]))
+                self._buffer[k] = self._allocate(k, saved.shape, saved.dtype)
+                self._buffer[k][:] = saved
+                del saved
+
+        self._size = meta['size']
+        self._id = meta['id']
+        self._dirty_chunks[:] = False
+        self._saved_path = path
+
     def clear(self):
         self._size = 0
         self._id = 0
         self._buffer = None
+        self._codecs = dict()
+        self._dirty_chunks[:] = True
+        self._saved_path = None
 
     @property
     def size(self):
@@ -85,6 +510,9 @@ class DataStorage:
 
 
 class SumTree:
+    # Rebuild the whole tree bottom-up if the number of updated leaves * REBUILD_RATIO >= capacity
+    REBUILD_RATIO = 128
+
     def __init__(self, capacity):
         capacity = int(capacity)
         assert capacity & (capacity - 1) == 0
@@ -107,29 +535,81 @@ class SumTree:
         [--------------Parent nodes-------------][-------leaves to recode priority-------]
                     size: capacity - 1                       size: capacity
         """
+        self._max_tree = np.zeros(2 * capacity - 1, dtype=np.float32)
+        """
+        Companion tree with the same structure, each parent node storing the max priority of its children
+        """
 
     def add(self, data_idx, p):
         self.update(data_idx, p)  # update tree_frame
 
     def update(self, data_idx, p):
-        tree_idx = self.data_idx_to_leaf_idx(data_idx)
-        self._tree[tree_idx] = p
+        tree_idx = self.data_idx_to_leaf_idx(np.asarray(data_idx, dtype=np.int64).reshape(-1))
+        p = np.broadcast_to(np.asarray(p, dtype=np.float32).reshape(-1), tree_idx.shape)
+        if len(tree_idx) == 0:
+            return
+
+        if len(tree_idx) * self.REBUILD_RATIO >= self.capacity:
+            self._tree[tree_idx] = p
+            self._max_tree[tree_idx] = p
+            self._rebuild()
+            return
+
+        # Sort once so that parent indices of each level stay sorted and can be deduplicated by a mask
+        # Stable sort keeps the last priority of duplicated leaves, the same as plain assignment
+        order = np.argsort(tree_idx, kind='stable')
+        tree_idx = tree_idx[order]
+        self._tree[tree_idx] = p[order]
+        self._max_tree[tree_idx] = p[order]
 
         for _ in range(self.depth - 1):
             parent_idx = (tree_idx - 1) // 2
-            parent_idx = np.unique(parent_idx)
-            node1 = self._tree[parent_idx * 2 + 1]
-            node2 = self._tree[parent_idx * 2 + 2]
-            self._tree[parent_idx] = node1 + node2
+            mask = np.empty(len(parent_idx), dtype=bool)
+            mask[0] = True
+            np.not_equal(parent_idx[1:], parent_idx[:-1], out=mask[1:])
+            parent_idx = parent_idx[mask]
+
+            node1 = parent_idx * 2 + 1
+            node2 = parent_idx * 2 + 2
+            self._tree[parent_idx] = self._tree[node1] + self._tree[node2]
+            self._max_tree[parent_idx] = np.maximum(self._max_tree[node1], self._max_tree[node2])
 
             tree_idx = parent_idx
 
-    def sample(self, batch_size):
+    def _rebuild(self):
+        """
+        Recompute all parent nodes bottom-up from the leaves
+        """
+        for i in range(self.depth - 1, 0, -1):
+            # Nodes of depth i are [2^i - 1, 2^(i + 1) - 1), parents are [2^(i - 1) - 1, 2^i - 1)
+            children = slice(2**i - 1, 2**(i + 1) - 1)
+            parents = slice(2**(i - 1) - 1, 2**i - 1)
+            nodes = self._tree[children].reshape(-1, 2)
+            np.add(nodes[:, 0], nodes[:, 1], out=self._tree[parents])
+            nodes = self._max_tree[children].reshape(-1, 2)
+            np.maximum(nodes[:, 0], nodes[:, 1], out=self._max_tree[parents])
+
+    def get_leaves(self):
+        return self._tree[self.capacity - 1:]
+
+    def set_leaves(self, p):
+        """
+        Set all leaves at once and rebuild the tree
+        """
+        self._tree[self.capacity - 1:] = p
+        self._max_tree[self.capacity - 1:] = p
+        self._rebuild()
+
+    def sample(self, batch_size, n_batches=1):
+        """
+        Stratified sample `n_batches` batches in one traversal
+        Return leaf indexes and priorities of [n_batches * batch_size, ], batch by batch
+        """
         pri_seg = self.total_p / batch_size       # priority segment
-        pri_seg_low = np.arange(batch_size)
+        pri_seg_low = np.tile(np.arange(batch_size), n_batches)
         pri_seg_high = pri_seg_low + 1
         v = np.random.uniform(pri_seg_low * pri_seg, pri_seg_high * pri_seg)
-        leaf_idx = np.zeros(batch_size, dtype=np.int32)
+        leaf_idx = np.zeros(n_batches * batch_size, dtype=np.int32)
 
         for _ in range(self.depth - 1):
             node1 = leaf_idx * 2 + 1
@@ -149,6 +629,7 @@ class SumTree:
 
     def clear(self):
         self._tree[:] = 0
+        self._max_tree[:] = 0
 
     def display(self):
         for i in range(self.depth):
@@ -160,7 +641,7 @@ class SumTree:
 
     @property
     def max(self):
-        return self._tree[self.capacity - 1:].max()
+        return self._max_tree[0]  # the root
 
 
 class PrioritizedReplayBuffer:
@@ -171,7 +652,13 @@ class PrioritizedReplayBuffer:
                  beta=0.4,  # Importance-sampling, from initial value increasing to 1
                  beta_increment_per_sampling=0.001,
                  td_error_min=0.01,  # Small amount to avoid zero priority
-                 td_error_max=1.):  # Clipped abs error
+                 td_error_max=1.,  # Clipped abs error
+                 memmap_dir=None,  # Directory of memory-mapped storage, None for in-memory storage
+                 storage_codecs=None,  # Storage codec of each key, None for uint8 images and float32 others
+                 frame_compression=None,  # zlib or lzma to compress image frames, None for no compression
+                 frame_compression_level=1,
+                 frame_cache_size=1024,  # The max number of decoded frames cached for each image key
+                 uint8_images=False):  # If sample images as uint8 [0, 255] instead of float [0, 1]
         self.batch_size = batch_size
         self.capacity = int(2**math.floor(math.log2(capacity)))
         self.alpha = alpha
@@ -180,7 +667,9 @@ class PrioritizedReplayBuffer:
         self.td_error_min = td_error_min
         self.td_error_max = td_error_max
         self._sum_tree = SumTree(self.capacity)
-        self._trans_storage = DataStorage(self.capacity)
+        self._trans_storage = DataStorage(self.capacity, memmap_dir, storage_codecs,
+                                          frame_compression, frame_compression_level, frame_cache_size,
+                                          uint8_images)
 
     def add(self, transitions: dict, ignore_size=0):
         if self._trans_storage.size == 0:
@@ -215,21 +704,71 @@ class PrioritizedReplayBuffer:
             probs[-ignore_size:] = 0
         self._sum_tree.add(data_pointers, probs)
 
-    def sample(self):
-        if not self.is_lg_batch_size:
-            return None
-
-        leaf_pointers, p = self._sum_tree.sample(self.batch_size)
+    def _sample_pointers(self, batch_size, n_batches=1):
+        """
+        Return:
+            data_pointers: [n_batches * batch_size, ]
+            p: [n_batches * batch_size, ], the priorities of sampled transitions
+        """
+        leaf_pointers, p = self._sum_tree.sample(batch_size, n_batches)
 
         data_pointers = self._sum_tree.leaf_idx_to_data_idx(leaf_pointers)
+
+        return data_pointers, p
+
+    def _get_is_weights(self, p, total_p, n_batches=1):
+        """
+        Importance-sampling weights normalized in each of `n_batches` batches
+        """
+        is_weights = (p / total_p).reshape(n_batches, -1)
+        self.beta = np.min([1., self.beta + n_batches * self.beta_increment_per_sampling])  # max = 1
+        is_weights = np.power(is_weights / np.min(is_weights, axis=1, keepdims=True), -self.beta).astype(np.float32)
+
+        return is_weights.reshape(-1, 1)
+
+    def _sample(self, batch_size, n_batches=1):
+        data_pointers, p = self._sample_pointers(batch_size, n_batches)
         transitions = self._trans_storage.get(data_pointers)
         data_ids = self._trans_storage.get_ids(data_pointers)
 
-        is_weights = p / self._sum_tree.total_p
-        self.beta = np.min([1., self.beta + self.beta_increment_per_sampling])  # max = 1
-        is_weights = np.power(is_weights / np.min(is_weights), -self.beta).astype(np.float32)
+        return data_ids, transitions, p
+
+    def _sample_sequences(self, seq_len, batch_size, n_batches=1):
+        data_pointers, p = self._sample_pointers(batch_size, n_batches)
+        data_ids = self._trans_storage.get_ids(data_pointers)
+        transitions = self._trans_storage.get_sequences(data_ids, seq_len)
+
+        return data_ids, transitions, p
+
+    def sample(self, n_batches=1):
+        """
+        Sample `n_batches` batches in one traversal, concatenated along the first dimension
+        """
+        if not self.is_lg_batch_size:
+            return None
 
-        return data_ids, transitions, np.expand_dims(is_weights, axis=1)
+        data_ids, transitions, p = self._sample(self.batch_size, n_batches)
+
+        return data_ids, transitions, self._get_is_weights(p, self._sum_tree.total_p, n_batches)
+
+    def sample_sequences(self, seq_len, n_batches=1):
+        """
+        Sample `batch_size` sequences, each of which contains `seq_len` consecutive transitions
+        starting from a prioritized sampled transition
+        `n_batches` batches are sampled in one traversal and gathered at once,
+        concatenated along the first dimension
+
+        Return:
+            data_ids: [n_batches * Batch, ], the ids of the first transitions
+            transitions: dict of [n_batches * Batch, seq_len, ...]
+            is_weights: [n_batches * Batch, 1]
+        """
+        if not self.is_lg_batch_size:
+            return None
+
+        data_ids, transitions, p = self._sample_sequences(seq_len, self.batch_size, n_batches)
+
+        return data_ids, transitions, self._get_is_weights(p, self._sum_tree.total_p, n_batches)
 
     def get_storage_data(self, data_ids):
         """
@@ -240,6 +779,17 @@ class PrioritizedReplayBuffer:
     def get_storage_data_ids(self, data_ids):
         return self._trans_storage.get_ids(data_ids)
 
+    def get_storage_codec(self, key, shape):
+        return self._trans_storage.get_codec(key, shape)
+
+    def is_valid(self, data_ids):
+        """
+        Whether the transitions of data_ids are still in the buffer
+        `id + i` of sequences may exceed the max id, compare it modulo the max id as ids are generated
+        """
+        data_ids = np.asarray(data_ids, dtype=np.int64)
+        return data_ids % self._trans_storage.max_id == self.get_storage_data_ids(data_ids).astype(np.int64)
+
     def update(self, data_ids, td_error):
         td_error = np.asarray(td_error)
         td_error = td_error.flatten()
@@ -256,6 +806,24 @@ class PrioritizedReplayBuffer:
     def update_transitions(self, data_ids, key, data):
         self._trans_storage.update(data_ids, key, data)
 
+    def save(self, path):
+        """
+        Save transitions, priorities and counters under `path`
+        Transitions are saved incrementally if the last saving was to the same `path`
+        """
+        path = Path(path)
+        self._trans_storage.save(path)
+        np.save(path.joinpath('priority.npy'), self._sum_tree.get_leaves())
+        with open(path.joinpath('replay.json'), 'w') as f:
+            json.dump({'beta': float(self.beta)}, f)
+
+    def load(self, path):
+        path = Path(path)
+        self._trans_storage.load(path)
+        self._sum_tree.set_leaves(np.load(path.joinpath('priority.npy')))
+        with open(path.joinpath('replay.json')) as f:
+            self.beta = json.load(f)['beta']
+
     def clear(self):
         self._trans_storage.clear()
         self._sum_tree.clear()
@@ -273,6 +841,237 @@ class PrioritizedReplayBuffer:
         return self._trans_storage.size > self.batch_size
 
 
+class ShardedPrioritizedReplayBuffer:
+    """
+    `n_shards` independent PrioritizedReplayBuffer shards, each with its own lock,
+    so that concurrent adding, sampling and updating do not serialize on one lock
+    Episodes are added to shards round-robin, and shards are sampled by their total priorities
+    All methods are thread-safe
+    """
+
+    def __init__(self, n_shards=1, batch_size=256, capacity=524288,
+                 beta=0.4, beta_increment_per_sampling=0.001,
+                 **kwargs):
+        """
+        kwargs: Other arguments of each PrioritizedReplayBuffer shard,
+            each shard stores its memory-mapped data under `memmap_dir/shard_{i}`
+        """
+        assert n_shards >= 1
+
+        self.n_shards = int(2**math.floor(math.log2(n_shards)))
+        self.batch_size = batch_size
+        self.beta = beta
+        self.beta_increment_per_sampling = beta_increment_per_sampling
+
+        capacity = int(2**math.floor(math.log2(capacity)))
+        memmap_dir = kwargs.pop('memmap_dir', None)
+        self._shards = [PrioritizedReplayBuffer(batch_size=batch_size,
+                                                capacity=capacity // self.n_shards,
+                                                beta=beta,
+                                                beta_increment_per_sampling=beta_increment_per_sampling,
+                                                memmap_dir=None if memmap_dir is None
+                                                else Path(memmap_dir).joinpath(f'shard_{i}'),
+                                                **kwargs)
+                        for i in range(self.n_shards)]
+        self._shard_locks = [threading.Lock() for _ in range(self.n_shards)]
+        self.capacity = sum(shard.capacity for shard in self._shards)
+
+        # Data id = shard index * _id_stride + id in the shard
+        # The stride leaves room for `id + i` of sequences beyond the max id of a shard
+        self._id_stride = 2 * self._shards[0]._trans_storage.max_id
+
+        self._next_shard = 0
+        self._next_shard_lock = threading.Lock()
+
+    _get_is_weights = PrioritizedReplayBuffer._get_is_weights
+
+    def _get_next_shard(self):
+        with self._next_shard_lock:
+            i = self._next_shard
+            self._next_shard = (i + 1) % self.n_shards
+
+        return i
+
+    def _split_ids(self, data_ids):
+        """
+        Return a list of (shard index, mask of data_ids in the shard, ids in the shard)
+        """
+        data_ids = np.asarray(data_ids, dtype=np.int64)
+        shard_idx = data_ids // self._id_stride
+
+        splits = []
+        for i in np.unique(shard_idx):
+            mask = shard_idx == i
+            splits.append((int(i), mask, data_ids[mask] % self._id_stride))
+
+        return splits
+
+    def add(self, transitions: dict, ignore_size=0):
+        i = self._get_next_shard()
+        with self._shard_locks[i]:
+            self._shards[i].add(transitions, ignore_size)
+
+    def add_with_td_error(self, td_error, transitions: dict, ignore_size=0):
+        i = self._get_next_shard()
+        with self._shard_locks[i]:
+            self._shards[i].add_with_td_error(td_error, transitions, ignore_size)
+
+    def _sample(self, sample_shard, n_batches):
+        """
+        Split each batch into shards by their total priorities and sample each shard under its own lock
+        sample_shard: (shard, batch_size) -> (data_ids, transitions, p)
+        """
+        if not self.is_lg_batch_size:
+            return None
+
+        total_ps = np.array([shard._sum_tree.total_p for shard in self._shards], dtype=np.float64)
+        if total_ps.sum() == 0:
+            return None
+        # [n_batches, n_shards]
+        shard_batch_sizes = np.random.multinomial(self.batch_size, total_ps / total_ps.sum(), size=n_batches)
+
+        data_ids, transitions, p = [], [], []
+        for i, batch_size in enumerate(shard_batch_sizes.sum(axis=0)):
+            if batch_size == 0:
+                continue
+
+            with self._shard_locks[i]:
+                shard_data_ids, shard_transitions, shard_p = sample_shard(self._shards[i], batch_size)
+
+            data_ids.append(shard_data_ids.astype(np.int64) + i * self._id_stride)
+            transitions.append(shard_transitions)
+            p.append(shard_p)
+
+        data_ids = np.concatenate(data_ids)
+        transitions = {k: np.concatenate([t[k] for t in transitions]) for k in transitions[0]}
+        p = np.concatenate(p)
+
+        if n_batches > 1:
+            # Samples are grouped by shards, reorder them batch by batch
+            shard_offsets = np.concatenate([[0], np.cumsum(shard_batch_sizes.sum(axis=0))[:-1]])
+            batch_offsets = shard_offsets + np.cumsum(shard_batch_sizes, axis=0) - shard_batch_sizes
+            order = np.concatenate([np.arange(o, o + n)
+                                    for offsets, sizes in zip(batch_offsets, shard_batch_sizes)
+                                    for o, n in zip(offsets, sizes)])
+            data_ids = data_ids[order]
+            transitions = {k: v[order] for k, v in transitions.items()}
+            p = p[order]
+
+        is_weights = self._get_is_weights(p, total_ps.sum(), n_batches)
+
+        return data_ids, transitions, is_weights
+
+    def sample(self, n_batches=1):
+        """
+        The same as PrioritizedReplayBuffer.sample
+        """
+        return self._sample(lambda shard, batch_size: shard._sample(batch_size), n_batches)
+
+    def sample_sequences(self, seq_len, n_batches=1):
+        """
+        The same as PrioritizedReplayBuffer.sample_sequences
+        """
+        return self._sample(lambda shard, batch_size: shard._sample_sequences(seq_len, batch_size), n_batches)
+
+    def get_storage_data(self, data_ids):
+        """
+        Get data without verifying whether data_ids exist
+        """
+        data_ids = np.asarray(data_ids)
+        data = dict()
+        for i, mask, shard_ids in self._split_ids(data_ids):
+            with self._shard_locks[i]:
+                shard_data = self._shards[i].get_storage_data(shard_ids)
+            for k, v in shard_data.items():
+                if k not in data:
+                    data[k] = np.empty([*data_ids.shape, *v.shape[1:]], dtype=v.dtype)
+                data[k][mask] = v
+
+        return data
+
+    def get_storage_data_ids(self, data_ids):
+        result = np.empty(np.shape(data_ids), dtype=np.int64)
+        for i, mask, shard_ids in self._split_ids(data_ids):
+            with self._shard_locks[i]:
+                result[mask] = self._shards[i].get_storage_data_ids(shard_ids).astype(np.int64) \
+                    + i * self._id_stride
+
+        return result
+
+    def is_valid(self, data_ids):
+        """
+        The same as PrioritizedReplayBuffer.is_valid
+        """
+        result = np.zeros(np.shape(data_ids), dtype=bool)
+        for i, mask, shard_ids in self._split_ids(data_ids):
+            with self._shard_locks[i]:
+                result[mask] = self._shards[i].is_valid(shard_ids)
+
+        return result
+
+    def update(self, data_ids, td_error):
+        """
+        Update priorities of data_ids, skipping transitions that have been overwritten since sampling
+        """
+        td_error = np.asarray(td_error).flatten()
+        for i, mask, shard_ids in self._split_ids(data_ids):
+            shard = self._shards[i]
+            with self._shard_locks[i]:
+                valid = shard.is_valid(shard_ids)
+                if np.any(valid):
+                    shard.update(shard_ids[valid], td_error[mask][valid])
+
+    def update_transitions(self, data_ids, key, data):
+        """
+        Update transitions of data_ids, skipping transitions that have been overwritten since sampling
+        """
+        for i, mask, shard_ids in self._split_ids(data_ids):
+            shard = self._shards[i]
+            with self._shard_locks[i]:
+                valid = shard.is_valid(shard_ids)
+                if np.any(valid):
+                    shard.update_transitions(shard_ids[valid], key, data[mask][valid])
+
+    def save(self, path):
+        """
+        Save each shard under `path/shard_{i}`
+        """
+        path = Path(path)
+        for i, shard in enumerate(self._shards):
+            with self._shard_locks[i]:
+                shard.save(path.joinpath(f'shard_{i}'))
+        with open(path.joinpath('replay.json'), 'w') as f:
+            json.dump({'beta': float(self.beta), 'n_shards': self.n_shards}, f)
+
+    def load(self, path):
+        path = Path(path)
+        with open(path.joinpath('replay.json')) as f:
+            meta = json.load(f)
+        assert meta.get('n_shards') == self.n_shards, f'The number of shards in {path} does not match'
+
+        for i, shard in enumerate(self._shards):
+            with self._shard_locks[i]:
+                shard.load(path.joinpath(f'shard_{i}'))
+        self.beta = meta['beta']
+
+    def clear(self):
+        for i, shard in enumerate(self._shards):
+            with self._shard_locks[i]:
+                shard.clear()
+
+    @property
+    def is_full(self):
+        return all(shard.is_full for shard in self._shards)
+
+    @property
+    def size(self):
+        return sum(shard.size for shard in self._shards)
+
+    @property
+    def is_lg_batch_size(self):
+        return self.size > self.batch_size
+
+
 if __name__ == "__main__":
     import time
     replay_buffer = PrioritizedReplayBuffer(16, 128)
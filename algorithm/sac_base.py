@@ -1,12 +1,18 @@
+import inspect
 import logging
+import threading
 import time
+from contextlib import ExitStack, contextmanager
 from pathlib import Path
 
 import numpy as np
 import tensorflow as tf
 import tensorflow_probability as tfp
+from numpy.lib.stride_tricks import sliding_window_view
 
-from .replay_buffer import PrioritizedReplayBuffer
+from .nn_models import ModelBaseRNNRep, ModelEnsembleQ
+from .replay_buffer import PrioritizedReplayBuffer, get_key_storage_codec
+from .summary_writer import AsyncSummaryWriter
 
 logger = logging.getLogger('sac.base')
 
@@ -49,6 +55,47 @@ def _np_to_tensor(fn):
     return c
 
 
+def decode_images(obs_list):
+    """
+    Cast uint8 [0, 255] images to float32 [0, 1] in the graph
+    """
+    return [tf.cast(obs, tf.float32) / 255. if obs.dtype == tf.uint8 else obs for obs in obs_list]
+
+
+def cast_to_float32(x):
+    """
+    Cast low precision outputs (tensors, Categorical and Normal distributions) of
+    mixed precision models back to float32
+    Distributions of tfp.layers.DistributionLambda are not Categorical or Normal instances,
+    so their layers have to be float32 as in ModelPolicy
+    """
+    if isinstance(x, (list, tuple)):
+        return type(x)(cast_to_float32(i) for i in x)
+    if isinstance(x, tfp.distributions.Categorical):
+        return tfp.distributions.Categorical(logits=tf.cast(x.logits_parameter(), tf.float32))
+    if isinstance(x, tfp.distributions.Normal):
+        return tfp.distributions.Normal(tf.cast(x.loc, tf.float32), tf.cast(x.scale, tf.float32))
+    if isinstance(x, tf.Tensor) and x.dtype.is_floating and x.dtype != tf.float32:
+        return tf.cast(x, tf.float32)
+    return x
+
+
+def float32_outputs(model_class):
+    """
+    Subclass `model_class` whose outputs are cast to float32
+    """
+    has_training = 'training' in inspect.signature(model_class.call).parameters.keys()
+
+    class Model(model_class):
+        def call(self, *args, **kwargs):
+            if 'training' in kwargs and not has_training:
+                del kwargs['training']
+
+            return cast_to_float32(super().call(*args, **kwargs))
+
+    return Model
+
+
 def scale_h(x, epsilon=0.001):
     return tf.sign(x) * (tf.sqrt(tf.abs(x) + 1) - 1) + epsilon * x
 
@@ -60,6 +107,9 @@ def scale_inverse_h(x, epsilon=0.001):
 
 class SAC_Base(object):
     _last_save_time = 0
+    _saving_thread = None
+    _skipped_saves = 0
+    replay_buffer = None
 
     def __init__(self,
                  obs_dims,
@@ -77,6 +127,7 @@ class SAC_Base(object):
 
                  ensemble_q_num=2,
                  ensemble_q_sample=2,
+                 vectorized_q=False,
 
                  burn_in_step=0,
                  n_step=1,
@@ -104,6 +155,13 @@ class SAC_Base(object):
                  use_rnd=False,
                  rnd_n_sample=10,
                  use_normalization=False,
+                 save_replay_buffer=False,
+                 uint8_images=False,
+                 prefetch_batches=0,
+                 train_steps_per_call=1,
+                 jit_compile=False,
+                 precision='float32',
+                 async_checkpoint=False,
 
                  replay_config=None):
         """
@@ -121,6 +179,7 @@ class SAC_Base(object):
 
         ensemble_q_num: 2 # Number of Qs
         ensemble_q_sample: 2 # Number of min Qs
+        vectorized_q: If compute all Qs in one ensemble-batched model with one optimizer
 
         burn_in_step: Burn-in steps in R2D2
         n_step: Update Q function by `n_step` steps
@@ -147,6 +206,14 @@ class SAC_Base(object):
         use_rnd: If use RND
         rnd_n_sample: RND sample times
         use_normalization: If use observation normalization
+        save_replay_buffer: If save the replay buffer with checkpoints and restore it
+        uint8_images: If sample images as uint8 and cast them to float32 inside model_rep
+        prefetch_batches: If > 0, sample batches in a tf.data pipeline `prefetch_batches` batches ahead of training
+        train_steps_per_call: Train `train_steps_per_call` stacked batches in one tf.function call
+        jit_compile: If compile training and acting functions with XLA
+        precision: float32 | mixed_bfloat16. If mixed_bfloat16, rep, Q and policy models compute in bfloat16
+            while their variables, losses and log_alpha stay in float32
+        async_checkpoint: If snapshot variables into host memory and write checkpoints in the background
         """
 
         physical_devices = tf.config.experimental.list_physical_devices('GPU')
@@ -160,6 +227,7 @@ class SAC_Base(object):
 
         self.ensemble_q_num = ensemble_q_num
         self.ensemble_q_sample = ensemble_q_sample
+        self.vectorized_q = vectorized_q
 
         self.burn_in_step = burn_in_step
         self.n_step = n_step
@@ -188,6 +256,14 @@ class SAC_Base(object):
         self.use_rnd = use_rnd
         self.rnd_n_sample = rnd_n_sample
         self.use_normalization = use_normalization
+        self.save_replay_buffer = save_replay_buffer
+        self.uint8_images = uint8_images
+        self.prefetch_batches = prefetch_batches
+        self.train_steps_per_call = train_steps_per_call
+        self.jit_compile = jit_compile
+        assert precision in ('float32', 'mixed_bfloat16'), f'Unsupported precision {precision}'
+        self.precision = precision
+        self.async_checkpoint = async_checkpoint
 
         self.action_dim = self.d_action_dim + self.c_action_dim
 
@@ -196,16 +272,28 @@ class SAC_Base(object):
         if seed is not None:
             tf.random.set_seed(seed)
 
+        replay_config = {} if replay_config is None else replay_config
+        self.storage_codecs = replay_config.get('storage_codecs')
+
         if self.train_mode:
             summary_path = Path(model_abs_dir).joinpath('log')
             self.summary_writer = tf.summary.create_file_writer(str(summary_path))
+            self.async_summary_writer = AsyncSummaryWriter(self.summary_writer)
 
-            replay_config = {} if replay_config is None else replay_config
-            self.replay_buffer = PrioritizedReplayBuffer(**replay_config)
+            self.replay_buffer = PrioritizedReplayBuffer(**replay_config, uint8_images=self.uint8_images)
+            # Guard the replay buffer against the prefetching pipeline
+            self._replay_buffer_lock = threading.Lock()
+            self._prefetch_iterator = None
 
         self._build_model(model, init_log_alpha, learning_rate)
         self._init_or_restore(model_abs_dir, last_ckpt)
 
+        if self.train_mode and self.save_replay_buffer:
+            self.replay_buffer_dir = Path(model_abs_dir).joinpath('replay')
+            if self.replay_buffer_dir.joinpath('replay.json').exists():
+                self.replay_buffer.load(self.replay_buffer_dir)
+                logger.info(f'Replay buffer restored from {self.replay_buffer_dir}, size: {self.replay_buffer.size}')
+
         self._init_tf_function()
 
     def _build_model(self, model, init_log_alpha, learning_rate):
@@ -231,20 +319,18 @@ class SAC_Base(object):
             # automatically. But if the subclass does not specify the 'training' argument,
             # it will throw exception when calling super().call(obs_list, *args, **kwargs)
 
-            import inspect
-
             has_training = 'training' in inspect.signature(model.ModelRep.call).parameters.keys()
 
             class ModelRep(model.ModelRep):
                 def call(self, obs_list, *args, **kwargs):
                     obs_list = [
                         tf.clip_by_value(
-                            (obs - p_self.running_means)
+                            (obs - p_self.running_means[i])
                             / tf.sqrt(
-                                p_self.running_variances / (tf.cast(p_self.normalizer_step, tf.float32) + 1)
+                                p_self.running_variances[i] / (tf.cast(p_self.normalizer_step, tf.float32) + 1)
                             ),
                             -5, 5
-                        ) for obs in obs_list
+                        ) for i, obs in enumerate(obs_list)
                     ]
 
                     if 'training' in kwargs and not has_training:
@@ -254,20 +340,37 @@ class SAC_Base(object):
         else:
             ModelRep = model.ModelRep
 
-        if self.use_rnn:
-            # Get represented state dimension
-            self.model_rep = ModelRep(self.obs_dims, self.d_action_dim, self.c_action_dim)
-            self.model_target_rep = ModelRep(self.obs_dims, self.d_action_dim, self.c_action_dim)
-            # Get state and rnn_state dimension
-            state, next_rnn_state = self.model_rep.init()
-            self.rnn_state_dim = next_rnn_state.shape[-1]
-        else:
-            # Get represented state dimension
-            self.model_rep = ModelRep(self.obs_dims)
-            self.model_target_rep = ModelRep(self.obs_dims)
-            # Get state dimension
-            state = self.model_rep.init()
-            self.rnn_state_dim = 1
+        if any(self._is_uint8_obs(i) for i in range(len(self.obs_dims))):
+            has_training = 'training' in inspect.signature(ModelRep.call).parameters.keys()
+            BaseModelRep = ModelRep
+
+            class ModelRep(BaseModelRep):
+                def call(self, obs_list, *args, **kwargs):
+                    obs_list = decode_images(obs_list)
+
+                    if 'training' in kwargs and not has_training:
+                        del kwargs['training']
+
+                    return super().call(obs_list, *args, **kwargs)
+
+        if self.precision != 'float32':
+            ModelRep = float32_outputs(ModelRep)
+
+        with self._precision_scope():
+            if self.use_rnn:
+                # Get represented state dimension
+                self.model_rep = ModelRep(self.obs_dims, self.d_action_dim, self.c_action_dim)
+                self.model_target_rep = ModelRep(self.obs_dims, self.d_action_dim, self.c_action_dim)
+                # Get state and rnn_state dimension
+                state, next_rnn_state = self.model_rep.init()
+                self.rnn_state_dim = next_rnn_state.shape[-1]
+            else:
+                # Get represented state dimension
+                self.model_rep = ModelRep(self.obs_dims)
+                self.model_target_rep = ModelRep(self.obs_dims)
+                # Get state dimension
+                state = self.model_rep.init()
+                self.rnn_state_dim = 1
         state_dim = state.shape[-1]
         logger.info(f'State Dimension: {state_dim}')
         self.optimizer_rep = adam_optimizer()
@@ -294,15 +397,53 @@ class SAC_Base(object):
             self.model_target_rnd = model.ModelRND(state_dim, self.d_action_dim + self.c_action_dim)
             self.optimizer_rnd = tf.keras.optimizers.Adam(learning_rate)
 
-        self.model_q_list = [model.ModelQ(state_dim, self.d_action_dim, self.c_action_dim, f'q{i}')
-                             for i in range(self.ensemble_q_num)]
-        self.model_target_q_list = [model.ModelQ(state_dim, self.d_action_dim, self.c_action_dim, f'target_q{i}')
-                                    for i in range(self.ensemble_q_num)]
-        self.optimizer_q_list = [adam_optimizer() for _ in range(self.ensemble_q_num)]
+        if self.precision != 'float32':
+            ModelQ = float32_outputs(model.ModelQ)
+            EnsembleQ = float32_outputs(ModelEnsembleQ)
+            ModelPolicy = float32_outputs(model.ModelPolicy)
+        else:
+            ModelQ = model.ModelQ
+            EnsembleQ = ModelEnsembleQ
+            ModelPolicy = model.ModelPolicy
+
+        def create_model_q(name): return ModelQ(state_dim, self.d_action_dim, self.c_action_dim, name)
+        self._create_model_q = create_model_q
+
+        with self._precision_scope():
+            if self.vectorized_q:
+                # ModelQ is only used as the architecture template
+                self.model_q = EnsembleQ(create_model_q('q_template'), self.ensemble_q_num, 'q')
+                self.model_target_q = EnsembleQ(create_model_q('target_q_template'), self.ensemble_q_num, 'target_q')
+            else:
+                self.model_q_list = [create_model_q(f'q{i}') for i in range(self.ensemble_q_num)]
+                self.model_target_q_list = [create_model_q(f'target_q{i}') for i in range(self.ensemble_q_num)]
+
+            self.model_policy = ModelPolicy(state_dim, self.d_action_dim, self.c_action_dim, 'policy')
 
-        self.model_policy = model.ModelPolicy(state_dim, self.d_action_dim, self.c_action_dim, 'policy')
+        if self.vectorized_q:
+            self.optimizer_q = adam_optimizer()
+        else:
+            self.optimizer_q_list = [adam_optimizer() for _ in range(self.ensemble_q_num)]
         self.optimizer_policy = adam_optimizer()
 
+    @contextmanager
+    def _precision_scope(self):
+        """
+        Models created in the scope compute in `precision`. Their variables are always float32,
+        so checkpoints are interchangeable between precisions.
+        bfloat16 has the same exponent range as float32, so no loss scaling is needed
+        """
+        if self.precision == 'float32':
+            yield
+            return
+
+        policy = tf.keras.mixed_precision.global_policy()
+        tf.keras.mixed_precision.set_global_policy(self.precision)
+        try:
+            yield
+        finally:
+            tf.keras.mixed_precision.set_global_policy(policy)
+
     def _create_normalizer(self):
         self.normalizer_step = tf.Variable(0, dtype=tf.int32, trainable=False, name='normalizer_step')
         self.running_means = []
@@ -330,10 +471,15 @@ class SAC_Base(object):
             'optimizer_policy': self.optimizer_policy
         }
 
-        for i in range(self.ensemble_q_num):
-            ckpt_saved[f'model_q{i}'] = self.model_q_list[i]
-            ckpt_saved[f'model_target_q{i}'] = self.model_target_q_list[i]
-            ckpt_saved[f'optimizer_q{i}'] = self.optimizer_q_list[i]
+        if self.vectorized_q:
+            ckpt_saved['model_q'] = self.model_q
+            ckpt_saved['model_target_q'] = self.model_target_q
+            ckpt_saved['optimizer_q'] = self.optimizer_q
+        else:
+            for i in range(self.ensemble_q_num):
+                ckpt_saved[f'model_q{i}'] = self.model_q_list[i]
+                ckpt_saved[f'model_target_q{i}'] = self.model_target_q_list[i]
+                ckpt_saved[f'optimizer_q{i}'] = self.optimizer_q_list[i]
 
         if self.use_normalization:
             ckpt_saved['normalizer_step'] = self.normalizer_step
@@ -376,6 +522,7 @@ class SAC_Base(object):
                     i = str.rindex(self.ckpt_manager.latest_checkpoint, '-')
                     latest_checkpoint = self.ckpt_manager.latest_checkpoint[:i] + f'-{last_ckpt}'
                 ckpt.restore(latest_checkpoint)
+                self._convert_q_checkpoint(latest_checkpoint)
                 logger.info(f'Restored from {latest_checkpoint}')
                 self.init_iteration = int(latest_checkpoint.split('-')[-1])
             else:
@@ -384,6 +531,40 @@ class SAC_Base(object):
                 self.init_iteration = 0
                 self._update_target_variables()
 
+    def _convert_q_checkpoint(self, ckpt_path):
+        """
+        Restore Qs saved in the other layout, a list of ModelQ or one ModelEnsembleQ
+        Optimizer states of Qs are not converted
+        """
+        ckpt_keys = set([name.split('/')[0] for name, _ in tf.train.list_variables(ckpt_path)])
+
+        if self.vectorized_q and 'model_q0' in ckpt_keys:
+            model_q_list = [self._create_model_q(f'q{i}') for i in range(self.ensemble_q_num)]
+            model_target_q_list = [self._create_model_q(f'target_q{i}') for i in range(self.ensemble_q_num)]
+            ckpt_q = {
+                **{f'model_q{i}': q for i, q in enumerate(model_q_list)},
+                **{f'model_target_q{i}': q for i, q in enumerate(model_target_q_list)}
+            }
+            for q in ckpt_q.values():
+                q.init()
+            tf.train.Checkpoint(**ckpt_q).restore(ckpt_path).expect_partial()
+
+            self.model_q.set_from_models(model_q_list)
+            self.model_target_q.set_from_models(model_target_q_list)
+            logger.info('Converted Qs from ModelQ list to ModelEnsembleQ')
+
+        elif not self.vectorized_q and 'model_q' in ckpt_keys:
+            model_q = ModelEnsembleQ(self.model_q_list[0], self.ensemble_q_num, 'q')
+            model_target_q = ModelEnsembleQ(self.model_target_q_list[0], self.ensemble_q_num, 'target_q')
+            model_q.init()
+            model_target_q.init()
+            tf.train.Checkpoint(model_q=model_q,
+                                model_target_q=model_target_q).restore(ckpt_path).expect_partial()
+
+            model_q.assign_to_models(self.model_q_list)
+            model_target_q.assign_to_models(self.model_target_q_list)
+            logger.info('Converted Qs from ModelEnsembleQ to ModelQ list')
+
     def _init_tf_function(self):
         """
         Initialize some @tf.function and specify tf.TensorSpec
@@ -401,12 +582,19 @@ class SAC_Base(object):
 
         """ get_n_probs
         n_obses_list, n_selected_actions, rnn_state=None """
-        tmp_get_n_probs = tf.function(self.get_n_probs.python_function, input_signature=[
-            [tf.TensorSpec(shape=(None, None, *t)) for t in self.obs_dims],
+        tmp_get_n_probs = self._tf_function(self.get_n_probs.python_function, input_signature=[
+            self._get_obs_signature(None, None),
             tf.TensorSpec(shape=(None, None, self.action_dim)),
             tf.TensorSpec(shape=(None, self.rnn_state_dim)) if self.use_rnn else None_tensor,
-        ])
-        self.get_n_probs = _np_to_tensor(tmp_get_n_probs)
+        ], jit_name='get_n_probs')
+        self.get_n_probs = self._encode_images(_np_to_tensor(tmp_get_n_probs))
+
+        """ choose_action, choose_rnn_action """
+        self.choose_action = self._tf_function(self.choose_action.python_function,
+                                               jit_name='choose_action')
+        if self.use_rnn:
+            self.choose_rnn_action = self._tf_function(self.choose_rnn_action.python_function,
+                                                       jit_name='choose_rnn_action')
 
         step_size = self.burn_in_step + self.n_step
 
@@ -415,16 +603,17 @@ class SAC_Base(object):
         n_mu_probs=None,
         rnn_state=None """
         signature = [
-            [tf.TensorSpec(shape=(None, step_size, *t)) for t in self.obs_dims],
+            self._get_obs_signature(None, step_size),
             tf.TensorSpec(shape=(None, step_size, self.action_dim)),
             tf.TensorSpec(shape=(None, step_size)),
-            [tf.TensorSpec(shape=(None, *t)) for t in self.obs_dims],
+            self._get_obs_signature(None),
             tf.TensorSpec(shape=(None, step_size)),
             tf.TensorSpec(shape=(None, step_size)) if self.use_n_step_is else None_tensor,
             tf.TensorSpec(shape=(None, self.rnn_state_dim)) if self.use_rnn else None_tensor,
         ]
-        self.get_td_error = _np_to_tensor(tf.function(self.get_td_error.python_function,
-                                                      input_signature=signature))
+        self.get_td_error = self._encode_images(_np_to_tensor(self._tf_function(self.get_td_error.python_function,
+                                                                                input_signature=signature,
+                                                                                jit_name='get_td_error')))
 
         if self.train_mode:
             """ _train
@@ -432,17 +621,114 @@ class SAC_Base(object):
             n_mu_probs=None, priority_is=None,
             initial_rnn_state=None """
             signature = [
-                [tf.TensorSpec(shape=(None, step_size, *t)) for t in self.obs_dims],
+                self._get_obs_signature(None, step_size),
                 tf.TensorSpec(shape=(None, step_size, self.action_dim)),
                 tf.TensorSpec(shape=(None, step_size)),
-                [tf.TensorSpec(shape=(None, *t)) for t in self.obs_dims],
+                self._get_obs_signature(None),
                 tf.TensorSpec(shape=(None, step_size)),
                 tf.TensorSpec(shape=(None, step_size)) if self.use_n_step_is else None_tensor,
                 tf.TensorSpec(shape=(None, 1)) if self.use_priority else None_tensor,
                 tf.TensorSpec(shape=(None, self.rnn_state_dim)) if self.use_rnn else None_tensor,
             ]
-            self._train = _np_to_tensor(tf.function(self._train.python_function,
-                                                    input_signature=signature))
+            self._train = self._encode_images(_np_to_tensor(tf.function(self._train.python_function,
+                                                                        input_signature=signature)))
+            self._train_and_recompute = self._encode_images(_np_to_tensor(
+                self._tf_function(self._train_and_recompute.python_function, input_signature=signature,
+                                  jit_name='_train_and_recompute')))
+
+            if self.train_steps_per_call > 1:
+                """ _train_n_steps
+                The same as _train_and_recompute, but with stacked batches [K, Batch, ...] """
+                signature = [
+                    self._get_obs_signature(None, None, step_size),
+                    tf.TensorSpec(shape=(None, None, step_size, self.action_dim)),
+                    tf.TensorSpec(shape=(None, None, step_size)),
+                    self._get_obs_signature(None, None),
+                    tf.TensorSpec(shape=(None, None, step_size)),
+                    tf.TensorSpec(shape=(None, None, step_size)) if self.use_n_step_is else None_tensor,
+                    tf.TensorSpec(shape=(None, None, 1)) if self.use_priority else None_tensor,
+                    tf.TensorSpec(shape=(None, None, self.rnn_state_dim)) if self.use_rnn else None_tensor,
+                ]
+                self._train_n_steps = self._encode_images(_np_to_tensor(self._tf_function(self._train_n_steps.python_function,
+                                                                                          input_signature=signature,
+                                                                                          jit_name='_train_n_steps')))
+
+    def _tf_function(self, fn, input_signature=None, jit_name=None):
+        """
+        tf.function of `fn`. If `jit_compile` and `jit_name` is specified, `fn` is compiled with XLA,
+        and falls back to tf.function if XLA fails to compile it in the first call
+        """
+        tf_fn = tf.function(fn, input_signature=input_signature)
+        if not self.jit_compile or jit_name is None:
+            return tf_fn
+
+        jit_fn = tf.function(fn, input_signature=input_signature, jit_compile=True)
+        compiled_fn = None
+
+        def c(*args, **kwargs):
+            nonlocal compiled_fn
+
+            # Called inside another tf.function, which will be compiled or not as a whole
+            if not tf.executing_eagerly():
+                return tf_fn(*args, **kwargs)
+
+            if compiled_fn is None:
+                try:
+                    result = jit_fn(*args, **kwargs)
+                    compiled_fn = jit_fn
+                    logger.info(f'{jit_name} is compiled with XLA')
+                    return result
+                except (tf.errors.InvalidArgumentError, tf.errors.UnimplementedError) as e:
+                    compiled_fn = tf_fn
+                    logger.warning(f'{jit_name} falls back to tf.function without XLA: {e.message.splitlines()[0]}')
+
+            return compiled_fn(*args, **kwargs)
+
+        return c
+
+    def _is_uint8_obs(self, i):
+        """
+        If the i-th observation is sampled as uint8, decided by the storage codec of `obs_{i}`
+        that the replay buffer actually uses
+        """
+        key, shape = f'obs_{i}', self.obs_dims[i]
+        if self.replay_buffer is not None:
+            codec = self.replay_buffer.get_storage_codec(key, shape)
+        else:
+            codec = get_key_storage_codec(key, shape, self.storage_codecs, self.uint8_images)
+
+        return codec.decoded_dtype == np.uint8
+
+    def _get_obs_signature(self, *batch_shape):
+        """
+        tf.TensorSpec of observations, uint8 for observations sampled as uint8
+        """
+        return [tf.TensorSpec(shape=(*batch_shape, *t),
+                              dtype=tf.uint8 if self._is_uint8_obs(i) else tf.float32)
+                for i, t in enumerate(self.obs_dims)]
+
+    def _encode_images(self, fn):
+        """
+        Convert float [0, 1] observations sampled as uint8 to uint8 [0, 255]
+        the same way as the replay buffer stores them, before calling `fn`
+        """
+        uint8_obs = [self._is_uint8_obs(i) for i in range(len(self.obs_dims))]
+        if not any(uint8_obs):
+            return fn
+
+        def encode(arg):
+            if not isinstance(arg, list):
+                return arg
+
+            return [(o * 255).astype(np.uint8)
+                    if is_uint8 and isinstance(o, np.ndarray) and o.dtype != np.uint8 else o
+                    for o, is_uint8 in zip(arg, uint8_obs)]
+
+        def c(*args, **kwargs):
+            return fn(*[encode(a) for a in args],
+                      **{k: encode(v) for k, v in kwargs.items()})
+
+        return c
 
     def get_initial_rnn_state(self, batch_size):
         assert self.use_rnn
@@ -456,15 +742,33 @@ class SAC_Base(object):
         """
         target_variables, eval_variables = [], []
 
-        for i in range(self.ensemble_q_num):
-            target_variables += self.model_target_q_list[i].trainable_variables
-            eval_variables += self.model_q_list[i].trainable_variables
+        if self.vectorized_q:
+            target_variables += self.model_target_q.trainable_variables
+            eval_variables += self.model_q.trainable_variables
+        else:
+            for i in range(self.ensemble_q_num):
+                target_variables += self.model_target_q_list[i].trainable_variables
+                eval_variables += self.model_q_list[i].trainable_variables
 
         target_variables += self.model_target_rep.trainable_variables
         eval_variables += self.model_rep.trainable_variables
 
         [t.assign(tau * e + (1. - tau) * t) for t, e in zip(target_variables, eval_variables)]
 
+    def _get_q_list(self, state, c_action, target=False):
+        """
+        Return d_q_list ([Batch, ..., d_action_dim], ...) and c_q_list ([Batch, ..., 1], ...) of all Qs
+        Lists are stacked tensors [ensemble_q_num, Batch, ...] if `vectorized_q`
+        """
+        if self.vectorized_q:
+            model_q = self.model_target_q if target else self.model_q
+            return model_q(state, c_action)
+
+        model_q_list = self.model_target_q_list if target else self.model_q_list
+        q_list = [q(state, c_action) for q in model_q_list]
+
+        return [q[0] for q in q_list], [q[1] for q in q_list]
+
     @tf.function
     def _udpate_normalizer(self, obs_list):
         self.normalizer_step.assign(self.normalizer_step + tf.shape(obs_list[0])[0])
@@ -494,6 +798,12 @@ class SAC_Base(object):
         else:
             n_states = self.model_rep(n_obses_list)
 
+        return self._get_n_probs(n_states, n_selected_actions)
+
+    def _get_n_probs(self, n_states, n_selected_actions):
+        """
+        Return the probabilities [Batch, n] of n_selected_actions under the current policy
+        """
         d_policy, c_policy = self.model_policy(n_states)
 
         policy_prob = tf.ones((tf.shape(n_states)[:2]))  # [Batch, n]
@@ -586,20 +896,25 @@ class SAC_Base(object):
         return y
 
     @tf.function
-    def _get_y(self, n_states, n_actions, n_rewards, state_, n_dones,
+    def _get_y(self, m_states, n_actions, n_rewards, n_dones,
                n_mu_probs=None):
         """
         tf.function
         Get target value
+        m_states: [Batch, n + 1, state_dim], the states and the next states overlap in n - 1 steps,
+            so the policy is evaluated once over all n + 1 states
+            Continuous actions are sampled independently for the states and the next states,
+            so the target Qs are evaluated once over the 2n (state, action) pairs of both views,
+            or once over the n + 1 states if there are no continuous actions
         """
 
         alpha_d = tf.exp(self.log_alpha_d)
         alpha_c = tf.exp(self.log_alpha_c)
 
-        next_n_states = tf.concat([n_states[:, 1:, ...], tf.reshape(state_, (-1, 1, state_.shape[-1]))], axis=1)
+        n_states = m_states[:, :-1, ...]
+        next_n_states = m_states[:, 1:, ...]
 
-        d_policy, c_policy = self.model_policy(n_states)
-        next_d_policy, next_c_policy = self.model_policy(next_n_states)
+        m_d_policy, m_c_policy = self.model_policy(m_states)
 
         if self.use_curiosity:
             approx_next_n_states = self.model_forward(n_states, n_actions)
@@ -607,22 +922,41 @@ class SAC_Base(object):
             in_n_rewards = in_n_rewards * self.curiosity_strength
             n_rewards += in_n_rewards
 
+        n = self.n_step
+
         if self.c_action_dim:
-            n_c_actions_sampled = c_policy.sample()  # [Batch, n, action_dim]
-            next_n_c_actions_sampled = next_c_policy.sample()
+            # Two independent samples from the same distributions, one for each view
+            m_c_actions_sampled_2 = m_c_policy.sample(2)  # [2, Batch, n + 1, action_dim]
+            n_c_actions_sampled = m_c_actions_sampled_2[0, :, :-1, ...]  # [Batch, n, action_dim]
+            next_n_c_actions_sampled = m_c_actions_sampled_2[1, :, 1:, ...]  # [Batch, n, action_dim]
+
+            # ([Batch, 2n, action_dim], ...), ([Batch, 2n, 1], ...)
+            m_d_q_list, m_c_q_list = self._get_q_list(tf.concat([n_states, next_n_states], axis=1),
+                                                      tf.tanh(tf.concat([n_c_actions_sampled,
+                                                                         next_n_c_actions_sampled], axis=1)),
+                                                      target=True)
+
+            def split_n_next(m_q_list):
+                # ([Batch, 2n, ...], ...) -> ([Batch, n, ...], ...), ([Batch, n, ...], ...)
+                if self.vectorized_q:
+                    return m_q_list[:, :, :n, ...], m_q_list[:, :, n:, ...]
+                return [q[:, :n, ...] for q in m_q_list], [q[:, n:, ...] for q in m_q_list]
         else:
-            n_c_actions_sampled = tf.zeros((0,))
             next_n_c_actions_sampled = tf.zeros((0,))
 
-        # ([Batch, n, action_dim], [Batch, n, 1])
-        q_list = [q(n_states, tf.tanh(n_c_actions_sampled)) for q in self.model_target_q_list]
-        next_q_list = [q(next_n_states, tf.tanh(next_n_c_actions_sampled)) for q in self.model_target_q_list]
+            # ([Batch, n + 1, action_dim], ...), ([Batch, n + 1, 1], ...)
+            m_d_q_list, m_c_q_list = self._get_q_list(m_states, tf.zeros((0,)), target=True)
 
-        d_q_list = [q[0] for q in q_list]  # [Batch, n, action_dim]
-        c_q_list = [q[1] for q in q_list]  # [Batch, n, 1]
+            def split_n_next(m_q_list):
+                # ([Batch, n + 1, ...], ...) -> ([Batch, n, ...], ...), ([Batch, n, ...], ...)
+                if self.vectorized_q:
+                    return m_q_list[:, :, :-1, ...], m_q_list[:, :, 1:, ...]
+                return [q[:, :-1, ...] for q in m_q_list], [q[:, 1:, ...] for q in m_q_list]
 
-        next_d_q_list = [q[0] for q in next_q_list]  # [Batch, n, action_dim]
-        next_c_q_list = [q[1] for q in next_q_list]  # [Batch, n, 1]
+        if self.d_action_dim:
+            d_q_list, next_d_q_list = split_n_next(m_d_q_list)
+        if self.c_action_dim:
+            c_q_list, next_c_q_list = split_n_next(m_c_q_list)
 
         d_y, c_y = tf.zeros((0,)), tf.zeros((0,))
 
@@ -632,7 +966,7 @@ class SAC_Base(object):
             # [ensemble_q_num, Batch, n, d_action_dim] -> [ensemble_q_sample, Batch, n, d_action_dim]
 
             if self.discrete_dqn_like:
-                next_d_eval_q_list = [q(next_n_states, tf.tanh(next_n_c_actions_sampled))[0] for q in self.model_q_list]
+                next_d_eval_q_list, _ = self._get_q_list(next_n_states, tf.tanh(next_n_c_actions_sampled))
                 stacked_next_d_eval_q = tf.gather(next_d_eval_q_list,
                                                   tf.random.shuffle(tf.range(self.ensemble_q_num))[:self.ensemble_q_sample])
                 # [ensemble_q_num, Batch, n, d_action_dim] -> [ensemble_q_sample, Batch, n, d_action_dim]
@@ -648,8 +982,9 @@ class SAC_Base(object):
                 min_q = tf.reduce_min(stacked_d_q, axis=0)  # [Batch, n, d_action_dim]
                 min_next_q = tf.reduce_min(stacked_next_d_q, axis=0)  # [Batch, n, d_action_dim]
 
-                probs = tf.nn.softmax(d_policy.logits)  # [Batch, n, action_dim]
-                next_probs = tf.nn.softmax(next_d_policy.logits)  # [Batch, n, action_dim]
+                m_probs = tf.nn.softmax(m_d_policy.logits)  # [Batch, n + 1, action_dim]
+                probs = m_probs[:, :-1, ...]  # [Batch, n, action_dim]
+                next_probs = m_probs[:, 1:, ...]  # [Batch, n, action_dim]
                 clipped_probs = tf.maximum(probs, 1e-8)
                 clipped_next_probs = tf.maximum(next_probs, 1e-8)
                 tmp_v = min_q - alpha_d * tf.math.log(clipped_probs)  # [Batch, n, action_dim]
@@ -660,7 +995,7 @@ class SAC_Base(object):
 
                 if self.use_n_step_is:
                     n_d_actions = n_actions[..., :self.d_action_dim]
-                    n_pi_probs = d_policy.prob(tf.argmax(n_d_actions, axis=-1))  # [Batch, n]
+                    n_pi_probs = tf.gather(probs, tf.argmax(n_d_actions, axis=-1), batch_dims=2)  # [Batch, n]
 
                 d_y = self._v_trace(n_rewards, n_dones,
                                     n_mu_probs,
@@ -668,8 +1003,11 @@ class SAC_Base(object):
                                     v, next_v)
 
         if self.c_action_dim:
-            n_actions_log_prob = tf.reduce_sum(squash_correction_log_prob(c_policy, n_c_actions_sampled), axis=-1)  # [Batch, n]
-            next_n_actions_log_prob = tf.reduce_sum(squash_correction_log_prob(next_c_policy, next_n_c_actions_sampled), axis=-1)
+            # [2, Batch, n + 1]
+            m_actions_log_prob_2 = tf.reduce_sum(squash_correction_log_prob(m_c_policy, m_c_actions_sampled_2),
+                                                 axis=-1)
+            n_actions_log_prob = m_actions_log_prob_2[0, :, :-1]  # [Batch, n]
+            next_n_actions_log_prob = m_actions_log_prob_2[1, :, 1:]  # [Batch, n]
 
             stacked_c_q = tf.gather(c_q_list,
                                     tf.random.shuffle(tf.range(self.ensemble_q_num))[:self.ensemble_q_sample])
@@ -689,7 +1027,9 @@ class SAC_Base(object):
 
             if self.use_n_step_is:
                 n_c_actions = n_actions[..., self.d_action_dim:]
-                n_pi_probs = squash_correction_prob(c_policy, tf.atanh(n_c_actions))
+                # The policy of the first n states
+                n_c_policy = tfp.distributions.Normal(m_c_policy.loc[:, :-1, ...], m_c_policy.scale[:, :-1, ...])
+                n_pi_probs = squash_correction_prob(n_c_policy, tf.atanh(n_c_actions))
                 # [Batch, n, action_dim]
                 n_pi_probs = tf.reduce_prod(n_pi_probs, axis=-1)  # [Batch, n]
 
@@ -706,22 +1046,39 @@ class SAC_Base(object):
                initial_rnn_state=None):
         """
         tf.function
+        Return the scalar summaries [len(self._summary_tags)]
         """
         if self.global_step % self.update_target_per_step == 0:
             self._update_target_variables(tau=self.tau)
 
-        with tf.GradientTape(persistent=True) as tape:
+        # Each non-persistent tape computes the gradients of its own losses in one backward pass:
+        # `tape` for Qs, rep, alpha, forward and RND, whose losses only reach their own variables,
+        # `policy_tape` for the policy, whose loss would reach Qs through the sampled action,
+        # and `pred_tapes` for each prediction loss, whose rep gradients are gated separately.
+        # `pred_tapes` only record rep and their own prediction model
+        tape = tf.GradientTape()
+        policy_tape = tf.GradientTape()
+        pred_tapes = [tf.GradientTape() for _ in range(3)] if self.use_prediction else []
+
+        with tape:
             m_obses_list = [tf.concat([n_obses, tf.reshape(next_obs, (-1, 1, *next_obs.shape[1:]))], axis=1)
                             for n_obses, next_obs in zip(n_obses_list, next_obs_list)]
+            with ExitStack() as stack:
+                for pred_tape in pred_tapes:
+                    stack.enter_context(pred_tape)
+
+                if self.use_rnn:
+                    m_states, _ = self.model_rep(m_obses_list,
+                                                 gen_pre_n_actions(n_actions, keep_last_action=True),
+                                                 initial_rnn_state)
+                else:
+                    m_states = self.model_rep(m_obses_list)
+
             if self.use_rnn:
-                m_states, _ = self.model_rep(m_obses_list,
-                                             gen_pre_n_actions(n_actions, keep_last_action=True),
-                                             initial_rnn_state)
                 m_target_states, _ = self.model_target_rep(m_obses_list,
                                                            gen_pre_n_actions(n_actions, keep_last_action=True),
                                                            initial_rnn_state)
             else:
-                m_states = self.model_rep(m_obses_list)
                 m_target_states = self.model_target_rep(m_obses_list)
 
             n_states = m_states[:, :-1, ...]
@@ -731,23 +1088,18 @@ class SAC_Base(object):
             d_action = action[..., :self.d_action_dim]
             c_action = action[..., self.d_action_dim:]
 
-            q_list = [q(state, c_action) for q in self.model_q_list]
-            # ([Batch, action_dim], [Batch, 1])
-            d_q_list = [q[0] for q in q_list]  # [Batch, action_dim]
-            c_q_list = [q[1] for q in q_list]  # [Batch, 1]
+            d_q_list, c_q_list = self._get_q_list(state, c_action)
+            # ([Batch, action_dim], ...), ([Batch, 1], ...)
 
-            d_y, c_y = self._get_y(m_target_states[:, self.burn_in_step:-1, ...],
+            d_y, c_y = self._get_y(m_target_states[:, self.burn_in_step:, ...],
                                    n_actions[:, self.burn_in_step:, ...],
                                    n_rewards[:, self.burn_in_step:],
-                                   m_target_states[:, -1, ...],
                                    n_dones[:, self.burn_in_step:],
                                    n_mu_probs[:, self.burn_in_step:] if self.use_n_step_is else None)
 
             d_y, c_y = tf.stop_gradient(d_y), tf.stop_gradient(c_y)
             #  [Batch, 1], [Batch, 1]
 
-            d_policy, c_policy = self.model_policy(state)
-
             ##### Q LOSS #####
 
             loss_q_list = [tf.zeros((tf.shape(state)[0], 1)) for _ in range(self.ensemble_q_num)]
@@ -759,7 +1111,7 @@ class SAC_Base(object):
 
             if self.c_action_dim:
                 if self.clip_epsilon > 0:
-                    target_c_q_list = [q(state, c_action)[1] for q in self.model_target_q_list]
+                    _, target_c_q_list = self._get_q_list(state, c_action, target=True)
 
                     clipped_q_list = [target_c_q_list[i] + tf.clip_by_value(
                         c_q_list[i] - target_c_q_list[i],
@@ -768,7 +1120,7 @@ class SAC_Base(object):
                     ) for i in range(self.ensemble_q_num)]
 
                     loss_q_a_list = [tf.square(clipped_q - c_y) for clipped_q in clipped_q_list]
-                    loss_q_b_list = [tf.square(q - c_y) for q in c_q_list]
+                    loss_q_b_list = [tf.square(c_q_list[i] - c_y) for i in range(self.ensemble_q_num)]
 
                     for i in range(self.ensemble_q_num):
                         loss_q_list[i] += tf.maximum(loss_q_a_list[i], loss_q_b_list[i])
@@ -784,105 +1136,154 @@ class SAC_Base(object):
             loss_rep_q = sum(loss_q_list)
 
             loss_mse = tf.keras.losses.MeanSquaredError()
-            if self.use_prediction:
-                if self.use_extra_data:
-                    extra_obs = self.model_transition.extra_obs(n_obses_list)[:, self.burn_in_step:, ...]
-                    extra_state = tf.concat([n_states[:, self.burn_in_step:, ...], extra_obs], axis=-1)
-                    approx_next_state_dist = self.model_transition(extra_state,
-                                                                   n_actions[:, self.burn_in_step:, ...])
-                else:
-                    approx_next_state_dist = self.model_transition(n_states[:, self.burn_in_step:, ...],
-                                                                   n_actions[:, self.burn_in_step:, ...])
-                loss_transition = -approx_next_state_dist.log_prob(m_target_states[:, self.burn_in_step + 1:, ...])
-                # loss_transition = -tf.maximum(loss_transition, -2.)
-                std_normal = tfp.distributions.Normal(tf.zeros_like(approx_next_state_dist.loc),
-                                                      tf.ones_like(approx_next_state_dist.scale))
-                loss_transition += self.transition_kl * tfp.distributions.kl_divergence(approx_next_state_dist, std_normal)
-                loss_transition = tf.reduce_mean(loss_transition)
-
-                approx_n_rewards = self.model_reward(m_states[:, self.burn_in_step + 1:, ...])
-                loss_reward = 0.5 * loss_mse(approx_n_rewards, tf.expand_dims(n_rewards[:, self.burn_in_step:], 2))
-
-                loss_obs = 0.5 * self.model_observation.get_loss(m_states[:, self.burn_in_step:, ...],
-                                                                 [m_obses[:, self.burn_in_step:, ...] for m_obses in m_obses_list])
-
-                loss_prediction = loss_transition + loss_reward + loss_obs
 
+            # The gradients of forward and RND are not applied to rep
             if self.use_curiosity:
-                approx_next_n_states = self.model_forward(n_states[:, self.burn_in_step:, ...],
+                approx_next_n_states = self.model_forward(tf.stop_gradient(n_states[:, self.burn_in_step:, ...]),
                                                           n_actions[:, self.burn_in_step:, ...])
-                next_n_states = m_states[:, self.burn_in_step + 1:, ...]
+                next_n_states = tf.stop_gradient(m_states[:, self.burn_in_step + 1:, ...])
                 loss_forward = loss_mse(approx_next_n_states, next_n_states)
 
             if self.use_rnd:
-                approx_f = self.model_rnd(n_states[:, self.burn_in_step:, ...],
+                rnd_n_states = tf.stop_gradient(n_states[:, self.burn_in_step:, ...])
+                approx_f = self.model_rnd(rnd_n_states,
                                           n_actions[:, self.burn_in_step:, ...])
-                f = self.model_target_rnd(n_states[:, self.burn_in_step:, ...],
+                f = self.model_target_rnd(rnd_n_states,
                                           n_actions[:, self.burn_in_step:, ...])
                 loss_rnd = tf.reduce_mean(tf.math.squared_difference(f, approx_f))
 
             ##### ALPHA LOSS & POLICY LOSS #####
 
-            loss_d_policy = tf.zeros((tf.shape(state)[0], 1))
-            loss_c_policy = tf.zeros((tf.shape(state)[0], 1))
-
-            loss_d_alpha = tf.zeros((tf.shape(state)[0], 1))
-            loss_c_alpha = tf.zeros((tf.shape(state)[0], 1))
+            # The policy is only recorded by `policy_tape`, which only differentiates the policy variables,
+            # so the policy loss reaches neither rep nor Qs
+            policy_state = tf.stop_gradient(state)
 
             alpha_d = tf.exp(self.log_alpha_d)
             alpha_c = tf.exp(self.log_alpha_c)
 
-            if self.d_action_dim and not self.discrete_dqn_like:
-                probs = tf.nn.softmax(d_policy.logits)   # [Batch, action_dim]
-                clipped_probs = tf.maximum(probs, 1e-8)
+            with tape.stop_recording(), policy_tape:
+                d_policy, c_policy = self.model_policy(policy_state)
 
-                stacked_d_q = tf.gather(d_q_list,
-                                        tf.random.shuffle(tf.range(self.ensemble_q_num))[:self.ensemble_q_sample])
-                # [ensemble_q_num, Batch, d_action_dim] -> [ensemble_q_sample, Batch, d_action_dim]
-                min_d_q = tf.reduce_min(stacked_d_q, axis=0)
-                # [ensemble_q_sample, Batch, d_action_dim] -> [Batch, d_action_dim]
+                loss_d_policy = tf.zeros((tf.shape(state)[0], 1))
+                loss_c_policy = tf.zeros((tf.shape(state)[0], 1))
 
-                _loss_policy = alpha_d * tf.math.log(clipped_probs) - min_d_q  # [Batch, d_action_dim]
-                loss_d_policy = tf.reduce_sum(probs * _loss_policy, axis=1, keepdims=True)  # [Batch, 1]
+                if self.d_action_dim and not self.discrete_dqn_like:
+                    probs = tf.nn.softmax(d_policy.logits)   # [Batch, action_dim]
+                    clipped_probs = tf.maximum(probs, 1e-8)
 
-                _loss_alpha = -alpha_d * (tf.math.log(clipped_probs) - self.d_action_dim)  # [Batch, action_dim]
-                loss_d_alpha = tf.reduce_sum(probs * _loss_alpha, axis=1, keepdims=True)  # [Batch, 1]
+                    stacked_d_q = tf.gather(d_q_list,
+                                            tf.random.shuffle(tf.range(self.ensemble_q_num))[:self.ensemble_q_sample])
+                    # [ensemble_q_num, Batch, d_action_dim] -> [ensemble_q_sample, Batch, d_action_dim]
+                    min_d_q = tf.reduce_min(stacked_d_q, axis=0)
+                    # [ensemble_q_sample, Batch, d_action_dim] -> [Batch, d_action_dim]
 
-            if self.c_action_dim:
-                action_sampled = c_policy.sample()
-                c_q_for_gradient_list = [q(state, tf.tanh(action_sampled))[1] for q in self.model_q_list]
-                # [[Batch, 1], ...]
+                    _loss_policy = tf.stop_gradient(alpha_d) * tf.math.log(clipped_probs) - min_d_q  # [Batch, d_action_dim]
+                    loss_d_policy = tf.reduce_sum(probs * _loss_policy, axis=1, keepdims=True)  # [Batch, 1]
+
+                if self.c_action_dim:
+                    action_sampled = c_policy.sample()
+                    _, c_q_for_gradient_list = self._get_q_list(policy_state, tf.tanh(action_sampled))
+                    # [[Batch, 1], ...]
+
+                    stacked_c_q = tf.gather(c_q_for_gradient_list,
+                                            tf.random.shuffle(tf.range(self.ensemble_q_num))[:self.ensemble_q_sample])
+                    min_c_q_for_gradient = tf.reduce_min(stacked_c_q, axis=0)
+                    # [ensemble_q_num, Batch, 1] -> [ensemble_q_sample, Batch, 1] -> [Batch, 1]
 
-                stacked_c_q_for_gradient = tf.gather(c_q_for_gradient_list,
-                                                     tf.random.shuffle(tf.range(self.ensemble_q_num))[:self.ensemble_q_sample])
-                # [ensemble_q_num, Batch, 1] -> [ensemble_q_sample, Batch, 1]
+                    log_prob = tf.reduce_sum(squash_correction_log_prob(c_policy, action_sampled), axis=1, keepdims=True)
+                    # [Batch, 1]
 
-                log_prob = tf.reduce_sum(squash_correction_log_prob(c_policy, action_sampled), axis=1, keepdims=True)
-                # [Batch, 1]
+                    loss_c_policy = tf.stop_gradient(alpha_c) * log_prob - min_c_q_for_gradient  # [Batch, 1]
 
-                min_c_q_for_gradient = tf.reduce_min(stacked_c_q_for_gradient, axis=0)
-                # [ensemble_q_sample, Batch, 1] -> [Batch, 1]
+                loss_policy = tf.reduce_mean(loss_d_policy + loss_c_policy)
+
+            # The alpha losses are recorded by `tape`, the policy outputs are constants to it
+            loss_d_alpha = tf.zeros((tf.shape(state)[0], 1))
+            loss_c_alpha = tf.zeros((tf.shape(state)[0], 1))
 
-                loss_c_policy = alpha_c * log_prob - min_c_q_for_gradient
-                # [Batch, 1]
+            if self.d_action_dim and not self.discrete_dqn_like:
+                _loss_alpha = -alpha_d * tf.stop_gradient(tf.math.log(clipped_probs) - self.d_action_dim)  # [Batch, action_dim]
+                loss_d_alpha = tf.reduce_sum(tf.stop_gradient(probs) * _loss_alpha, axis=1, keepdims=True)  # [Batch, 1]
 
-                loss_c_alpha = -alpha_c * (log_prob - self.c_action_dim)  # [Batch, 1]
+            if self.c_action_dim:
+                loss_c_alpha = -alpha_c * tf.stop_gradient(log_prob - self.c_action_dim)  # [Batch, 1]
 
-            loss_policy = tf.reduce_mean(loss_d_policy + loss_c_policy)
             loss_alpha = tf.reduce_mean(loss_d_alpha + loss_c_alpha)
 
-        # Compute gradients and optimize loss
-        for i in range(self.ensemble_q_num):
-            grads_q = tape.gradient(loss_q_list[i], self.model_q_list[i].trainable_variables)
-            self.optimizer_q_list[i].apply_gradients(zip(grads_q, self.model_q_list[i].trainable_variables))
+        if self.use_prediction:
+            # Each prediction loss is only recorded by its own tape, as their rep gradients are gated separately.
+            # m_states is sliced again under each tape, as slicing before only recorded by `tape` would disconnect rep
+            with pred_tapes[0]:
+                pred_n_states = m_states[:, self.burn_in_step:-1, ...]
+                if self.use_extra_data:
+                    extra_obs = self.model_transition.extra_obs(decode_images(n_obses_list))[:, self.burn_in_step:, ...]
+                    extra_state = tf.concat([pred_n_states, extra_obs], axis=-1)
+                    approx_next_state_dist = self.model_transition(extra_state,
+                                                                   n_actions[:, self.burn_in_step:, ...])
+                else:
+                    approx_next_state_dist = self.model_transition(pred_n_states,
+                                                                   n_actions[:, self.burn_in_step:, ...])
+                loss_transition = -approx_next_state_dist.log_prob(m_target_states[:, self.burn_in_step + 1:, ...])
+                # loss_transition = -tf.maximum(loss_transition, -2.)
+                std_normal = tfp.distributions.Normal(tf.zeros_like(approx_next_state_dist.loc),
+                                                      tf.ones_like(approx_next_state_dist.scale))
+                loss_transition += self.transition_kl * tfp.distributions.kl_divergence(approx_next_state_dist, std_normal)
+                loss_transition = tf.reduce_mean(loss_transition)
+
+            with pred_tapes[1]:
+                approx_n_rewards = self.model_reward(m_states[:, self.burn_in_step + 1:, ...])
+                loss_reward = 0.5 * loss_mse(approx_n_rewards, tf.expand_dims(n_rewards[:, self.burn_in_step:], 2))
 
+            with pred_tapes[2]:
+                loss_obs = 0.5 * self.model_observation.get_loss(m_states[:, self.burn_in_step:, ...],
+                                                                 [m_obses[:, self.burn_in_step:, ...]
+                                                                  for m_obses in decode_images(m_obses_list)])
+
+        # Compute gradients and optimize loss
+        # The combined backward pass of Q, rep, alpha, forward and RND losses.
+        # Qs are independent, so the gradient of the sum of Q losses is the gradient of each Q
+        q_variables = self.model_q.trainable_variables if self.vectorized_q \
+            else [q.trainable_variables for q in self.model_q_list]
         rep_variables = self.model_rep.trainable_variables
-        grads_rep = tape.gradient(loss_rep_q, rep_variables)
+        policy_variables = self.model_policy.trainable_variables
+        alpha_variables = [self.log_alpha_d, self.log_alpha_c]
+        targets = [loss_rep_q, loss_alpha]
+        sources = {'q': q_variables, 'rep': rep_variables, 'alpha': alpha_variables}
+        if self.use_curiosity:
+            targets.append(loss_forward)
+            sources['forward'] = self.model_forward.trainable_variables
+        if self.use_rnd:
+            targets.append(loss_rnd)
+            sources['rnd'] = self.model_rnd.trainable_variables
+
+        grads = tape.gradient(targets, sources)
+
+        if (self.d_action_dim and not self.discrete_dqn_like) or self.c_action_dim:
+            grads_policy = policy_tape.gradient(loss_policy, policy_variables)
+
+        if self.vectorized_q:
+            self.optimizer_q.apply_gradients(zip(grads['q'], q_variables))
+        else:
+            for i in range(self.ensemble_q_num):
+                self.optimizer_q_list[i].apply_gradients(zip(grads['q'][i], q_variables[i]))
+
+        grads_rep = grads['rep']
 
         if self.use_prediction:
-            grads_rep_preds = [tape.gradient(loss_transition, rep_variables),
-                               tape.gradient(loss_reward, rep_variables),
-                               tape.gradient(loss_obs, rep_variables)]
+            # The gating pass, the gradients of each prediction loss to rep and to its own prediction model.
+            # `jacobian` over the stacked losses would be one call, but vectorizing
+            # the backward pass of the RNN rep made training steps about 25% slower
+            prediction_variables = self.model_transition.trainable_variables + \
+                self.model_reward.trainable_variables + \
+                self.model_observation.trainable_variables
+            grads_rep_preds = []
+            grads_prediction = []
+            for pred_tape, loss, model in zip(pred_tapes,
+                                              [loss_transition, loss_reward, loss_obs],
+                                              [self.model_transition, self.model_reward, self.model_observation]):
+                grads_rep_pred, grads_model = pred_tape.gradient(loss, [rep_variables, model.trainable_variables])
+                grads_rep_preds.append(grads_rep_pred)
+                grads_prediction += grads_model
 
             # for i in range(len(grads_rep)):
             #     grad_rep = grads_rep[i]
@@ -907,53 +1308,43 @@ class SAC_Base(object):
         self.optimizer_rep.apply_gradients(zip(grads_rep, rep_variables))
 
         if self.use_prediction:
-            prediction_variables = self.model_transition.trainable_variables
-            prediction_variables += self.model_reward.trainable_variables
-            prediction_variables += self.model_observation.trainable_variables
-            grads_prediction = tape.gradient(loss_prediction, prediction_variables)
             self.optimizer_prediction.apply_gradients(zip(grads_prediction, prediction_variables))
 
         if self.use_curiosity:
-            grads_forward = tape.gradient(loss_forward, self.model_forward.trainable_variables)
-            self.optimizer_forward.apply_gradients(zip(grads_forward, self.model_forward.trainable_variables))
+            self.optimizer_forward.apply_gradients(zip(grads['forward'], self.model_forward.trainable_variables))
 
         if self.use_rnd:
-            grads_rnd = tape.gradient(loss_rnd, self.model_rnd.trainable_variables)
-            self.optimizer_rnd.apply_gradients(zip(grads_rnd, self.model_rnd.trainable_variables))
+            self.optimizer_rnd.apply_gradients(zip(grads['rnd'], self.model_rnd.trainable_variables))
 
         if (self.d_action_dim and not self.discrete_dqn_like) or self.c_action_dim:
-            grads_policy = tape.gradient(loss_policy, self.model_policy.trainable_variables)
-            self.optimizer_policy.apply_gradients(zip(grads_policy, self.model_policy.trainable_variables))
+            self.optimizer_policy.apply_gradients(zip(grads_policy, policy_variables))
+            if self.use_auto_alpha:
+                self.optimizer_alpha.apply_gradients(zip(grads['alpha'], alpha_variables))
 
-        if self.use_auto_alpha and ((self.d_action_dim and not self.discrete_dqn_like) or self.c_action_dim):
-            grads_alpha = tape.gradient(loss_alpha, [self.log_alpha_d, self.log_alpha_c])
-            self.optimizer_alpha.apply_gradients(zip(grads_alpha, [self.log_alpha_d, self.log_alpha_c]))
-
-        del tape
-
-        if self.summary_writer is not None and self.global_step % self.write_summary_per_step == 0:
-            with self.summary_writer.as_default():
-                tf.summary.scalar('loss/q', tf.reduce_mean(loss_q_list), step=self.global_step)
-                if self.d_action_dim:
-                    tf.summary.scalar('loss/d_entropy', tf.reduce_mean(d_policy.entropy()), step=self.global_step)
-                    tf.summary.scalar('loss/alpha_d', alpha_d, step=self.global_step)
-                if self.c_action_dim:
-                    tf.summary.scalar('loss/c_entropy', tf.reduce_mean(c_policy.entropy()), step=self.global_step)
-                    tf.summary.scalar('loss/alpha_c', alpha_c, step=self.global_step)
+        # Scalar summaries are returned and written by AsyncSummaryWriter out of the graph
+        summaries = {
+            'loss/q': tf.reduce_mean(loss_q_list)
+        }
+        if self.d_action_dim:
+            summaries['loss/d_entropy'] = tf.reduce_mean(d_policy.entropy())
+            summaries['loss/alpha_d'] = alpha_d
+        if self.c_action_dim:
+            summaries['loss/c_entropy'] = tf.reduce_mean(c_policy.entropy())
+            summaries['loss/alpha_c'] = alpha_c
 
-                if self.use_curiosity:
-                    tf.summary.scalar('loss/forward', loss_forward, step=self.global_step)
+        if self.use_curiosity:
+            summaries['loss/forward'] = loss_forward
 
-                if self.use_rnd:
-                    tf.summary.scalar('loss/rnd', loss_rnd, step=self.global_step)
+        if self.use_rnd:
+            summaries['loss/rnd'] = loss_rnd
 
-                if self.use_prediction:
-                    tf.summary.scalar('loss/transition',
-                                      tf.reduce_mean(approx_next_state_dist.entropy()),
-                                      step=self.global_step)
-                    tf.summary.scalar('loss/reward', loss_reward, step=self.global_step)
-                    tf.summary.scalar('loss/observation', loss_obs, step=self.global_step)
+        if self.use_prediction:
+            summaries['loss/transition'] = tf.reduce_mean(approx_next_state_dist.entropy())
+            summaries['loss/reward'] = loss_reward
+            summaries['loss/observation'] = loss_obs
 
+            if self.summary_writer is not None and self.global_step % self.write_summary_per_step == 0:
+                with self.summary_writer.as_default():
                     approx_obs_list = self.model_observation(m_states[0:1, self.burn_in_step:, ...])
                     if not isinstance(approx_obs_list, (list, tuple)):
                         approx_obs_list = [approx_obs_list]
@@ -963,22 +1354,127 @@ class SAC_Base(object):
                                              tf.reshape(approx_obs, [-1, *approx_obs.shape[2:]]),
                                              max_outputs=self.n_step, step=self.global_step)
 
-            self.summary_writer.flush()
+        # The tags only depend on the config, so they are the same in all traces
+        self._summary_tags = list(summaries.keys())
+
+        return tf.stack([tf.cast(v, tf.float32) for v in summaries.values()])
+
+    @tf.function
+    def _train_and_recompute(self, n_obses_list, n_actions, n_rewards, next_obs_list, n_dones,
+                             n_mu_probs=None, priority_is=None,
+                             initial_rnn_state=None):
+        """
+        tf.function
+        Train one batch, then recompute the td-error, the policy probabilities and the rnn states
+        of the batch with the updated networks in one forward sweep of model_rep and model_target_rep
+
+        Return td_error [Batch, 1], n_pi_probs [Batch, N], n_rnn_states [Batch, N, rnn_state_dim]
+        and the scalar summaries of _train. Unused results are empty tensors
+        """
+        summaries = self._train(n_obses_list=n_obses_list,
+                    n_actions=n_actions,
+                    n_rewards=n_rewards,
+                    next_obs_list=next_obs_list,
+                    n_dones=n_dones,
+                    n_mu_probs=n_mu_probs if self.use_n_step_is else None,
+                    priority_is=priority_is if self.use_priority else None,
+                    initial_rnn_state=initial_rnn_state if self.use_rnn else None)
+
+        m_obses_list = [tf.concat([n_obses, tf.reshape(next_obs, (-1, 1, *next_obs.shape[1:]))], axis=1)
+                        for n_obses, next_obs in zip(n_obses_list, next_obs_list)]
+        n_rnn_states = tf.zeros((0, ))
+        if self.use_rnn:
+            m_pre_actions = gen_pre_n_actions(n_actions, keep_last_action=True)
+            m_states, m_rnn_states = self._get_all_rnn_states(m_obses_list, m_pre_actions, initial_rnn_state)
+            n_rnn_states = m_rnn_states[:, :-1, ...]
+
+            m_target_states, *_ = self.model_target_rep(m_obses_list,
+                                                        m_pre_actions,
+                                                        initial_rnn_state)
+        else:
+            m_states = self.model_rep(m_obses_list)
+            m_target_states = self.model_target_rep(m_obses_list)
+
+        n_pi_probs = tf.zeros((0, ))
+        if self.use_n_step_is:
+            n_pi_probs = self._get_n_probs(m_states[:, :-1, ...], n_actions)
+
+        td_error = tf.zeros((0, ))
+        if self.use_priority:
+            td_error = self._get_td_error(m_states[:, self.burn_in_step, ...], m_target_states,
+                                          n_actions, n_rewards, n_dones,
+                                          n_pi_probs if self.use_n_step_is else None)
+
+        return td_error, n_pi_probs, n_rnn_states, summaries
+
+    @tf.function
+    def _train_n_steps(self, n_obses_list, n_actions, n_rewards, next_obs_list, n_dones,
+                       n_mu_probs=None, priority_is=None,
+                       initial_rnn_state=None):
+        """
+        tf.function
+        Train K stacked batches [K, Batch, ...] in a tf.while_loop,
+        increasing global_step in the graph after each batch
+
+        Return the results of _train_and_recompute of each batch, stacked along the first axis
+        """
+        n_steps = tf.shape(n_actions)[0]
+        td_errors = tf.TensorArray(tf.float32, size=n_steps)
+        n_pi_probs_array = tf.TensorArray(tf.float32, size=n_steps)
+        n_rnn_states_array = tf.TensorArray(tf.float32, size=n_steps)
+        summaries_array = tf.TensorArray(tf.float32, size=n_steps)
+
+        for i in tf.range(n_steps):
+            td_error, n_pi_probs, n_rnn_states, summaries = self._train_and_recompute(
+                n_obses_list=[n_obses[i] for n_obses in n_obses_list],
+                n_actions=n_actions[i],
+                n_rewards=n_rewards[i],
+                next_obs_list=[next_obs[i] for next_obs in next_obs_list],
+                n_dones=n_dones[i],
+                n_mu_probs=n_mu_probs[i] if self.use_n_step_is else None,
+                priority_is=priority_is[i] if self.use_priority else None,
+                initial_rnn_state=initial_rnn_state[i] if self.use_rnn else None)
+
+            td_errors = td_errors.write(i, td_error)
+            n_pi_probs_array = n_pi_probs_array.write(i, n_pi_probs)
+            n_rnn_states_array = n_rnn_states_array.write(i, n_rnn_states)
+            summaries_array = summaries_array.write(i, summaries)
+
+            self.global_step.assign_add(1)
+
+        return td_errors.stack(), n_pi_probs_array.stack(), n_rnn_states_array.stack(), summaries_array.stack()
 
     @tf.function
     def get_n_rnn_states(self, n_obses_list, n_actions, rnn_state):
         """
         tf.function
         """
+        _, n_rnn_states = self._get_all_rnn_states(n_obses_list, gen_pre_n_actions(n_actions), rnn_state)
+
+        return n_rnn_states
+
+    def _get_all_rnn_states(self, n_obses_list, n_pre_actions, rnn_state):
+        """
+        Return the states [Batch, N, state_dim] and the rnn states after each step [Batch, N, rnn_state_dim]
+        of model_rep, in a single sequence call if the model supports `return_all_states`,
+        otherwise stepping model_rep over each timestep
+        """
+        if isinstance(self.model_rep, ModelBaseRNNRep):
+            n_states, _, n_rnn_states = self.model_rep(n_obses_list, n_pre_actions, rnn_state,
+                                                       return_all_states=True)
+            if n_rnn_states is not None:
+                return n_states, n_rnn_states
+
+        n_states = list()
         n_rnn_states = list()
-        n_actions = gen_pre_n_actions(n_actions)
         for i in range(n_obses_list[0].shape[1]):
-            _, rnn_state = self.model_rep([o[:, i:i + 1, ...] for o in n_obses_list],
-                                          n_actions[:, i:i + 1, ...],
-                                          rnn_state)
+            state, rnn_state = self.model_rep([o[:, i:i + 1, ...] for o in n_obses_list],
+                                              n_pre_actions[:, i:i + 1, ...],
+                                              rnn_state)
+            n_states.append(state)
             n_rnn_states.append(rnn_state)
 
-        return tf.stack(n_rnn_states, axis=1)
+        return tf.concat(n_states, axis=1), tf.stack(n_rnn_states, axis=1)
 
     @tf.function
     def rnd_sample(self, state, d_policy, c_policy):
@@ -1015,7 +1511,8 @@ class SAC_Base(object):
                                                          tf.shape(state)[0])[0]
                         d_action = tf.one_hot(d_action, self.d_action_dim)
                     else:
-                        d_q, _ = self.model_q_list[0](state, c_policy.sample() if self.c_action_dim else tf.zeros((0,)))
+                        d_q_list, _ = self._get_q_list(state, c_policy.sample() if self.c_action_dim else tf.zeros((0,)))
+                        d_q = d_q_list[0]
                         d_action = tf.argmax(d_q, axis=-1)
                         d_action = tf.one_hot(d_action, self.d_action_dim)
                 else:
@@ -1136,23 +1633,29 @@ class SAC_Base(object):
             state = self.model_rep([m_obses[:, self.burn_in_step, ...] for m_obses in m_obses_list])
             m_target_states = self.model_target_rep(m_obses_list)
 
+        return self._get_td_error(state, m_target_states,
+                                  n_actions, n_rewards, n_dones, n_mu_probs)
+
+    def _get_td_error(self, state, m_target_states,
+                      n_actions, n_rewards, n_dones, n_mu_probs=None):
+        """
+        state: [Batch, state_dim], the state at the burn-in step
+        m_target_states: [Batch, N + 1, state_dim]
+        """
         action = n_actions[:, self.burn_in_step, ...]
         d_action = action[..., :self.d_action_dim]
         c_action = action[..., self.d_action_dim:]
 
-        # ([Batch, action_dim], [Batch, 1])
-        q_list = [q(state, c_action) for q in self.model_q_list]
-        d_q_list = [q[0] for q in q_list]  # [Batch, action_dim]
-        c_q_list = [q[1] for q in q_list]  # [Batch, 1]
+        # ([Batch, action_dim], ...), ([Batch, 1], ...)
+        d_q_list, c_q_list = self._get_q_list(state, c_action)
 
         if self.d_action_dim:
-            d_q_list = [tf.reduce_sum(d_action * q, axis=-1, keepdims=True) for q in d_q_list]
+            d_q_list = [tf.reduce_sum(d_action * d_q_list[i], axis=-1, keepdims=True) for i in range(self.ensemble_q_num)]
             # [Batch, 1]
 
-        d_y, c_y = self._get_y(m_target_states[:, self.burn_in_step:-1, ...],
+        d_y, c_y = self._get_y(m_target_states[:, self.burn_in_step:, ...],
                                n_actions[:, self.burn_in_step:, ...],
                                n_rewards[:, self.burn_in_step:],
-                               m_target_states[:, -1, ...],
                                n_dones[:, self.burn_in_step:],
                                n_mu_probs[:, self.burn_in_step:] if self.use_n_step_is else None)
 
@@ -1177,7 +1680,8 @@ class SAC_Base(object):
                              next_obs_list,
                              n_dones,
                              n_mu_probs=None,
-                             n_rnn_states=None):
+                             n_rnn_states=None,
+                             chunk_size=256):
         """
         n_obses_list: list([1, episode_len, obs_dim_i], ...)
         n_actions: [1, episode_len, action_dim]
@@ -1185,60 +1689,130 @@ class SAC_Base(object):
         next_obs_list: list([1, obs_dim_i], ...)
         n_dones: [1, episode_len]
         n_rnn_states: [1, episode_len, rnn_state_dim]
+        chunk_size: The number of windows computed in one call of get_td_error
 
         Return the td-error of raw episode observations
         """
         ignore_size = self.burn_in_step + self.n_step
-
-        tmp_n_obses_list = [None] * len(n_obses_list)
-        for i, n_obses in enumerate(n_obses_list):
-            tmp_n_obses_list[i] = np.concatenate([n_obses[:, i:i + ignore_size]
-                                                  for i in range(n_obses.shape[1] - ignore_size + 1)], axis=0)
-        n_actions = np.concatenate([n_actions[:, i:i + ignore_size]
-                                    for i in range(n_actions.shape[1] - ignore_size + 1)], axis=0)
-        n_rewards = np.concatenate([n_rewards[:, i:i + ignore_size]
-                                    for i in range(n_rewards.shape[1] - ignore_size + 1)], axis=0)
-        tmp_next_obs_list = [None] * len(next_obs_list)
-        for i, n_obses in enumerate(n_obses_list):
-            tmp_next_obs_list[i] = np.concatenate([n_obses[:, i + ignore_size]
-                                                   for i in range(n_obses.shape[1] - ignore_size)]
-                                                  + [next_obs_list[i]],
-                                                  axis=0)
-        n_dones = np.concatenate([n_dones[:, i:i + ignore_size]
-                                  for i in range(n_dones.shape[1] - ignore_size + 1)], axis=0)
-
+        episode_len = n_actions.shape[1]
+        n_windows = episode_len - ignore_size + 1
+
+        def window(x):
+            # [1, episode_len, ...] -> [n_windows, ignore_size, ...] view without copying
+            return np.moveaxis(sliding_window_view(x[0], ignore_size, axis=0), -1, 1)
+
+        def next_obs_chunk(n_obses, next_obs, start, end):
+            # The next observation of the last window is next_obs
+            if end + ignore_size <= episode_len:
+                return n_obses[0, start + ignore_size:end + ignore_size]
+            return np.concatenate([n_obses[0, start + ignore_size:], next_obs], axis=0)
+
+        win_n_obses_list = [window(n_obses) for n_obses in n_obses_list]
+        win_n_actions = window(n_actions)
+        win_n_rewards = window(n_rewards)
+        win_n_dones = window(n_dones)
         if self.use_n_step_is:
-            n_mu_probs = np.concatenate([n_mu_probs[:, i:i + ignore_size]
-                                         for i in range(n_mu_probs.shape[1] - ignore_size + 1)], axis=0)
-        if self.use_rnn:
-            rnn_state = np.concatenate([n_rnn_states[:, i]
-                                        for i in range(n_rnn_states.shape[1] - ignore_size + 1)], axis=0)
-
-        td_error = self.get_td_error(n_obses_list=tmp_n_obses_list,
-                                     n_actions=n_actions,
-                                     n_rewards=n_rewards,
-                                     next_obs_list=tmp_next_obs_list,
-                                     n_dones=n_dones,
-                                     n_mu_probs=n_mu_probs if self.use_n_step_is else None,
-                                     rnn_state=rnn_state if self.use_rnn else None).numpy()
+            win_n_mu_probs = window(n_mu_probs)
+
+        # Feed the windows in fixed-size chunks, only copying one chunk at a time
+        td_error_list = []
+        for start in range(0, n_windows, chunk_size):
+            end = min(start + chunk_size, n_windows)
+            td_error = self.get_td_error(n_obses_list=[o[start:end] for o in win_n_obses_list],
+                                         n_actions=win_n_actions[start:end],
+                                         n_rewards=win_n_rewards[start:end],
+                                         next_obs_list=[next_obs_chunk(n_obses, next_obs, start, end)
+                                                        for n_obses, next_obs in zip(n_obses_list, next_obs_list)],
+                                         n_dones=win_n_dones[start:end],
+                                         n_mu_probs=win_n_mu_probs[start:end] if self.use_n_step_is else None,
+                                         rnn_state=n_rnn_states[0, start:end] if self.use_rnn else None).numpy()
+            td_error_list.append(td_error)
+
+        td_error = np.concatenate(td_error_list, axis=0)
         td_error = td_error.flatten()
         td_error = np.concatenate([td_error,
                                    np.zeros(ignore_size, dtype=np.float32)])
         return td_error
 
+    # For the acting policy to follow the training policy in asynchronous training
+    # If use @tf.function, the function will return Tensors, not Variables
+    def get_policy_variables(self):
+        variables = self.model_rep.trainable_variables + self.model_policy.trainable_variables
+
+        if self.use_normalization:
+            variables += [self.normalizer_step] +\
+                self.running_means +\
+                self.running_variances
+
+        return variables
+
+    @tf.function
+    def update_policy_variables(self, t_variables):
+        variables = self.get_policy_variables()
+
+        for v, t_v in zip(variables, t_variables):
+            v.assign(tf.cast(t_v, v.dtype))
+
     def write_constant_summaries(self, constant_summaries, iteration):
         """
         Write constant information like reward, iteration from sac_main.py
+        They are written and flushed in the background together with training summaries
+        """
+        self.async_summary_writer.write_scalars({s['tag']: s['simple_value'] for s in constant_summaries},
+                                                int(self.global_step.numpy()))
+
+    def save_model(self, wait=False):
         """
-        with self.summary_writer.as_default():
-            for s in constant_summaries:
-                tf.summary.scalar(s['tag'], s['simple_value'], step=self.global_step)
+        If async_checkpoint, variables are copied into host memory and written in the background.
+        At most one save is in flight, a save is skipped if the previous one is still being written.
+        wait: If wait for the previous save in flight and for the checkpoint to be written
+        """
+        if self.async_checkpoint:
+            self._save_model_async(wait)
+        else:
+            self.ckpt_manager.save(self.global_step)
+            logger.info(f"Model saved at {self.global_step.numpy()}")
 
-        self.summary_writer.flush()
+        if self.train_mode and self.save_replay_buffer:
+            with self._replay_buffer_lock:
+                self.replay_buffer.save(self.replay_buffer_dir)
+            logger.info(f"Replay buffer saved, size: {self.replay_buffer.size}")
 
-    def save_model(self):
-        self.ckpt_manager.save(self.global_step)
-        logger.info(f"Model saved at {self.global_step.numpy()}")
+        if self.train_mode:
+            # Summaries up to the checkpoint are on disk as well
+            self.async_summary_writer.flush()
+
+    def _save_model_async(self, wait):
+        if self._saving_thread is not None and self._saving_thread.is_alive():
+            if wait:
+                self._saving_thread.join()
+            else:
+                self._skipped_saves += 1
+                logger.warning(f'Skipped saving model at {self.global_step.numpy()}, the previous save is in flight, '
+                               f'{self._skipped_saves} skipped')
+                return
+
+        step = self.global_step.numpy()
+        t = time.time()
+        self.ckpt_manager.save(step, options=tf.train.CheckpointOptions(experimental_enable_async_checkpoint=True))
+        snapshot_time = time.time() - t
+
+        def _wait():
+            self.ckpt_manager.checkpoint.sync()
+            logger.info(f'Model saved at {step}, snapshot {snapshot_time:.2f}s, '
+                        f'save {time.time() - t:.2f}s, {self._skipped_saves} skipped')
+
+        self._saving_thread = threading.Thread(target=_wait, daemon=True)
+        self._saving_thread.start()
+        if wait:
+            self._saving_thread.join()
+
+    def close(self):
+        """
+        Write the summaries still buffered and stop the background summary writing
+        """
+        if self.train_mode:
+            self.async_summary_writer.close(int(self.global_step.numpy()))
 
     @tf.function
     def _increase_global_step(self):
@@ -1313,39 +1887,26 @@ class SAC_Base(object):
                                                  n_dones=n_dones,
                                                  n_mu_probs=n_mu_probs if self.use_n_step_is else None,
                                                  n_rnn_states=n_rnn_states if self.use_rnn else None)
-            self.replay_buffer.add_with_td_error(td_error, storage_data,
-                                                 ignore_size=self.burn_in_step + self.n_step)
+            with self._replay_buffer_lock:
+                self.replay_buffer.add_with_td_error(td_error, storage_data,
+                                                     ignore_size=self.burn_in_step + self.n_step)
         else:
-            self.replay_buffer.add(storage_data,
-                                   ignore_size=self.burn_in_step + self.n_step)
-
-    def train(self):
-        # Sample from replay buffer
-        sampled = self.replay_buffer.sample()
-        if sampled is None:
-            return 0
+            with self._replay_buffer_lock:
+                self.replay_buffer.add(storage_data,
+                                       ignore_size=self.burn_in_step + self.n_step)
 
+    def _sample(self):
         """
-        trans:
-            obs_i: [Batch, obs_dim_i]
-            action: [Batch, action_dim]
-            reward: [Batch, ]
-            done: [Batch, ]
-            mu_prob: [Batch, ]
-            rnn_state: [Batch, rnn_state_dim]
+        Sample n_step transitions from replay buffer
+        `train_steps_per_call` batches are concatenated
+        Return None if the replay buffer does not have enough transitions
         """
-        pointers, trans, priority_is = sampled
-
-        # Get n_step transitions TODO: could be faster
-        trans = {k: [v] for k, v in trans.items()}
-        # k: [v, v, ...]
-        for i in range(1, self.burn_in_step + self.n_step + 1):
-            t_trans = self.replay_buffer.get_storage_data(pointers + i).items()
-            for k, v in t_trans:
-                trans[k].append(v)
+        sampled = self.replay_buffer.sample_sequences(self.burn_in_step + self.n_step + 1,
+                                                      self.train_steps_per_call)
+        if sampled is None:
+            return None
 
-        for k, v in trans.items():
-            trans[k] = np.concatenate([np.expand_dims(t, 1) for t in v], axis=1)
+        pointers, trans, priority_is = sampled
 
         """
         m_obses_list: list([Batch, N + 1, obs_dim_i])
@@ -1366,61 +1927,197 @@ class SAC_Base(object):
         next_obs_list = [m_obses[:, -1, ...] for m_obses in m_obses_list]
         n_dones = m_dones[:, :-1]
 
+        n_mu_probs = None
         if self.use_n_step_is:
             m_mu_probs = trans['mu_prob']
             n_mu_probs = m_mu_probs[:, :-1]
 
+        rnn_state = None
         if self.use_rnn:
             m_rnn_states = trans['rnn_state']
             rnn_state = m_rnn_states[:, 0, ...]
 
-        self._train(n_obses_list=n_obses_list,
-                    n_actions=n_actions,
-                    n_rewards=n_rewards,
-                    next_obs_list=next_obs_list,
-                    n_dones=n_dones,
-                    n_mu_probs=n_mu_probs if self.use_n_step_is else None,
-                    priority_is=priority_is if self.use_priority else None,
-                    initial_rnn_state=rnn_state if self.use_rnn else None)
+        return (pointers,
+                n_obses_list,
+                n_actions,
+                n_rewards,
+                next_obs_list,
+                n_dones,
+                n_mu_probs,
+                rnn_state,
+                priority_is)
+
+    def _gen_sampled(self):
+        """
+        The generator of the prefetching pipeline, sampling under the replay buffer lock
+        Optional data that are None are replaced by empty arrays
+        """
+        empty = np.zeros((0, ), dtype=np.float32)
+
+        while True:
+            with self._replay_buffer_lock:
+                (pointers,
+                 n_obses_list,
+                 n_actions,
+                 n_rewards,
+                 next_obs_list,
+                 n_dones,
+                 n_mu_probs,
+                 rnn_state,
+                 priority_is) = self._sample()
+
+            yield (pointers.astype(np.int64),
+                   tuple(n_obses_list),
+                   n_actions,
+                   n_rewards,
+                   tuple(next_obs_list),
+                   n_dones,
+                   empty if n_mu_probs is None else n_mu_probs,
+                   empty if rnn_state is None else rnn_state,
+                   priority_is)
+
+    def _get_prefetched(self):
+        """
+        Get a batch from the tf.data pipeline that samples `prefetch_batches` batches ahead of training
+        The pipeline starts once the replay buffer has enough transitions,
+        so that the generator never waits for transitions that the training thread adds
+        """
+        if self._prefetch_iterator is None:
+            with self._replay_buffer_lock:
+                if not self.replay_buffer.is_lg_batch_size:
+                    return None
+
+            step_size = self.burn_in_step + self.n_step
+            empty_spec = tf.TensorSpec((0, ))
+            output_signature = (
+                tf.TensorSpec((None, ), dtype=tf.int64),
+                tuple(self._get_obs_signature(None, step_size)),
+                tf.TensorSpec((None, step_size, self.action_dim)),
+                tf.TensorSpec((None, step_size)),
+                tuple(self._get_obs_signature(None)),
+                tf.TensorSpec((None, step_size)),
+                tf.TensorSpec((None, step_size)) if self.use_n_step_is else empty_spec,
+                tf.TensorSpec((None, self.rnn_state_dim)) if self.use_rnn else empty_spec,
+                tf.TensorSpec((None, 1))
+            )
+            dataset = tf.data.Dataset.from_generator(self._gen_sampled, output_signature=output_signature)
+            self._prefetch_iterator = iter(dataset.prefetch(self.prefetch_batches))
+
+        (pointers,
+         n_obses_list,
+         n_actions,
+         n_rewards,
+         next_obs_list,
+         n_dones,
+         n_mu_probs,
+         rnn_state,
+         priority_is) = next(self._prefetch_iterator)
+
+        return (pointers.numpy(),
+                list(n_obses_list),
+                n_actions,
+                n_rewards,
+                list(next_obs_list),
+                n_dones,
+                n_mu_probs if self.use_n_step_is else None,
+                rnn_state if self.use_rnn else None,
+                priority_is)
+
+    def _update_td_error(self, pointers, td_error):
+        with self._replay_buffer_lock:
+            # Transitions may be overwritten since they were prefetched
+            # or added by another thread during training
+            mask = self.replay_buffer.is_valid(pointers)
+            if np.any(mask):
+                self.replay_buffer.update(pointers[mask], td_error[mask])
+
+    def _update_transitions(self, pointers, key, data):
+        with self._replay_buffer_lock:
+            mask = self.replay_buffer.is_valid(pointers)
+            if np.any(mask):
+                self.replay_buffer.update_transitions(pointers[mask], key, data[mask])
 
-        step = self.global_step.numpy()
+    def train(self):
+        if self.prefetch_batches > 0:
+            sampled = self._get_prefetched()
+        else:
+            with self._replay_buffer_lock:
+                sampled = self._sample()
+        if sampled is None:
+            return 0
 
-        if step % self.save_model_per_step == 0 \
+        (pointers,
+         n_obses_list,
+         n_actions,
+         n_rewards,
+         next_obs_list,
+         n_dones,
+         n_mu_probs,
+         rnn_state,
+         priority_is) = sampled
+
+        step = self.global_step.numpy()
+        n_steps = self.train_steps_per_call
+
+        if n_steps == 1:
+            (td_error,
+             n_pi_probs,
+             n_rnn_states,
+             summaries) = self._train_and_recompute(n_obses_list=n_obses_list,
+                                                    n_actions=n_actions,
+                                                    n_rewards=n_rewards,
+                                                    next_obs_list=next_obs_list,
+                                                    n_dones=n_dones,
+                                                    n_mu_probs=n_mu_probs,
+                                                    priority_is=priority_is if self.use_priority else None,
+                                                    initial_rnn_state=rnn_state)
+        else:
+            def _stack(x):
+                # [K * Batch, ...] -> [K, Batch, ...]
+                return tf.reshape(x, (n_steps, -1, *x.shape[1:])) if x is not None else None
+
+            (td_error,
+             n_pi_probs,
+             n_rnn_states,
+             summaries) = self._train_n_steps(n_obses_list=[_stack(n_obses) for n_obses in n_obses_list],
+                                              n_actions=_stack(n_actions),
+                                              n_rewards=_stack(n_rewards),
+                                              next_obs_list=[_stack(next_obs) for next_obs in next_obs_list],
+                                              n_dones=_stack(n_dones),
+                                              n_mu_probs=_stack(n_mu_probs),
+                                              priority_is=_stack(priority_is) if self.use_priority else None,
+                                              initial_rnn_state=_stack(rnn_state))
+
+        self.async_summary_writer.add(self._summary_tags, summaries)
+        # If a multiple of `write_summary_per_step` is in [step, step + n_steps)
+        if (step + n_steps - 1) // self.write_summary_per_step > (step - 1) // self.write_summary_per_step:
+            self.async_summary_writer.write(step + n_steps - 1)
+
+        # If a multiple of `save_model_per_step` is in [step, step + n_steps)
+        if (step + n_steps - 1) // self.save_model_per_step > (step - 1) // self.save_model_per_step \
                 and (time.time() - self._last_save_time) / 60 >= self.save_model_per_minute:
             self.save_model()
             self._last_save_time = time.time()
 
-        if self.use_n_step_is:
-            n_pi_probs_tensor = self.get_n_probs(n_obses_list,
-                                                 n_actions,
-                                                 rnn_state=rnn_state if self.use_rnn else None)
-
         # Update td_error
         if self.use_priority:
-            td_error = self.get_td_error(n_obses_list=n_obses_list,
-                                         n_actions=n_actions,
-                                         n_rewards=n_rewards,
-                                         next_obs_list=next_obs_list,
-                                         n_dones=n_dones,
-                                         n_mu_probs=n_pi_probs_tensor if self.use_n_step_is else None,
-                                         rnn_state=rnn_state if self.use_rnn else None).numpy()
-            self.replay_buffer.update(pointers, td_error)
+            self._update_td_error(pointers, td_error.numpy().reshape(-1, 1))
 
         # Update rnn_state
         if self.use_rnn:
             pointers_list = [pointers + i for i in range(1, self.burn_in_step + self.n_step + 1)]
             tmp_pointers = np.stack(pointers_list, axis=1).reshape(-1)
-            n_rnn_states = self.get_n_rnn_states(n_obses_list, n_actions, rnn_state).numpy()
-            rnn_states = n_rnn_states.reshape(-1, n_rnn_states.shape[-1])
-            self.replay_buffer.update_transitions(tmp_pointers, 'rnn_state', rnn_states)
+            rnn_states = n_rnn_states.numpy().reshape(-1, self.rnn_state_dim)
+            self._update_transitions(tmp_pointers, 'rnn_state', rnn_states)
 
         # Update n_mu_probs
         if self.use_n_step_is:
             pointers_list = [pointers + i for i in range(0, self.burn_in_step + self.n_step)]
             tmp_pointers = np.stack(pointers_list, axis=1).reshape(-1)
-            pi_probs = n_pi_probs_tensor.numpy().reshape(-1)
-            self.replay_buffer.update_transitions(tmp_pointers, 'mu_prob', pi_probs)
+            pi_probs = n_pi_probs.numpy().reshape(-1)
+            self._update_transitions(tmp_pointers, 'mu_prob', pi_probs)
 
-        self._increase_global_step()
+        if n_steps == 1:
+            self._increase_global_step()
 
-        return step + 1
+        return step + n_steps
@@ -3,6 +3,7 @@ import logging
 import os
 import shutil
 import sys
+import threading
 import time
 from pathlib import Path
 
@@ -11,6 +12,7 @@ import numpy as np
 import algorithm.config_helper as config_helper
 
 from .agent import Agent
+from .rate_limiter import RateLimiter
 from .sac_base import SAC_Base
 
 
@@ -137,6 +139,71 @@ class Main(object):
 
                             **sac_config)
 
+        self.async_training = self.train_mode and self.config['async_training']
+        if self.async_training:
+            # The acting policy, refreshed from self.sac by the trainer thread
+            self.sac_bak = SAC_Base(obs_dims=self.obs_dims,
+                                    d_action_dim=self.d_action_dim,
+                                    c_action_dim=self.c_action_dim,
+                                    model_abs_dir=None,
+                                    model=custom_nn_model,
+                                    train_mode=False,
+
+                                    **sac_config)
+            self._sac_bak_lock = threading.Lock()
+            self._update_sac_bak()
+
+            # The error buffer holds at least one train call, otherwise sampling could block forever
+            self._rate_limiter = RateLimiter(self.config['update_to_data_ratio'],
+                                             max(self.config['update_error_buffer'],
+                                                 self.sac.train_steps_per_call))
+            self._trained_steps = 0
+        else:
+            self.sac_bak = self.sac
+            self._sac_bak_lock = threading.Lock()
+
+    def _update_sac_bak(self):
+        variables = [v.numpy() for v in self.sac.get_policy_variables()]
+        with self._sac_bak_lock:
+            self.sac_bak.update_policy_variables(variables)
+
+    def _run_trainer(self):
+        """
+        Train against the shared replay buffer in a separate thread,
+        rate-limited to `update_to_data_ratio` gradient steps per env step
+        Env steps while the replay buffer warms up are not counted
+        """
+        # Warming up the replay buffer is not rate-limited
+        while not self.sac.replay_buffer.is_lg_batch_size:
+            if self._rate_limiter.closed:
+                return
+            time.sleep(0.1)
+
+        last_refresh_step = 0
+
+        # Each train call runs `train_steps_per_call` gradient steps
+        steps_per_call = self.sac.train_steps_per_call
+
+        while self._rate_limiter.sample(steps_per_call):
+            trained_steps = self.sac.train()
+            if trained_steps == 0:
+                # Not enough transitions in the replay buffer, no gradient step is taken
+                self._rate_limiter.cancel_sample(steps_per_call)
+                time.sleep(0.1)
+                continue
+
+            self._trained_steps = trained_steps
+            if trained_steps - last_refresh_step >= self.config['policy_refresh_interval']:
+                self._update_sac_bak()
+                last_refresh_step = trained_steps
+
+            if self.config['max_step'] != -1 and trained_steps >= self.config['max_step']:
+                break
+
+        # Unblock env stepping
+        self._rate_limiter.close()
+        self.logger.warning('Training exits')
+
     def _run(self):
         use_rnn = self.sac.use_rnn
 
@@ -153,7 +220,13 @@ class Main(object):
         iteration = 0
         trained_steps = 0
 
+        if self.async_training:
+            t_trainer = threading.Thread(target=self._run_trainer, daemon=True)
+            t_trainer.start()
+
         while iteration != self.config['max_iter']:
+            if self.async_training:
+                trained_steps = self._trained_steps
             if self.config['max_step'] != -1 and trained_steps >= self.config['max_step']:
                 break
 
@@ -183,12 +256,14 @@ class Main(object):
                                                  [np.zeros(t) for t in self.obs_dims],
                                                  initial_rnn_state[0])
 
-                    action, next_rnn_state = self.sac.choose_rnn_action([o.astype(np.float32) for o in obs_list],
-                                                                        action,
-                                                                        rnn_state)
+                    with self._sac_bak_lock:
+                        action, next_rnn_state = self.sac_bak.choose_rnn_action([o.astype(np.float32) for o in obs_list],
+                                                                                action,
+                                                                                rnn_state)
                     next_rnn_state = next_rnn_state.numpy()
                 else:
-                    action = self.sac.choose_action([o.astype(np.float32) for o in obs_list])
+                    with self._sac_bak_lock:
+                        action = self.sac_bak.choose_action([o.astype(np.float32) for o in obs_list])
 
                 action = action.numpy()
 
@@ -216,7 +291,11 @@ class Main(object):
                         # n_rnn_states
                         for episode_trans in episode_trans_list:
                             self.sac.fill_replay_buffer(*episode_trans)
-                    trained_steps = self.sac.train()
+                    if self.async_training:
+                        # Block if training falls too far behind
+                        self._rate_limiter.insert()
+                    else:
+                        trained_steps = self.sac.train()
 
                 obs_list = next_obs_list
                 action[local_done] = np.zeros(self.action_dim)
@@ -233,7 +312,12 @@ class Main(object):
 
             iteration += 1
 
-        self.sac.save_model()
+        if self.async_training:
+            self._rate_limiter.close()
+            t_trainer.join()
+
+        self.sac.save_model(wait=True)
+        self.sac.close()
         self.env.close()
 
     def _log_episode_summaries(self, iteration, agents):
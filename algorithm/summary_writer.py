@@ -0,0 +1,126 @@
+import collections
+import logging
+import queue
+import threading
+
+import numpy as np
+import tensorflow as tf
+
+logger = logging.getLogger('sac.base.summary_writer')
+
+
+class AsyncSummaryWriter:
+    """
+    Buffer the scalar summaries of training steps in a ring buffer and write their mean, min and max
+    to TensorBoard in a background thread, so that the training path never writes or flushes files
+    """
+
+    def __init__(self, summary_writer, capacity=1000):
+        """
+        summary_writer: tf.summary.SummaryWriter
+        capacity: The number of buffered `add` calls, the oldest ones are dropped with a warning if it is exceeded
+        """
+        self._summary_writer = summary_writer
+
+        self._buffer = collections.deque(maxlen=capacity)
+        self._dropped = 0
+        self._lock = threading.Lock()
+        self._write_queue = queue.Queue()
+        self._closed = False
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def add(self, tags, values):
+        """
+        tags: List of summary tags
+        values: [len(tags)] or [K, len(tags)] tensors returned from the graph,
+            which are only converted to numpy in the background thread
+        """
+        with self._lock:
+            if len(self._buffer) == self._buffer.maxlen:
+                self._dropped += 1
+            self._buffer.append((tags, values))
+
+    def write(self, step):
+        """
+        Write the summaries buffered so far at `step` in the background
+        """
+        if not self._closed:
+            self._write_queue.put(('buffered', step))
+
+    def write_scalars(self, scalars, step):
+        """
+        Write a dict of constant scalars at `step` in the background
+        """
+        if not self._closed:
+            self._write_queue.put(('scalars', (scalars, step)))
+
+    def flush(self):
+        """
+        Block until all requested writes are done and flushed
+        """
+        if not self._closed:
+            self._write_queue.join()
+
+    def close(self, step=None):
+        """
+        Write the summaries still buffered at `step` if it is not None, drain the queue,
+        stop the background thread and flush the summary writer
+        """
+        if self._closed:
+            return
+
+        if step is not None:
+            self.write(step)
+        self._closed = True
+        self._write_queue.put(None)
+        self._thread.join()
+        self._summary_writer.flush()
+
+    def _write_buffered(self, step):
+        with self._lock:
+            buffer = list(self._buffer)
+            self._buffer.clear()
+            dropped, self._dropped = self._dropped, 0
+
+        if dropped:
+            logger.warning(f'{dropped} summaries dropped before step {step}, '
+                           f'the buffer capacity {self._buffer.maxlen} is exceeded')
+
+        tag_values = collections.defaultdict(list)
+        for tags, values in buffer:
+            values = np.reshape(values, (-1, len(tags)))
+            for i, tag in enumerate(tags):
+                tag_values[tag].append(values[:, i])
+
+        with self._summary_writer.as_default():
+            for tag, values in tag_values.items():
+                values = np.concatenate(values)
+                tf.summary.scalar(tag, values.mean(), step=step)
+                tf.summary.scalar(f'{tag}_min', values.min(), step=step)
+                tf.summary.scalar(f'{tag}_max', values.max(), step=step)
+
+    def _write_scalars(self, scalars, step):
+        with self._summary_writer.as_default():
+            for tag, value in scalars.items():
+                tf.summary.scalar(tag, value, step=step)
+
+    def _run(self):
+        while True:
+            item = self._write_queue.get()
+            try:
+                if item is None:
+                    return
+
+                kind, arg = item
+                if kind == 'buffered':
+                    self._write_buffered(arg)
+                else:
+                    self._write_scalars(*arg)
+
+                self._summary_writer.flush()
+            except Exception as e:
+                logger.error(f'Writing summaries failed: {e}')
+            finally:
+                self._write_queue.task_done()
@@ -168,6 +168,7 @@ class Actor(object):
                                      model_abs_dir=None,
                                      model=custom_nn_model,
                                      train_mode=False,
+                                     storage_codecs=config['replay_config'].get('storage_codecs'),
 
                                      **sac_config)
 
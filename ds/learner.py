@@ -28,8 +28,12 @@ from .utils import PeerSet, rpc_error_inspector
 
 
 class SampledDataBuffer:
-    def __init__(self, get_sampled_data):
+    def __init__(self, get_sampled_data, n_batches=1):
+        """
+        get_sampled_data: Get `n_batches` batches in one call
+        """
         self._get_sampled_data = get_sampled_data
+        self._n_batches = n_batches
 
         self._data_feeded = False
         self._closed = False
@@ -41,10 +45,11 @@ class SampledDataBuffer:
 
     def run(self):
         while not self._closed:
-            sampled = self._get_sampled_data()
+            sampled = self._get_sampled_data(self._n_batches)
 
             if sampled is not None:
-                self._buffer.put(sampled)
+                for batch in sampled:
+                    self._buffer.put(batch)
                 self._data_feeded = True
             else:
                 self.logger.warning('No data sampled')
@@ -262,6 +267,7 @@ class Learner:
                                model_abs_dir=model_abs_dir,
                                model=custom_nn_model,
                                last_ckpt=self.last_ckpt,
+                               storage_codecs=self.replay_config.get('storage_codecs'),
 
                                **self.sac_config)
 
@@ -272,6 +278,7 @@ class Learner:
                                    model_abs_dir=None,
                                    model=custom_nn_model,
                                    last_ckpt=self.last_ckpt,
+                                   storage_codecs=self.replay_config.get('storage_codecs'),
 
                                    **self.sac_config)
 
@@ -506,7 +513,20 @@ class Learner:
                 {'tag': 'reward/mean', 'simple_value': rewards.mean()},
                 {'tag': 'reward/max', 'simple_value': rewards.max()},
                 {'tag': 'reward/min', 'simple_value': rewards.min()}
-            ], iteration)
+            ] + self._get_rate_limiter_summaries(), iteration)
+
+    def _get_rate_limiter_summaries(self):
+        """
+        Seconds that Add and Sample were blocked by the replay rate limiter since the last call
+        """
+        if self.base_config['samples_per_insert'] is None:
+            return []
+
+        add_blocked_time, sample_blocked_time = self._stub.get_replay_blocked_time()
+        return [
+            {'tag': 'replay/add_blocked_time', 'simple_value': add_blocked_time},
+            {'tag': 'replay/sample_blocked_time', 'simple_value': sample_blocked_time}
+        ]
 
     def _log_episode_info(self, iteration, start_time, agents):
         time_elapse = (time.time() - start_time) / 60
@@ -516,7 +536,8 @@ class Learner:
         self.logger.info(f'{iteration}, S {max(steps)}, {time_elapse:.2f}, R {rewards}')
 
     def _run_training_client(self):
-        sample_data_buffer = SampledDataBuffer(self._stub.get_sampled_data)
+        sample_data_buffer = SampledDataBuffer(self._stub.get_sampled_data,
+                                               self.base_config['sample_batches_per_call'])
         update_data_buffer = UpdateDataBuffer(self._stub.update_td_error,
                                               self._stub.update_transitions)
 
@@ -599,6 +620,9 @@ class Learner:
             self.env.close()
         if hasattr(self, 'server'):
             self.server.stop(None)
+        if hasattr(self, 'sac'):
+            # Not under _sac_lock, close may be called by a thread holding it
+            self.sac.close()
 
         self._stub.close()
 
@@ -776,6 +800,8 @@ class StubController:
             ('grpc.max_receive_message_length', C.MAX_MESSAGE_LENGTH)
         ])
         self._replay_stub = replay_pb2_grpc.ReplayServiceStub(self._replay_channel)
+        self._replay_blocked_time = [0., 0.]
+        self._replay_blocked_time_lock = threading.Lock()
 
         self._logger = logging.getLogger('ds.learner.stub')
 
@@ -788,18 +814,48 @@ class StubController:
 
     # To replay
     @rpc_error_inspector
-    def get_sampled_data(self):
-        response = self._replay_stub.Sample(Empty())
+    def get_sampled_data(self, n_batches=1):
+        """
+        Return a list of `n_batches` batches sampled in one call
+        """
+        response = self._replay_stub.Sample(replay_pb2.SampleRequest(n_batches=n_batches))
+        if response:
+            with self._replay_blocked_time_lock:
+                self._replay_blocked_time[0] += response.add_blocked_time
+                self._replay_blocked_time[1] += response.sample_blocked_time
+
         if response and response.has_data:
-            return (proto_to_ndarray(response.pointers),
-                    [proto_to_ndarray(n_obses) for n_obses in response.n_obses_list],
-                    proto_to_ndarray(response.n_actions),
-                    proto_to_ndarray(response.n_rewards),
-                    [proto_to_ndarray(next_obs) for next_obs in response.next_obs_list],
-                    proto_to_ndarray(response.n_dones),
-                    proto_to_ndarray(response.n_mu_probs),
-                    proto_to_ndarray(response.rnn_state),
-                    proto_to_ndarray(response.priority_is))
+            sampled = (proto_to_ndarray(response.pointers),
+                       [proto_to_ndarray(n_obses) for n_obses in response.n_obses_list],
+                       proto_to_ndarray(response.n_actions),
+                       proto_to_ndarray(response.n_rewards),
+                       [proto_to_ndarray(next_obs) for next_obs in response.next_obs_list],
+                       proto_to_ndarray(response.n_dones),
+                       proto_to_ndarray(response.n_mu_probs),
+                       proto_to_ndarray(response.rnn_state),
+                       proto_to_ndarray(response.priority_is))
+
+            def split(data):
+                if data is None:
+                    return [None] * n_batches
+                elif isinstance(data, list):
+                    return list(zip(*[np.split(d, n_batches) for d in data]))
+                else:
+                    return np.split(data, n_batches)
+
+            # Lists of observations are split into tuples, convert them back to lists
+            return [tuple(list(d) if isinstance(d, tuple) else d for d in batch)
+                    for batch in zip(*[split(d) for d in sampled])]
+
+    def get_replay_blocked_time(self):
+        """
+        Return and reset the seconds that Add and Sample were blocked by the replay rate limiter
+        """
+        with self._replay_blocked_time_lock:
+            blocked_time = tuple(self._replay_blocked_time)
+            self._replay_blocked_time = [0., 0.]
+
+        return blocked_time
 
     # To replay
     @rpc_error_inspector
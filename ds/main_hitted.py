@@ -20,7 +20,7 @@ class LearnerHitted(Learner):
             {'tag': 'reward/max', 'simple_value': rewards.max()},
             {'tag': 'reward/min', 'simple_value': rewards.min()},
             {'tag': 'reward/hitted', 'simple_value': hitted}
-        ], iteration)
+        ] + self._get_rate_limiter_summaries(), iteration)
 
     def _log_episode_info(self, iteration, start_time, agents):
         time_elapse = (time.time() - start_time) / 60
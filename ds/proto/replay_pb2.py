@@ -21,7 +21,7 @@ DESCRIPTOR = _descriptor.FileDescriptor(
   syntax='proto3',
   serialized_options=None,
   create_key=_descriptor._internal_create_key,
-  serialized_pb=b'\n\x0creplay.proto\x12\x06replay\x1a\rndarray.proto\x1a\x0epingpong.proto\"\xe0\x01\n\nAddRequest\x12\x1e\n\x0cn_obses_list\x18\x01 \x03(\x0b\x32\x08.NDarray\x12\x1b\n\tn_actions\x18\x02 \x01(\x0b\x32\x08.NDarray\x12\x1b\n\tn_rewards\x18\x03 \x01(\x0b\x32\x08.NDarray\x12\x1f\n\rnext_obs_list\x18\x04 \x03(\x0b\x32\x08.NDarray\x12\x19\n\x07n_dones\x18\x05 \x01(\x0b\x32\x08.NDarray\x12\x1c\n\nn_mu_probs\x18\x06 \x01(\x0b\x32\x08.NDarray\x12\x1e\n\x0cn_rnn_states\x18\x07 \x01(\x0b\x32\x08.NDarray\"\xab\x02\n\x0bSampledData\x12\x1a\n\x08pointers\x18\x01 \x01(\x0b\x32\x08.NDarray\x12\x1e\n\x0cn_obses_list\x18\x02 \x03(\x0b\x32\x08.NDarray\x12\x1b\n\tn_actions\x18\x03 \x01(\x0b\x32\x08.NDarray\x12\x1b\n\tn_rewards\x18\x04 \x01(\x0b\x32\x08.NDarray\x12\x1f\n\rnext_obs_list\x18\x05 \x03(\x0b\x32\x08.NDarray\x12\x19\n\x07n_dones\x18\x06 \x01(\x0b\x32\x08.NDarray\x12\x1c\n\nn_mu_probs\x18\x07 \x01(\x0b\x32\x08.NDarray\x12\x1b\n\trnn_state\x18\x08 \x01(\x0b\x32\x08.NDarray\x12\x1d\n\x0bpriority_is\x18\t \x01(\x0b\x32\x08.NDarray\x12\x10\n\x08has_data\x18\n \x01(\x08\"N\n\x14UpdateTDErrorRequest\x12\x1a\n\x08pointers\x18\x01 \x01(\x0b\x32\x08.NDarray\x12\x1a\n\x08td_error\x18\x02 \x01(\x0b\x32\x08.NDarray\"[\n\x18UpdateTransitionsRequest\x12\x1a\n\x08pointers\x18\x01 \x01(\x0b\x32\x08.NDarray\x12\x0b\n\x03key\x18\x02 \x01(\t\x12\x16\n\x04\x64\x61ta\x18\x03 \x01(\x0b\x32\x08.NDarray2\xf0\x01\n\rReplayService\x12\x1f\n\x0bPersistence\x12\x05.Ping\x1a\x05.Pong(\x01\x30\x01\x12!\n\x03\x41\x64\x64\x12\x12.replay.AddRequest\x1a\x06.Empty\x12%\n\x06Sample\x12\x06.Empty\x1a\x13.replay.SampledData\x12\x35\n\rUpdateTDError\x12\x1c.replay.UpdateTDErrorRequest\x1a\x06.Empty\x12=\n\x11UpdateTransitions\x12 .replay.UpdateTransitionsRequest\x1a\x06.Emptyb\x06proto3'
+  serialized_pb=b'\n\x0creplay.proto\x12\x06replay\x1a\rndarray.proto\x1a\x0epingpong.proto\"\xe0\x01\n\nAddRequest\x12\x1e\n\x0cn_obses_list\x18\x01 \x03(\x0b2\x08.NDarray\x12\x1b\n\tn_actions\x18\x02 \x01(\x0b2\x08.NDarray\x12\x1b\n\tn_rewards\x18\x03 \x01(\x0b2\x08.NDarray\x12\x1f\n\rnext_obs_list\x18\x04 \x03(\x0b2\x08.NDarray\x12\x19\n\x07n_dones\x18\x05 \x01(\x0b2\x08.NDarray\x12\x1c\n\nn_mu_probs\x18\x06 \x01(\x0b2\x08.NDarray\x12\x1e\n\x0cn_rnn_states\x18\x07 \x01(\x0b2\x08.NDarray\"\"\n\rSampleRequest\x12\x11\n\tn_batches\x18\x01 \x01(\x05\"\xe2\x02\n\x0bSampledData\x12\x1a\n\x08pointers\x18\x01 \x01(\x0b2\x08.NDarray\x12\x1e\n\x0cn_obses_list\x18\x02 \x03(\x0b2\x08.NDarray\x12\x1b\n\tn_actions\x18\x03 \x01(\x0b2\x08.NDarray\x12\x1b\n\tn_rewards\x18\x04 \x01(\x0b2\x08.NDarray\x12\x1f\n\rnext_obs_list\x18\x05 \x03(\x0b2\x08.NDarray\x12\x19\n\x07n_dones\x18\x06 \x01(\x0b2\x08.NDarray\x12\x1c\n\nn_mu_probs\x18\x07 \x01(\x0b2\x08.NDarray\x12\x1b\n\trnn_state\x18\x08 \x01(\x0b2\x08.NDarray\x12\x1d\n\x0bpriority_is\x18\t \x01(\x0b2\x08.NDarray\x12\x10\n\x08has_data\x18\n \x01(\x08\x12\x18\n\x10add_blocked_time\x18\x0b \x01(\x02\x12\x1b\n\x13sample_blocked_time\x18\x0c \x01(\x02\"N\n\x14UpdateTDErrorRequest\x12\x1a\n\x08pointers\x18\x01 \x01(\x0b2\x08.NDarray\x12\x1a\n\x08td_error\x18\x02 \x01(\x0b2\x08.NDarray\"[\n\x18UpdateTransitionsRequest\x12\x1a\n\x08pointers\x18\x01 \x01(\x0b2\x08.NDarray\x12\x0b\n\x03key\x18\x02 \x01(\t\x12\x16\n\x04data\x18\x03 \x01(\x0b2\x08.NDarray2\xff\x01\n\rReplayService\x12\x1f\n\x0bPersistence\x12\x05.Ping\x1a\x05.Pong(\x010\x01\x12!\n\x03Add\x12\x12.replay.AddRequest\x1a\x06.Empty\x124\n\x06Sample\x12\x15.replay.SampleRequest\x1a\x13.replay.SampledData\x125\n\rUpdateTDError\x12\x1c.replay.UpdateTDErrorRequest\x1a\x06.Empty\x12=\n\x11UpdateTransitions\x12 .replay.UpdateTransitionsRequest\x1a\x06.Emptyb\x06proto3'
   ,
   dependencies=[ndarray__pb2.DESCRIPTOR,pingpong__pb2.DESCRIPTOR,])
 
@@ -102,6 +102,38 @@ _ADDREQUEST = _descriptor.Descriptor(
 )
 
 
+_SAMPLEREQUEST = _descriptor.Descriptor(
+  name='SampleRequest',
+  full_name='replay.SampleRequest',
+  filename=None,
+  file=DESCRIPTOR,
+  containing_type=None,
+  create_key=_descriptor._internal_create_key,
+  fields=[
+    _descriptor.FieldDescriptor(
+      name='n_batches', full_name='replay.SampleRequest.n_batches', index=0,
+      number=1, type=5, cpp_type=1, label=1,
+      has_default_value=False, default_value=0,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
+  ],
+  extensions=[
+  ],
+  nested_types=[],
+  enum_types=[
+  ],
+  serialized_options=None,
+  is_extendable=False,
+  syntax='proto3',
+  extension_ranges=[],
+  oneofs=[
+  ],
+  serialized_start=282,
+  serialized_end=316,
+)
+
+
 _SAMPLEDDATA = _descriptor.Descriptor(
   name='SampledData',
   full_name='replay.SampledData',
@@ -180,6 +212,20 @@ _SAMPLEDDATA = _descriptor.Descriptor(
       message_type=None, enum_type=None, containing_type=None,
       is_extension=False, extension_scope=None,
       serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
+    _descriptor.FieldDescriptor(
+      name='add_blocked_time', full_name='replay.SampledData.add_blocked_time', index=10,
+      number=11, type=2, cpp_type=6, label=1,
+      has_default_value=False, default_value=float(0),
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
+    _descriptor.FieldDescriptor(
+      name='sample_blocked_time', full_name='replay.SampledData.sample_blocked_time', index=11,
+      number=12, type=2, cpp_type=6, label=1,
+      has_default_value=False, default_value=float(0),
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
   ],
   extensions=[
   ],
@@ -192,8 +238,8 @@ _SAMPLEDDATA = _descriptor.Descriptor(
   extension_ranges=[],
   oneofs=[
   ],
-  serialized_start=283,
-  serialized_end=582,
+  serialized_start=319,
+  serialized_end=673,
 )
 
 
@@ -231,8 +277,8 @@ _UPDATETDERRORREQUEST = _descriptor.Descriptor(
   extension_ranges=[],
   oneofs=[
   ],
-  serialized_start=584,
-  serialized_end=662,
+  serialized_start=675,
+  serialized_end=753,
 )
 
 
@@ -277,8 +323,8 @@ _UPDATETRANSITIONSREQUEST = _descriptor.Descriptor(
   extension_ranges=[],
   oneofs=[
   ],
-  serialized_start=664,
-  serialized_end=755,
+  serialized_start=755,
+  serialized_end=846,
 )
 
 _ADDREQUEST.fields_by_name['n_obses_list'].message_type = ndarray__pb2._NDARRAY
@@ -302,6 +348,7 @@ _UPDATETDERRORREQUEST.fields_by_name['td_error'].message_type = ndarray__pb2._ND
 _UPDATETRANSITIONSREQUEST.fields_by_name['pointers'].message_type = ndarray__pb2._NDARRAY
 _UPDATETRANSITIONSREQUEST.fields_by_name['data'].message_type = ndarray__pb2._NDARRAY
 DESCRIPTOR.message_types_by_name['AddRequest'] = _ADDREQUEST
+DESCRIPTOR.message_types_by_name['SampleRequest'] = _SAMPLEREQUEST
 DESCRIPTOR.message_types_by_name['SampledData'] = _SAMPLEDDATA
 DESCRIPTOR.message_types_by_name['UpdateTDErrorRequest'] = _UPDATETDERRORREQUEST
 DESCRIPTOR.message_types_by_name['UpdateTransitionsRequest'] = _UPDATETRANSITIONSREQUEST
@@ -314,6 +361,13 @@ AddRequest = _reflection.GeneratedProtocolMessageType('AddRequest', (_message.Me
   })
 _sym_db.RegisterMessage(AddRequest)
 
+SampleRequest = _reflection.GeneratedProtocolMessageType('SampleRequest', (_message.Message,), {
+  'DESCRIPTOR' : _SAMPLEREQUEST,
+  '__module__' : 'replay_pb2'
+  # @@protoc_insertion_point(class_scope:replay.SampleRequest)
+  })
+_sym_db.RegisterMessage(SampleRequest)
+
 SampledData = _reflection.GeneratedProtocolMessageType('SampledData', (_message.Message,), {
   'DESCRIPTOR' : _SAMPLEDDATA,
   '__module__' : 'replay_pb2'
@@ -344,8 +398,8 @@ _REPLAYSERVICE = _descriptor.ServiceDescriptor(
   index=0,
   serialized_options=None,
   create_key=_descriptor._internal_create_key,
-  serialized_start=758,
-  serialized_end=998,
+  serialized_start=849,
+  serialized_end=1104,
   methods=[
   _descriptor.MethodDescriptor(
     name='Persistence',
@@ -372,7 +426,7 @@ _REPLAYSERVICE = _descriptor.ServiceDescriptor(
     full_name='replay.ReplayService.Sample',
     index=2,
     containing_service=None,
-    input_type=ndarray__pb2._EMPTY,
+    input_type=_SAMPLEREQUEST,
     output_type=_SAMPLEDDATA,
     serialized_options=None,
     create_key=_descriptor._internal_create_key,
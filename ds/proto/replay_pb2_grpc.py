@@ -28,7 +28,7 @@ class ReplayServiceStub(object):
                 )
         self.Sample = channel.unary_unary(
                 '/replay.ReplayService/Sample',
-                request_serializer=ndarray__pb2.Empty.SerializeToString,
+                request_serializer=replay__pb2.SampleRequest.SerializeToString,
                 response_deserializer=replay__pb2.SampledData.FromString,
                 )
         self.UpdateTDError = channel.unary_unary(
@@ -91,7 +91,7 @@ def add_ReplayServiceServicer_to_server(servicer, server):
             ),
             'Sample': grpc.unary_unary_rpc_method_handler(
                     servicer.Sample,
-                    request_deserializer=ndarray__pb2.Empty.FromString,
+                    request_deserializer=replay__pb2.SampleRequest.FromString,
                     response_serializer=replay__pb2.SampledData.SerializeToString,
             ),
             'UpdateTDError': grpc.unary_unary_rpc_method_handler(
@@ -160,7 +160,7 @@ class ReplayService(object):
             timeout=None,
             metadata=None):
         return grpc.experimental.unary_unary(request, target, '/replay.ReplayService/Sample',
-            ndarray__pb2.Empty.SerializeToString,
+            replay__pb2.SampleRequest.SerializeToString,
             replay__pb2.SampledData.FromString,
             options, channel_credentials,
             insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
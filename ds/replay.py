@@ -10,7 +10,8 @@ import grpc
 import numpy as np
 
 import algorithm.config_helper as config_helper
-from algorithm.replay_buffer import PrioritizedReplayBuffer
+from algorithm.rate_limiter import RateLimiter
+from algorithm.replay_buffer import ShardedPrioritizedReplayBuffer
 
 from . import constants as C
 from .proto import learner_pb2, learner_pb2_grpc, replay_pb2, replay_pb2_grpc
@@ -21,8 +22,6 @@ from .utils import PeerSet, rpc_error_inspector
 
 
 class Replay(object):
-    _replay_buffer_lock = threading.Lock()
-
     def __init__(self, root_dir, config_dir, args):
         self.root_dir = root_dir
         self.cmd_args = args
@@ -93,9 +92,19 @@ class Replay(object):
         self.burn_in_step = sac_config['burn_in_step']
         self.n_step = sac_config['n_step']
 
-        self._replay_buffer = PrioritizedReplayBuffer(**replay_config)
+        # Each shard has its own lock, so that Add, Sample and Update proceed in parallel
+        self._replay_buffer = ShardedPrioritizedReplayBuffer(n_shards=config['base_config']['replay_shards'],
+                                                             **replay_config,
+                                                             uint8_images=sac_config['uint8_images'])
         self._curr_percent = -1
 
+        # Keep the ratio of sampled transitions to added transitions around `samples_per_insert`
+        self._rate_limiter = None
+        if config['base_config']['samples_per_insert'] is not None:
+            self._rate_limiter = RateLimiter(config['base_config']['samples_per_insert'],
+                                             config['base_config']['samples_per_insert_tolerance'])
+            self._rate_limiter_timeout = config['base_config']['rate_limiter_timeout']
+
         if self.cmd_args.logger_in_file:
             logger_file = Path(model_abs_dir).joinpath('replay.log')
             config_helper.set_logger(logger_file)
@@ -103,6 +112,11 @@ class Replay(object):
 
         config_helper.display_config(config, self.logger)
 
+        self.replay_buffer_dir = config['base_config']['replay_buffer_dir']
+        if self.replay_buffer_dir is not None and Path(self.replay_buffer_dir).joinpath('replay.json').exists():
+            self._replay_buffer.load(self.replay_buffer_dir)
+            self.logger.info(f'Replay buffer restored from {self.replay_buffer_dir}, size: {self._replay_buffer.size}')
+
     def _add(self,
              n_obses_list,
              n_actions,
@@ -112,7 +126,12 @@ class Replay(object):
              n_mu_probs,
              n_rnn_states=None):
 
-        self.obs_list_len = len(n_obses_list)
+        if self._rate_limiter is not None:
+            # Slow down actors if learners fall behind.
+            # Transitions are still added after the timeout, and counted so that learners can catch up
+            if not self._rate_limiter.insert(n_rewards.shape[1], self._rate_limiter_timeout):
+                self._rate_limiter.force_insert(n_rewards.shape[1])
+
         # Reshape [1, episode_len, ...] to [episode_len, ...]
         obs_list = [n_obses.reshape([-1, *n_obses.shape[2:]]) for n_obses in n_obses_list]
         action = n_actions.reshape([-1, n_actions.shape[-1]])
@@ -157,36 +176,38 @@ class Replay(object):
 
         if td_error is not None:
             td_error = td_error.flatten()
-            with self._replay_buffer_lock:
-                self._replay_buffer.add_with_td_error(td_error, storage_data,
-                                                      ignore_size=self.burn_in_step + self.n_step)
+            self._replay_buffer.add_with_td_error(td_error, storage_data,
+                                                  ignore_size=self.burn_in_step + self.n_step)
 
             percent = int(self._replay_buffer.size / self._replay_buffer.capacity * 100)
             if percent > self._curr_percent:
                 self.logger.info(f'Buffer size: {percent}%')
                 self._curr_percent = percent
 
-    def _sample(self):
-        with self._replay_buffer_lock:
-            sampled = self._replay_buffer.sample()
+    def _sample(self, n_batches=1):
+        n_samples = self._replay_buffer.batch_size * n_batches
 
-            if sampled is None:
+        if self._rate_limiter is not None:
+            # Warming up the replay buffer is not rate-limited
+            if not self._replay_buffer.is_lg_batch_size:
+                return None
+            # No data are returned if actors fall behind until the timeout, learners will retry
+            if not self._rate_limiter.sample(n_samples, self._rate_limiter_timeout):
                 return None
 
-            pointers, trans, priority_is = sampled
+        # Get n_step transitions, `n_batches` batches are concatenated
+        sampled = self._replay_buffer.sample_sequences(self.burn_in_step + self.n_step + 1, n_batches)
 
-            # Get n_step transitions
-            trans = {k: [v] for k, v in trans.items()}
-            # k: [v, v, ...]
-            for i in range(1, self.burn_in_step + self.n_step + 1):
-                t_trans = self._replay_buffer.get_storage_data(pointers + i).items()
-                for k, v in t_trans:
-                    trans[k].append(v)
+        if sampled is None:
+            # Nothing is sampled, give the samples back to the rate limiter
+            if self._rate_limiter is not None:
+                self._rate_limiter.cancel_sample(n_samples)
+            return None
 
-        for k, v in trans.items():
-            trans[k] = np.concatenate([np.expand_dims(t, 1) for t in v], axis=1)
+        pointers, trans, priority_is = sampled
 
-        m_obses_list = [trans[f'obs_{i}'] for i in range(self.obs_list_len)]
+        obs_list_len = len([k for k in trans if k.startswith('obs_')])
+        m_obses_list = [trans[f'obs_{i}'] for i in range(obs_list_len)]
         m_actions = trans['action']
         m_rewards = trans['reward']
         m_dones = trans['done']
@@ -214,20 +235,26 @@ class Replay(object):
                           rnn_state), priority_is
 
     def _update_td_error(self, pointers, td_error):
-        with self._replay_buffer_lock:
-            mask = pointers == self._replay_buffer.get_storage_data_ids(pointers)
-            self._replay_buffer.update(pointers[mask], td_error[mask])
+        # Transitions overwritten since sampling are skipped
+        self._replay_buffer.update(pointers, td_error)
 
     def _update_transitions(self, pointers, key, data):
-        with self._replay_buffer_lock:
-            mask = pointers == self._replay_buffer.get_storage_data_ids(pointers)
-            self._replay_buffer.update_transitions(pointers[mask], key, data[mask])
+        self._replay_buffer.update_transitions(pointers, key, data)
+
+    def _get_blocked_time(self):
+        """
+        Return and reset the seconds that Add and Sample were blocked by the rate limiter
+        """
+        if self._rate_limiter is None:
+            return 0., 0.
+        return self._rate_limiter.get_blocked_time()
 
     def _run_replay_server(self, replay_port):
         servicer = ReplayService(self._add,
                                  self._sample,
                                  self._update_td_error,
-                                 self._update_transitions)
+                                 self._update_transitions,
+                                 self._get_blocked_time)
         self.server = grpc.server(futures.ThreadPoolExecutor(max_workers=C.MAX_THREAD_WORKERS),
                                   options=[
             ('grpc.max_send_message_length', C.MAX_MESSAGE_LENGTH),
@@ -240,19 +267,28 @@ class Replay(object):
         self.server.wait_for_termination()
 
     def close(self):
+        if getattr(self, '_rate_limiter', None) is not None:
+            self._rate_limiter.close()
+
         self.server.stop(None)
 
+        if hasattr(self, '_replay_buffer') and self.replay_buffer_dir is not None:
+            self._replay_buffer.save(self.replay_buffer_dir)
+            self.logger.info(f'Replay buffer saved to {self.replay_buffer_dir}, size: {self._replay_buffer.size}')
+
 
 class ReplayService(replay_pb2_grpc.ReplayServiceServicer):
     def __init__(self,
                  add,
                  sample,
                  update_td_error,
-                 update_transitions):
+                 update_transitions,
+                 get_blocked_time):
         self._add = add
         self._sample = sample
         self._update_td_error = update_td_error
         self._update_transitions = update_transitions
+        self._get_blocked_time = get_blocked_time
 
         self._peer_set = PeerSet(logging.getLogger('ds.replay.service'))
 
@@ -277,10 +313,14 @@ class ReplayService(replay_pb2_grpc.ReplayServiceServicer):
                   n_rnn_states=proto_to_ndarray(request.n_rnn_states))
         return Empty()
 
-    def Sample(self, request, context):
-        sampled = self._sample()
+    def Sample(self, request: replay_pb2.SampleRequest, context):
+        sampled = self._sample(max(request.n_batches, 1))
+        # The rate limiter blocking time is exported to learners' summaries
+        add_blocked_time, sample_blocked_time = self._get_blocked_time()
         if sampled is None:
-            return replay_pb2.SampledData(has_data=False)
+            return replay_pb2.SampledData(has_data=False,
+                                          add_blocked_time=add_blocked_time,
+                                          sample_blocked_time=sample_blocked_time)
         else:
             pointers, trans, priority_is = sampled
             (n_obses_list,
@@ -300,7 +340,9 @@ class ReplayService(replay_pb2_grpc.ReplayServiceServicer):
                                           n_mu_probs=ndarray_to_proto(n_mu_probs),
                                           rnn_state=ndarray_to_proto(rnn_state),
                                           priority_is=ndarray_to_proto(priority_is),
-                                          has_data=True)
+                                          has_data=True,
+                                          add_blocked_time=add_blocked_time,
+                                          sample_blocked_time=sample_blocked_time)
 
     def UpdateTDError(self, request: replay_pb2.UpdateTDErrorRequest, context):
         self._update_td_error(proto_to_ndarray(request.pointers),
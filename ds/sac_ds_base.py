@@ -8,6 +8,7 @@ import tensorflow as tf
 
 sys.path.append(str(Path(__file__).resolve().parent.parent))
 from algorithm.sac_base import SAC_Base
+from algorithm.summary_writer import AsyncSummaryWriter
 
 logger = logging.getLogger('sac.base.ds')
 
@@ -29,6 +30,7 @@ class SAC_DS_Base(SAC_Base):
 
                  ensemble_q_num=2,
                  ensemble_q_sample=2,
+                 vectorized_q=False,
 
                  burn_in_step=0,
                  n_step=1,
@@ -54,8 +56,13 @@ class SAC_DS_Base(SAC_Base):
                  use_rnd=False,
                  rnd_n_sample=10,
                  use_normalization=False,
+                 uint8_images=False,
+                 jit_compile=False,
+                 precision='float32',
+                 async_checkpoint=False,
 
-                 noise=0.):
+                 noise=0.,
+                 storage_codecs=None):
 
         physical_devices = tf.config.experimental.list_physical_devices('GPU')
         if len(physical_devices) > 0:
@@ -68,6 +75,7 @@ class SAC_DS_Base(SAC_Base):
 
         self.ensemble_q_num = ensemble_q_num
         self.ensemble_q_sample = ensemble_q_sample
+        self.vectorized_q = vectorized_q
 
         self.burn_in_step = burn_in_step
         self.n_step = n_step
@@ -94,10 +102,19 @@ class SAC_DS_Base(SAC_Base):
         self.use_rnd = use_rnd
         self.rnd_n_sample = rnd_n_sample
         self.use_normalization = use_normalization
+        self.uint8_images = uint8_images
+        self.jit_compile = jit_compile
+        assert precision in ('float32', 'mixed_bfloat16'), f'Unsupported precision {precision}'
+        self.precision = precision
+        self.async_checkpoint = async_checkpoint
         self.use_priority = True
         self.use_n_step_is = True
+        self.save_replay_buffer = False  # Replay buffer is saved by the replay server
+        self.train_steps_per_call = 1
 
         self.noise = noise
+        # Storage codecs of the replay server, deciding the dtypes of sampled observations
+        self.storage_codecs = storage_codecs
 
         self.action_dim = self.d_action_dim + self.c_action_dim
 
@@ -110,6 +127,7 @@ class SAC_DS_Base(SAC_Base):
         if train_mode:
             summary_path = Path(model_abs_dir).joinpath('log')
             self.summary_writer = tf.summary.create_file_writer(str(summary_path))
+            self.async_summary_writer = AsyncSummaryWriter(self.summary_writer)
 
         self._init_tf_function()
 
@@ -167,8 +185,11 @@ class SAC_DS_Base(SAC_Base):
             self.model_policy.trainable_variables +\
             [self.log_alpha_d, self.log_alpha_c]
 
-        for model_q in self.model_q_list:
-            variables += model_q.trainable_variables
+        if self.vectorized_q:
+            variables += self.model_q.trainable_variables
+        else:
+            for model_q in self.model_q_list:
+                variables += model_q.trainable_variables
 
         if self.use_prediction:
             variables += self.model_transition.trainable_variables +\
@@ -198,8 +219,11 @@ class SAC_DS_Base(SAC_Base):
         variables = self.get_nn_variables()
         variables += self.model_target_rep.trainable_variables
 
-        for model_target_q in self.model_target_q_list:
-            variables += model_target_q.trainable_variables
+        if self.vectorized_q:
+            variables += self.model_target_q.trainable_variables
+        else:
+            for model_target_q in self.model_target_q_list:
+                variables += model_target_q.trainable_variables
 
         if self.use_normalization:
             variables += [self.normalizer_step] +\
@@ -226,8 +250,11 @@ class SAC_DS_Base(SAC_Base):
         opt_variables = self.optimizer_rep.weights +\
             self.optimizer_policy.weights
 
-        for optimizer_q in self.optimizer_q_list:
-            opt_variables += optimizer_q.weights
+        if self.vectorized_q:
+            opt_variables += self.optimizer_q.weights
+        else:
+            for optimizer_q in self.optimizer_q_list:
+                opt_variables += optimizer_q.weights
 
         if self.use_auto_alpha:
             opt_variables += self.optimizer_alpha.weights
@@ -252,46 +279,42 @@ class SAC_DS_Base(SAC_Base):
               priority_is,
               rnn_state=None):
 
-        self._train(n_obses_list=n_obses_list,
-                    n_actions=n_actions,
-                    n_rewards=n_rewards,
-                    next_obs_list=next_obs_list,
-                    n_dones=n_dones,
-                    n_mu_probs=n_mu_probs,
-                    priority_is=priority_is,
-                    initial_rnn_state=rnn_state if self.use_rnn else None)
-
         step = self.global_step.numpy()
 
+        (td_error,
+         n_pi_probs,
+         n_rnn_states,
+         summaries) = self._train_and_recompute(n_obses_list=n_obses_list,
+                                                n_actions=n_actions,
+                                                n_rewards=n_rewards,
+                                                next_obs_list=next_obs_list,
+                                                n_dones=n_dones,
+                                                n_mu_probs=n_mu_probs,
+                                                priority_is=priority_is,
+                                                initial_rnn_state=rnn_state if self.use_rnn else None)
+
+        self.async_summary_writer.add(self._summary_tags, summaries)
+        if step % self.write_summary_per_step == 0:
+            self.async_summary_writer.write(step)
+
         if step % self.save_model_per_step == 0 \
                 and (time.time() - self._last_save_time) / 60 >= self.save_model_per_minute:
             self.save_model()
             self._last_save_time = time.time()
 
-        n_pi_probs_tensor = self.get_n_probs(n_obses_list,
-                                             n_actions,
-                                             rnn_state=rnn_state if self.use_rnn else None)
-
-        td_error = self.get_td_error(n_obses_list=n_obses_list,
-                                     n_actions=n_actions,
-                                     n_rewards=n_rewards,
-                                     next_obs_list=next_obs_list,
-                                     n_dones=n_dones,
-                                     n_mu_probs=n_pi_probs_tensor,
-                                     rnn_state=rnn_state if self.use_rnn else None).numpy()
+        td_error = td_error.numpy()
 
         update_data = list()
 
         pointers_list = [pointers + i for i in range(0, self.burn_in_step + self.n_step)]
         tmp_pointers = np.stack(pointers_list, axis=1).reshape(-1)
-        pi_probs = n_pi_probs_tensor.numpy().reshape(-1)
+        pi_probs = n_pi_probs.numpy().reshape(-1)
         update_data.append((tmp_pointers, 'mu_prob', pi_probs))
 
         if self.use_rnn:
             pointers_list = [pointers + i for i in range(1, self.burn_in_step + self.n_step + 1)]
             tmp_pointers = np.stack(pointers_list, axis=1).reshape(-1)
-            n_rnn_states = self.get_n_rnn_states(n_obses_list, n_actions, rnn_state).numpy()
-            rnn_states = n_rnn_states.reshape(-1, n_rnn_states.shape[-1])
+            rnn_states = n_rnn_states.numpy().reshape(-1, self.rnn_state_dim)
             update_data.append((tmp_pointers, 'rnn_state', rnn_states))
 
         self._increase_global_step()
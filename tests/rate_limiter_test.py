@@ -0,0 +1,91 @@
+import unittest
+import sys
+import threading
+
+sys.path.append('..')
+
+from algorithm.rate_limiter import RateLimiter
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_ratio(self):
+        rate_limiter = RateLimiter(2, 4)
+
+        # Inserts before the first sample are not counted
+        for _ in range(100):
+            self.assertTrue(rate_limiter.insert())
+
+        # Start counting inserts
+        self.assertTrue(rate_limiter.sample())
+        samples = 1
+
+        def sample():
+            nonlocal samples
+            while rate_limiter.sample():
+                samples += 1
+
+        t = threading.Thread(target=sample, daemon=True)
+        t.start()
+
+        for _ in range(50):
+            self.assertTrue(rate_limiter.insert())
+
+        # The sampler runs ahead of the ratio by at most the error buffer
+        t.join(0.5)
+        self.assertEqual(samples, 50 * 2 + 4)
+
+        rate_limiter.close()
+        t.join(1)
+        self.assertFalse(t.is_alive())
+        self.assertFalse(rate_limiter.insert())
+
+    def test_close(self):
+        rate_limiter = RateLimiter(1, 1)
+        rate_limiter.sample()
+
+        t = threading.Thread(target=lambda: rate_limiter.sample(10), daemon=True)
+        t.start()
+        t.join(0.1)
+        self.assertTrue(t.is_alive())
+
+        rate_limiter.close()
+        t.join(1)
+        self.assertFalse(t.is_alive())
+
+    def test_timeout(self):
+        rate_limiter = RateLimiter(1, 10)
+        self.assertTrue(rate_limiter.sample())
+
+        # Timed out samples and inserts are not counted
+        self.assertFalse(rate_limiter.sample(20, timeout=0.01))
+        self.assertTrue(rate_limiter.insert(10))
+        self.assertFalse(rate_limiter.insert(2, timeout=0.01))
+        self.assertTrue(rate_limiter.sample(19))
+
+        insert_blocked_time, sample_blocked_time = rate_limiter.get_blocked_time()
+        self.assertGreater(insert_blocked_time, 0)
+        self.assertGreater(sample_blocked_time, 0)
+        self.assertEqual(rate_limiter.get_blocked_time(), (0, 0))
+
+    def test_force_insert(self):
+        rate_limiter = RateLimiter(1, 1)
+        self.assertTrue(rate_limiter.sample())
+        self.assertFalse(rate_limiter.sample(timeout=0.01))
+
+        # Inserts made after a timeout are still counted
+        self.assertTrue(rate_limiter.insert(2))
+        self.assertFalse(rate_limiter.insert(2, timeout=0.01))
+        rate_limiter.force_insert(2)
+        self.assertTrue(rate_limiter.sample(4))
+
+    def test_cancel_sample(self):
+        rate_limiter = RateLimiter(1, 2)
+        self.assertTrue(rate_limiter.sample(2))
+        self.assertFalse(rate_limiter.sample(timeout=0.01))
+
+        rate_limiter.cancel_sample(2)
+        self.assertTrue(rate_limiter.sample(2))
+
+
+if __name__ == '__main__':
+    unittest.main()
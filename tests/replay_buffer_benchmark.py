@@ -0,0 +1,137 @@
+"""
+Benchmarks of PrioritizedReplayBuffer
+Usage: python -m tests.replay_buffer_benchmark
+"""
+
+import sys
+import time
+
+import numpy as np
+
+sys.path.append('..')
+
+from algorithm.replay_buffer import PrioritizedReplayBuffer, SumTree
+
+
+EPISODE_LEN = 200
+N_EPISODES = 200
+
+
+def gen_episode_trans():
+    return {
+        'obs_0': np.random.randn(EPISODE_LEN, 10).astype(np.float32),
+        'action': np.random.randn(EPISODE_LEN, 2).astype(np.float32),
+        'reward': np.random.randn(EPISODE_LEN).astype(np.float32)
+    }
+
+
+def bench_add():
+    """
+    The latency of `add` should be flat as capacity grows
+    """
+    print('add latency')
+    for log2_capacity in range(14, 23, 2):
+        replay_buffer = PrioritizedReplayBuffer(capacity=2**log2_capacity)
+        episode_trans = gen_episode_trans()
+        # Warm up, allocating storage
+        replay_buffer.add(episode_trans, ignore_size=1)
+
+        t = time.time()
+        for _ in range(N_EPISODES):
+            replay_buffer.add(episode_trans, ignore_size=1)
+        t = (time.time() - t) / N_EPISODES
+
+        print(f'capacity 2^{log2_capacity:<4} {t * 1000:8.3f}ms')
+
+
+def gen_visual_episode_trans(episode_len=EPISODE_LEN):
+    """
+    Smooth frames moving slowly along an episode, like rendered visual observations
+    """
+    t = np.arange(episode_len)[:, None, None]
+    x = np.linspace(0, 4 * np.pi, 84)
+    frame = (np.sin(x[None, :, None] + t * 0.1) * np.cos(x[None, None, :] - t * 0.05) + 1) / 2
+    frame = np.round(frame * 8) / 8  # Flat shading
+    obs = np.stack([frame, frame[:, ::-1], frame[:, :, ::-1]], axis=-1).astype(np.float32)
+
+    return {
+        'obs_0': obs,
+        'action': np.random.randn(episode_len, 2).astype(np.float32),
+        'reward': np.random.randn(episode_len).astype(np.float32)
+    }
+
+
+def bench_sample_n_batches():
+    """
+    The cost per batch of sampling `n_batches` batches in one call
+    """
+    print('sample_sequences n_batches')
+    replay_buffer = PrioritizedReplayBuffer(batch_size=256, capacity=2**16)
+    episode_trans = gen_episode_trans()
+    while not replay_buffer.is_full:
+        replay_buffer.add(episode_trans, ignore_size=4)
+
+    for n_batches in [1, 4, 16]:
+        t = time.time()
+        for _ in range(64 // n_batches):
+            replay_buffer.sample_sequences(5, n_batches)
+        t = (time.time() - t) / 64
+
+        print(f'n_batches {n_batches:<4} {t * 1000:8.3f}ms/batch')
+
+
+def bench_frame_compression():
+    """
+    The compression ratio of image frames and the cost of n-step sequence sampling
+    """
+    print('frame compression')
+    capacity = 2**14
+    seq_len = 5
+    episode_trans = gen_visual_episode_trans()
+
+    for frame_compression, level in [(None, 0), ('zlib', 1), ('zlib', 6), ('lzma', 0)]:
+        replay_buffer = PrioritizedReplayBuffer(capacity=capacity,
+                                                frame_compression=frame_compression,
+                                                frame_compression_level=level)
+
+        t = time.time()
+        while not replay_buffer.is_full:
+            replay_buffer.add(episode_trans, ignore_size=seq_len - 1)
+        t_add = (time.time() - t) / capacity
+
+        obs = replay_buffer._trans_storage._buffer['obs_0']
+        ratio = np.prod(obs.shape) * np.dtype(obs.dtype).itemsize / obs.nbytes
+
+        t = time.time()
+        for _ in range(20):
+            replay_buffer.sample_sequences(seq_len)
+        t_sample = (time.time() - t) / 20
+
+        print(f'{str(frame_compression):<5} level {level} ratio {ratio:6.1f} '
+              f'add {t_add * 1e6:7.2f}us/frame sample_sequences {t_sample * 1000:8.3f}ms')
+
+
+def bench_update():
+    """
+    The throughput of `SumTree.update` with the size of UpdateTDError and UpdateTransitions
+    """
+    print('SumTree.update throughput')
+    for log2_capacity in range(14, 23, 4):
+        sum_tree = SumTree(2**log2_capacity)
+        for n in [256, 256 * 40, 2**log2_capacity // 2]:
+            data_idx = np.random.randint(0, sum_tree.capacity, n)
+            p = np.random.rand(n)
+
+            t = time.time()
+            for _ in range(10):
+                sum_tree.update(data_idx, p)
+            t = (time.time() - t) / 10
+
+            print(f'capacity 2^{log2_capacity:<4} n {n:<8} {t * 1000:8.3f}ms {n / t / 1e6:8.2f}M/s')
+
+
+if __name__ == '__main__':
+    bench_add()
+    bench_update()
+    bench_sample_n_batches()
+    bench_frame_compression()
@@ -0,0 +1,358 @@
+import unittest
+import sys
+
+import numpy as np
+
+sys.path.append('..')
+
+from algorithm.replay_buffer import (CompressedFrameStore, PrioritizedReplayBuffer,
+                                     ShardedPrioritizedReplayBuffer, SumTree)
+
+
+BATCH = 16
+CAPACITY = 128
+EPISODE_LEN = 30
+
+
+def gen_episode_trans():
+    return {
+        'obs_0': np.random.randn(EPISODE_LEN, 4).astype(np.float32),
+        'obs_1': np.random.rand(EPISODE_LEN, 6, 6, 3).astype(np.float32),
+        'action': np.random.randn(EPISODE_LEN, 2).astype(np.float32),
+        'reward': np.random.randn(EPISODE_LEN).astype(np.float32)
+    }
+
+
+class TestReplayBuffer(unittest.TestCase):
+    def test_sample_sequences(self):
+        replay_buffer = PrioritizedReplayBuffer(BATCH, CAPACITY)
+        seq_len = 5
+
+        for _ in range(10):
+            replay_buffer.add(gen_episode_trans(), ignore_size=seq_len - 1)
+
+            sampled = replay_buffer.sample_sequences(seq_len)
+            if sampled is None:
+                continue
+
+            pointers, trans, priority_is = sampled
+            self.assertEqual(priority_is.shape, (BATCH, 1))
+
+            for i in range(seq_len):
+                t_trans = replay_buffer.get_storage_data(pointers + i)
+                for k, v in t_trans.items():
+                    self.assertEqual(trans[k].shape, (BATCH, seq_len, *v.shape[1:]))
+                    np.testing.assert_allclose(trans[k][:, i], v)
+
+    def test_max_priority(self):
+        replay_buffer = PrioritizedReplayBuffer(BATCH, CAPACITY)
+
+        for _ in range(10):
+            replay_buffer.add_with_td_error(np.random.rand(EPISODE_LEN), gen_episode_trans())
+
+            sampled = replay_buffer.sample()
+            if sampled is not None:
+                pointers, trans, priority_is = sampled
+                replay_buffer.update(pointers, np.random.rand(BATCH))
+
+            sum_tree = replay_buffer._sum_tree
+            self.assertAlmostEqual(sum_tree.max, sum_tree._tree[CAPACITY - 1:].max())
+
+    def test_sum_tree_update(self):
+        sum_tree = SumTree(CAPACITY)
+        leaves = np.zeros(CAPACITY, dtype=np.float32)
+
+        # Level-wise updates with duplicated leaves and a bulk rebuild
+        for n in [1, 8, 20, CAPACITY]:
+            data_idx = np.random.randint(0, CAPACITY, n)
+            data_idx[-1] = data_idx[0]
+            p = np.random.rand(n).astype(np.float32)
+            sum_tree.update(data_idx, p)
+            leaves[data_idx] = p
+
+            np.testing.assert_allclose(sum_tree._tree[CAPACITY - 1:], leaves)
+            self.assertAlmostEqual(sum_tree.total_p, leaves.sum(), places=3)
+            self.assertAlmostEqual(sum_tree.max, leaves.max())
+            for i in range(CAPACITY - 1):
+                self.assertAlmostEqual(sum_tree._tree[i],
+                                       sum_tree._tree[2 * i + 1] + sum_tree._tree[2 * i + 2], places=5)
+
+        # Scalar data_idx and p
+        sum_tree.update(3, 0.5)
+        self.assertEqual(sum_tree.get_leaves()[3], 0.5)
+
+    def test_memmap_storage(self):
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as memmap_dir:
+            replay_buffer = PrioritizedReplayBuffer(BATCH, CAPACITY, memmap_dir=memmap_dir)
+
+            for _ in range(10):
+                episode_trans = gen_episode_trans()
+                replay_buffer.add(episode_trans)
+
+                pointers = np.arange(replay_buffer._trans_storage._id - EPISODE_LEN,
+                                     replay_buffer._trans_storage._id)
+                trans = replay_buffer.get_storage_data(pointers)
+                np.testing.assert_allclose(trans['obs_0'], episode_trans['obs_0'])
+                np.testing.assert_allclose(trans['obs_1'], episode_trans['obs_1'], atol=1 / 255.)
+
+                self.assertIsNotNone(replay_buffer.sample_sequences(3))
+
+    def test_save_load(self):
+        import tempfile
+
+        replay_buffer = PrioritizedReplayBuffer(BATCH, CAPACITY)
+
+        with tempfile.TemporaryDirectory() as path:
+            for _ in range(3):
+                replay_buffer.add_with_td_error(np.random.rand(EPISODE_LEN), gen_episode_trans())
+                # The second and third savings are incremental
+                replay_buffer.save(path)
+
+            loaded_replay_buffer = PrioritizedReplayBuffer(BATCH, CAPACITY)
+            loaded_replay_buffer.load(path)
+
+        self.assertEqual(loaded_replay_buffer.size, replay_buffer.size)
+        self.assertEqual(loaded_replay_buffer.beta, replay_buffer.beta)
+        self.assertAlmostEqual(loaded_replay_buffer._sum_tree.total_p, replay_buffer._sum_tree.total_p, places=4)
+        self.assertAlmostEqual(loaded_replay_buffer._sum_tree.max, replay_buffer._sum_tree.max)
+
+        pointers = np.arange(replay_buffer.size)
+        trans = replay_buffer.get_storage_data(pointers)
+        loaded_trans = loaded_replay_buffer.get_storage_data(pointers)
+        for k, v in trans.items():
+            np.testing.assert_allclose(loaded_trans[k], v)
+        np.testing.assert_array_equal(loaded_replay_buffer.get_storage_data_ids(pointers),
+                                      replay_buffer.get_storage_data_ids(pointers))
+
+    def test_storage_codecs(self):
+        episode_trans = gen_episode_trans()
+        action = np.eye(3, dtype=np.float32)[np.random.randint(0, 3, EPISODE_LEN)]
+        action[0] = 0  # All-zero row
+        episode_trans['action'] = action
+        episode_trans['mixed_action'] = np.concatenate([action, episode_trans['obs_0']], axis=-1)
+
+        replay_buffer = PrioritizedReplayBuffer(BATCH, CAPACITY, storage_codecs={
+            'obs_0': 'float16',
+            'reward': 'bfloat16',
+            'action': 'one_hot',
+            'mixed_action': 'one_hot:3'
+        })
+        replay_buffer.add(episode_trans, ignore_size=1)
+
+        storage = replay_buffer._trans_storage._buffer
+        self.assertEqual(storage['obs_0'].dtype, np.float16)
+        self.assertEqual(storage['obs_1'].dtype, np.uint8)
+        self.assertEqual(storage['reward'].dtype, np.uint16)
+        self.assertEqual(storage['action'].shape, (CAPACITY,))
+        self.assertEqual(storage['mixed_action'].shape, (CAPACITY, 5))
+
+        trans = replay_buffer.get_storage_data(np.arange(EPISODE_LEN))
+        for k, v in trans.items():
+            self.assertEqual(v.dtype, np.float32)
+        np.testing.assert_allclose(trans['obs_0'], episode_trans['obs_0'], rtol=1e-3, atol=1e-3)
+        np.testing.assert_allclose(trans['reward'], episode_trans['reward'], rtol=1e-2, atol=1e-2)
+        np.testing.assert_array_equal(trans['action'], episode_trans['action'])
+        np.testing.assert_array_equal(trans['mixed_action'], episode_trans['mixed_action'])
+
+        sampled = replay_buffer.sample_sequences(2)
+        self.assertEqual(sampled[1]['action'].shape, (BATCH, 2, 3))
+
+    def test_frame_compression(self):
+        import tempfile
+
+        for frame_compression in ['zlib', 'lzma']:
+            replay_buffer = PrioritizedReplayBuffer(BATCH, CAPACITY,
+                                                    frame_compression=frame_compression,
+                                                    frame_cache_size=EPISODE_LEN)
+            uncompressed_replay_buffer = PrioritizedReplayBuffer(BATCH, CAPACITY)
+
+            for _ in range(6):
+                episode_trans = gen_episode_trans()
+                replay_buffer.add(episode_trans)
+                uncompressed_replay_buffer.add(episode_trans)
+
+            pointers = np.random.randint(0, CAPACITY, [BATCH, 3])
+            trans = replay_buffer.get_storage_data(pointers)
+            uncompressed_trans = uncompressed_replay_buffer.get_storage_data(pointers)
+            for k, v in uncompressed_trans.items():
+                np.testing.assert_array_equal(trans[k], v)
+
+            storage = replay_buffer._trans_storage
+            seq_pointers = np.expand_dims(pointers[:, 0], 1) + np.arange(3)
+            np.testing.assert_array_equal(storage.get_sequences(pointers[:, 0], 3)['obs_1'],
+                                          uncompressed_replay_buffer.get_storage_data(seq_pointers)['obs_1'])
+            self.assertLessEqual(len(storage._buffer['obs_1']._cache), EPISODE_LEN)
+
+            with tempfile.TemporaryDirectory() as path:
+                replay_buffer.save(path)
+                loaded_replay_buffer = PrioritizedReplayBuffer(BATCH, CAPACITY)
+                loaded_replay_buffer.load(path)
+
+            np.testing.assert_array_equal(loaded_replay_buffer.get_storage_data(pointers)['obs_1'],
+                                          uncompressed_trans['obs_1'])
+
+    def test_frame_store_pointers(self):
+        import tempfile
+        from pathlib import Path
+
+        store = CompressedFrameStore(CAPACITY, (4, 4, 3), np.uint8)
+        frames = np.random.randint(0, 256, [CAPACITY, 4, 4, 3], dtype=np.uint8)
+        store[np.arange(CAPACITY)] = frames
+
+        # Negative pointers wrap like ndarray indexing
+        np.testing.assert_array_equal(store[-1], frames[-1])
+        np.testing.assert_array_equal(store[np.array([[-2, 3]])], frames[np.array([[-2, 3]])])
+        with self.assertRaises(IndexError):
+            store[CAPACITY]
+
+        # Load across several chunks
+        store.LOAD_CHUNK_SIZE = 10
+        with tempfile.TemporaryDirectory() as path:
+            store.save(Path(path), 'obs')
+            store.load(Path(path), 'obs')
+        np.testing.assert_array_equal(store[np.arange(CAPACITY)], frames)
+
+    def test_uint8_images(self):
+        replay_buffer = PrioritizedReplayBuffer(BATCH, CAPACITY, uint8_images=True)
+        episode_trans = gen_episode_trans()
+        replay_buffer.add(episode_trans, ignore_size=2)
+
+        pointers, trans, priority_is = replay_buffer.sample_sequences(3)
+        self.assertEqual(trans['obs_1'].dtype, np.uint8)
+        self.assertEqual(trans['obs_0'].dtype, np.float32)
+        np.testing.assert_allclose(trans['obs_1'][:, 0] / 255., episode_trans['obs_1'][pointers], atol=1 / 255.)
+
+        # An explicit storage codec takes precedence over uint8_images
+        replay_buffer = PrioritizedReplayBuffer(BATCH, CAPACITY, storage_codecs={'obs_1': 'float16'}, uint8_images=True)
+        self.assertEqual(replay_buffer.get_storage_codec('obs_1', (6, 6, 3)).decoded_dtype, np.float32)
+        replay_buffer.add(episode_trans, ignore_size=2)
+        pointers, trans, priority_is = replay_buffer.sample_sequences(3)
+        self.assertEqual(trans['obs_1'].dtype, np.float32)
+
+    def test_sharded_replay_buffer(self):
+        import tempfile
+        import threading
+
+        replay_buffer = ShardedPrioritizedReplayBuffer(4, BATCH, CAPACITY * 4)
+        seq_len = 3
+
+        def add():
+            for _ in range(20):
+                replay_buffer.add_with_td_error(np.random.rand(EPISODE_LEN), gen_episode_trans(),
+                                                ignore_size=seq_len - 1)
+
+        threads = [threading.Thread(target=add) for _ in range(4)]
+        for t in threads:
+            t.start()
+
+        while any(t.is_alive() for t in threads) or replay_buffer.size == 0:
+            sampled = replay_buffer.sample_sequences(seq_len)
+            if sampled is None:
+                continue
+
+            data_ids, trans, priority_is = sampled
+            self.assertEqual(priority_is.shape, (BATCH, 1))
+            self.assertEqual(trans['obs_1'].shape, (BATCH, seq_len, 6, 6, 3))
+            replay_buffer.update(data_ids, np.random.rand(BATCH))
+            replay_buffer.update_transitions(data_ids + 1, 'reward', np.zeros(BATCH, dtype=np.float32))
+
+        for t in threads:
+            t.join()
+
+        self.assertTrue(replay_buffer.is_full)
+
+        data_ids, trans, priority_is = replay_buffer.sample_sequences(seq_len)
+        np.testing.assert_array_equal(replay_buffer.get_storage_data_ids(data_ids), data_ids)
+        for i in range(seq_len):
+            t_trans = replay_buffer.get_storage_data(data_ids + i)
+            for k, v in t_trans.items():
+                np.testing.assert_allclose(trans[k][:, i], v)
+
+        with tempfile.TemporaryDirectory() as path:
+            replay_buffer.save(path)
+            loaded_replay_buffer = ShardedPrioritizedReplayBuffer(4, BATCH, CAPACITY * 4)
+            loaded_replay_buffer.load(path)
+
+        self.assertEqual(loaded_replay_buffer.size, replay_buffer.size)
+        np.testing.assert_allclose(loaded_replay_buffer.get_storage_data(data_ids)['obs_0'], trans['obs_0'][:, 0])
+
+    def test_sharded_memmap_storage(self):
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as memmap_dir:
+            replay_buffer = ShardedPrioritizedReplayBuffer(4, BATCH, CAPACITY * 4, memmap_dir=memmap_dir)
+
+            shard_trans = []
+            for _ in range(4):
+                episode_trans = gen_episode_trans()
+                replay_buffer.add(episode_trans)
+                shard_trans.append(episode_trans)
+
+            # Each shard reads back its own data
+            for i, episode_trans in enumerate(shard_trans):
+                data_ids = i * replay_buffer._id_stride + np.arange(EPISODE_LEN)
+                trans = replay_buffer.get_storage_data(data_ids)
+                np.testing.assert_allclose(trans['obs_0'], episode_trans['obs_0'])
+                np.testing.assert_allclose(trans['reward'], episode_trans['reward'])
+
+            with tempfile.TemporaryDirectory() as path:
+                replay_buffer.save(path)
+                loaded_replay_buffer = ShardedPrioritizedReplayBuffer(4, BATCH, CAPACITY * 4)
+                loaded_replay_buffer.load(path)
+
+            for i, episode_trans in enumerate(shard_trans):
+                data_ids = i * replay_buffer._id_stride + np.arange(EPISODE_LEN)
+                np.testing.assert_allclose(loaded_replay_buffer.get_storage_data(data_ids)['obs_0'],
+                                           episode_trans['obs_0'])
+
+    def test_sharded_id_wrapping(self):
+        replay_buffer = ShardedPrioritizedReplayBuffer(1, BATCH, CAPACITY)
+        storage = replay_buffer._shards[0]._trans_storage
+        storage._id = storage.max_id - 2
+        replay_buffer.add(gen_episode_trans())
+
+        # `id + i` beyond the max id refers to the wrapped id
+        data_ids = np.array([storage.max_id - 2]) + np.arange(3)
+        replay_buffer.update_transitions(data_ids, 'reward', np.full(3, 7., dtype=np.float32))
+        np.testing.assert_array_equal(replay_buffer.get_storage_data(data_ids % storage.max_id)['reward'], 7.)
+
+    def test_is_valid(self):
+        replay_buffer = PrioritizedReplayBuffer(BATCH, CAPACITY)
+        storage = replay_buffer._trans_storage
+        storage._id = storage.max_id - 2
+        replay_buffer.add(gen_episode_trans())
+
+        # `id + i` beyond the max id is valid, an overwritten id in the same slot is not
+        data_ids = np.array([storage.max_id - 2]) + np.arange(3)
+        np.testing.assert_array_equal(replay_buffer.is_valid(data_ids), True)
+        np.testing.assert_array_equal(replay_buffer.is_valid(data_ids - CAPACITY), False)
+
+        sharded_replay_buffer = ShardedPrioritizedReplayBuffer(1, BATCH, CAPACITY)
+        sharded_replay_buffer._shards[0] = replay_buffer
+        np.testing.assert_array_equal(sharded_replay_buffer.is_valid(data_ids), True)
+
+    def test_sample_n_batches(self):
+        n_batches = 4
+        seq_len = 3
+
+        for replay_buffer in [PrioritizedReplayBuffer(BATCH, CAPACITY),
+                              ShardedPrioritizedReplayBuffer(4, BATCH, CAPACITY * 4)]:
+            for _ in range(20):
+                replay_buffer.add_with_td_error(np.random.rand(EPISODE_LEN), gen_episode_trans(),
+                                                ignore_size=seq_len - 1)
+
+            data_ids, trans, priority_is = replay_buffer.sample_sequences(seq_len, n_batches)
+            self.assertEqual(data_ids.shape, (n_batches * BATCH,))
+            self.assertEqual(trans['obs_0'].shape, (n_batches * BATCH, seq_len, 4))
+            self.assertEqual(priority_is.shape, (n_batches * BATCH, 1))
+            # Importance-sampling weights are normalized in each batch
+            np.testing.assert_allclose(priority_is.reshape(n_batches, BATCH).max(axis=1), 1)
+
+            for i in range(seq_len):
+                np.testing.assert_allclose(trans['obs_0'][:, i],
+                                           replay_buffer.get_storage_data(data_ids + i)['obs_0'])
+
+            data_ids, trans, priority_is = replay_buffer.sample(n_batches)
+            self.assertEqual(trans['action'].shape, (n_batches * BATCH, 2))
@@ -0,0 +1,122 @@
+"""
+Benchmarks of SAC_Base
+Usage: python -m tests.sac_base_benchmark
+"""
+
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+
+sys.path.append('..')
+
+from algorithm.sac_base import SAC_Base
+
+from . import nn_vanilla
+
+
+OBS_DIMS = [(10,), (8,)]
+D_ACTION_DIM = 2
+C_ACTION_DIM = 4
+EPISODE_LEN = 200
+N_STEPS = 500
+
+
+def gen_episode_trans():
+    return ([np.random.randn(1, EPISODE_LEN, *t).astype(np.float32) for t in OBS_DIMS],
+            np.random.randn(1, EPISODE_LEN, D_ACTION_DIM + C_ACTION_DIM).astype(np.float32),
+            np.random.randn(1, EPISODE_LEN).astype(np.float32),
+            [np.random.randn(1, *t).astype(np.float32) for t in OBS_DIMS],
+            np.zeros((1, EPISODE_LEN), dtype=np.float32))
+
+
+def gen_sac(name, **kwargs):
+    return SAC_Base(obs_dims=OBS_DIMS,
+                    d_action_dim=D_ACTION_DIM,
+                    c_action_dim=C_ACTION_DIM,
+                    model_abs_dir=f'tests/model/benchmark_{name}',
+                    model=nn_vanilla,
+                    n_step=3,
+                    **kwargs)
+
+
+def bench_jit_compile():
+    """
+    Training and acting steps/sec with and without XLA
+    """
+    print('jit_compile steps/sec')
+    for jit_compile in [False, True]:
+        sac = gen_sac(f'jit_compile_{jit_compile}', jit_compile=jit_compile)
+        for _ in range(10):
+            sac.fill_replay_buffer(*gen_episode_trans())
+
+        # Warm up, tracing and compiling
+        sac.train()
+        obs_list = [np.random.randn(10, *t).astype(np.float32) for t in OBS_DIMS]
+        sac.choose_action(obs_list)
+
+        t = time.time()
+        for _ in range(N_STEPS):
+            sac.train()
+        train_t = time.time() - t
+
+        t = time.time()
+        for _ in range(N_STEPS):
+            sac.choose_action(obs_list)
+        choose_action_t = time.time() - t
+
+        print(f'jit_compile {str(jit_compile):<6} '
+              f'train {N_STEPS / train_t:8.1f}/s choose_action {N_STEPS / choose_action_t:8.1f}/s')
+
+
+def _count_flops(concrete_fn):
+    opts = tf.compat.v1.profiler.ProfileOptionBuilder.float_operation()
+    opts['output'] = 'none'
+    return tf.compat.v1.profiler.profile(concrete_fn.graph, options=opts).total_float_ops
+
+
+def bench_get_y():
+    """
+    FLOPs and time per call of SAC_Base._get_y,
+    with discrete, continuous and both kinds of actions
+    """
+    n_step = 3
+    batch = 256
+    print(f'_get_y batch {batch}, n_step {n_step}')
+    for d_action_dim, c_action_dim in [(D_ACTION_DIM, 0), (0, C_ACTION_DIM), (D_ACTION_DIM, C_ACTION_DIM)]:
+        sac = SAC_Base(obs_dims=OBS_DIMS,
+                       d_action_dim=d_action_dim,
+                       c_action_dim=c_action_dim,
+                       model_abs_dir=f'tests/model/benchmark_get_y_{d_action_dim}_{c_action_dim}',
+                       model=nn_vanilla,
+                       n_step=n_step)
+
+        m_obs_list = [tf.random.normal((batch, n_step + 1, *t)) for t in OBS_DIMS]
+        m_states = sac.model_target_rep(m_obs_list)
+        d_actions = tf.one_hot(tf.random.uniform((batch, n_step), maxval=max(d_action_dim, 1), dtype=tf.int32),
+                               d_action_dim)
+        c_actions = tf.tanh(tf.random.normal((batch, n_step, c_action_dim)))
+        args = (m_states,
+                tf.concat([d_actions, c_actions], axis=-1),
+                tf.random.normal((batch, n_step)),
+                tf.zeros((batch, n_step)),
+                tf.random.uniform((batch, n_step)))
+
+        flops = _count_flops(sac._get_y.get_concrete_function(*args))
+
+        # Warm up
+        sac._get_y(*args)
+
+        t = time.time()
+        for _ in range(N_STEPS):
+            sac._get_y(*args)
+        get_y_t = time.time() - t
+
+        print(f'd_action_dim {d_action_dim} c_action_dim {c_action_dim} '
+              f'FLOPs {flops:,} {get_y_t / N_STEPS * 1000:.3f}ms/call')
+
+
+if __name__ == '__main__':
+    bench_jit_compile()
+    bench_get_y()
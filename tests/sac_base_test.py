@@ -2,6 +2,7 @@ import unittest
 import sys
 
 import numpy as np
+import tensorflow as tf
 
 sys.path.append('..')
 
@@ -23,7 +24,8 @@ def gen_episode_trans(action_dim):
              np.random.randn(1, EPISODE_LEN, 8).astype(np.float32),
              np.random.randn(1, EPISODE_LEN, 30, 30, 3).astype(np.float32)],
 
-            np.random.randn(1, EPISODE_LEN, action_dim).astype(np.float32),
+            # Continuous actions are squashed into (-1, 1) as the policy outputs them
+            np.tanh(np.random.randn(1, EPISODE_LEN, action_dim)).astype(np.float32),
 
             np.random.randn(1, EPISODE_LEN).astype(np.float32),
 
@@ -153,4 +155,288 @@ class TestStringMethods(unittest.TestCase):
         for _ in range(1024):
             sac.choose_action(gen_batch_obs())
             sac.fill_replay_buffer(*gen_episode_trans(14))
-            sac.train()
\ No newline at end of file
+            sac.train()
+
+    def test_uint8_images(self):
+        from . import nn_vanilla
+
+        sac = SAC_Base(
+            obs_dims=[(10,), (8,), (30, 30, 3)],
+            d_action_dim=10,
+            c_action_dim=4,
+            model_abs_dir='tests/model/models_test_uint8_images',
+            model=nn_vanilla,
+            burn_in_step=0,
+            n_step=3,
+            use_rnn=False,
+            discrete_dqn_like=False,
+            use_priority=True,
+            use_n_step_is=True,
+            use_prediction=False,
+            use_normalization=True,
+            uint8_images=True
+        )
+
+        for _ in range(1024):
+            sac.choose_action(gen_batch_obs())
+            sac.fill_replay_buffer(*gen_episode_trans(14))
+            sac.train()
+
+        # An explicit storage codec of an image key takes precedence over uint8_images
+        sac = SAC_Base(
+            obs_dims=[(10,), (8,), (30, 30, 3)],
+            d_action_dim=10,
+            c_action_dim=4,
+            model_abs_dir='tests/model/models_test_uint8_images_codecs',
+            model=nn_vanilla,
+            burn_in_step=0,
+            n_step=3,
+            use_rnn=False,
+            uint8_images=True,
+            prefetch_batches=2,
+            replay_config={'storage_codecs': {'obs_2': 'float16'}}
+        )
+        self.assertEqual(sac._get_obs_signature(None)[2].dtype, tf.float32)
+
+        for _ in range(10):
+            sac.fill_replay_buffer(*gen_episode_trans(14))
+            sac.train()
+
+    def test_prefetch_batches(self):
+        from . import nn_vanilla
+
+        sac = SAC_Base(
+            obs_dims=[(10,), (8,), (30, 30, 3)],
+            d_action_dim=10,
+            c_action_dim=4,
+            model_abs_dir='tests/model/models_test_prefetch_batches',
+            model=nn_vanilla,
+            burn_in_step=0,
+            n_step=3,
+            use_rnn=False,
+            discrete_dqn_like=False,
+            use_priority=True,
+            use_n_step_is=True,
+            use_prediction=False,
+            use_normalization=False,
+            prefetch_batches=2
+        )
+
+        for _ in range(1024):
+            sac.choose_action(gen_batch_obs())
+            sac.fill_replay_buffer(*gen_episode_trans(14))
+            sac.train()
+
+    def test_train_steps_per_call(self):
+        from . import nn_vanilla
+
+        sac = SAC_Base(
+            obs_dims=[(10,), (8,), (30, 30, 3)],
+            d_action_dim=10,
+            c_action_dim=4,
+            model_abs_dir='tests/model/models_test_train_steps_per_call',
+            model=nn_vanilla,
+            burn_in_step=0,
+            n_step=3,
+            use_rnn=False,
+            discrete_dqn_like=False,
+            use_priority=True,
+            use_n_step_is=True,
+            use_prediction=False,
+            use_normalization=False,
+            train_steps_per_call=4
+        )
+
+        for _ in range(256):
+            sac.choose_action(gen_batch_obs())
+            sac.fill_replay_buffer(*gen_episode_trans(14))
+            step = sac.train()
+            self.assertEqual(step % 4, 0)
+
+    def test_vectorized_q(self):
+        from . import nn_vanilla
+
+        sac = SAC_Base(
+            obs_dims=[(10,), (8,), (30, 30, 3)],
+            d_action_dim=10,
+            c_action_dim=4,
+            model_abs_dir='tests/model/models_test_vectorized_q',
+            model=nn_vanilla,
+            ensemble_q_num=4,
+            ensemble_q_sample=2,
+            vectorized_q=True,
+            burn_in_step=0,
+            n_step=3,
+            use_rnn=False,
+            discrete_dqn_like=False,
+            use_priority=True,
+            use_n_step_is=True,
+            use_prediction=False,
+            use_normalization=False
+        )
+
+        for _ in range(256):
+            sac.choose_action(gen_batch_obs())
+            sac.fill_replay_buffer(*gen_episode_trans(14))
+            sac.train()
+        sac.save_model()
+
+        # Restore the checkpoint into the ModelQ list layout
+        sac_q_list = SAC_Base(
+            obs_dims=[(10,), (8,), (30, 30, 3)],
+            d_action_dim=10,
+            c_action_dim=4,
+            model_abs_dir='tests/model/models_test_vectorized_q',
+            model=nn_vanilla,
+            train_mode=False,
+            ensemble_q_num=4,
+            ensemble_q_sample=2,
+            vectorized_q=False,
+            burn_in_step=0,
+            n_step=3,
+            use_rnn=False
+        )
+
+        state = np.random.randn(BATCH, sac.model_q.state_dim).astype(np.float32)
+        c_action = np.random.randn(BATCH, 4).astype(np.float32)
+        d_q_list, c_q_list = sac._get_q_list(state, c_action)
+        d_q_list_, c_q_list_ = sac_q_list._get_q_list(state, c_action)
+        for i in range(4):
+            np.testing.assert_allclose(d_q_list[i], d_q_list_[i], rtol=1e-5)
+            np.testing.assert_allclose(c_q_list[i], c_q_list_[i], rtol=1e-5)
+
+    def test_mixed_bfloat16(self):
+        from . import nn_vanilla
+
+        sac = SAC_Base(
+            obs_dims=[(10,), (8,), (30, 30, 3)],
+            d_action_dim=10,
+            c_action_dim=4,
+            model_abs_dir='tests/model/models_test_mixed_bfloat16',
+            model=nn_vanilla,
+            burn_in_step=0,
+            n_step=3,
+            use_rnn=False,
+            use_priority=True,
+            use_n_step_is=True,
+            use_prediction=False,
+            precision='mixed_bfloat16'
+        )
+
+        for _ in range(256):
+            sac.choose_action(gen_batch_obs())
+            sac.fill_replay_buffer(*gen_episode_trans(14))
+            sac.train()
+        sac.save_model()
+
+        # Variables stay float32, so the checkpoint is restored in float32 precision
+        sac_float32 = SAC_Base(
+            obs_dims=[(10,), (8,), (30, 30, 3)],
+            d_action_dim=10,
+            c_action_dim=4,
+            model_abs_dir='tests/model/models_test_mixed_bfloat16',
+            model=nn_vanilla,
+            train_mode=False,
+            burn_in_step=0,
+            n_step=3,
+            use_rnn=False
+        )
+
+        for v, v_ in zip(sac.get_policy_variables(), sac_float32.get_policy_variables()):
+            self.assertEqual(v.dtype.name, 'float32')
+            np.testing.assert_array_equal(v.numpy(), v_.numpy())
+
+    def test_get_n_rnn_states(self):
+        from . import nn_rnn
+
+        sac = SAC_Base(
+            obs_dims=[(10,), (8,), (30, 30, 3)],
+            d_action_dim=10,
+            c_action_dim=4,
+            model_abs_dir='tests/model/models_test_get_n_rnn_states',
+            model=nn_rnn,
+            train_mode=False,
+            burn_in_step=2,
+            n_step=3,
+            use_rnn=True
+        )
+
+        n_obses_list = [np.random.randn(BATCH, 5, 10).astype(np.float32),
+                        np.random.randn(BATCH, 5, 8).astype(np.float32),
+                        np.random.randn(BATCH, 5, 30, 30, 3).astype(np.float32)]
+        n_actions = np.random.randn(BATCH, 5, 14).astype(np.float32)
+        rnn_state = np.random.randn(BATCH, sac.rnn_state_dim).astype(np.float32)
+
+        n_rnn_states = sac.get_n_rnn_states(n_obses_list, n_actions, rnn_state)
+
+        # The single sequence call matches stepping model_rep over each timestep
+        pre_action = np.zeros((BATCH, 1, 14), dtype=np.float32)
+        for i in range(5):
+            _, rnn_state = sac.model_rep([tf.constant(o[:, i:i + 1, ...]) for o in n_obses_list],
+                                         tf.constant(pre_action), tf.constant(rnn_state))
+            np.testing.assert_allclose(n_rnn_states[:, i, ...], rnn_state, rtol=1e-4, atol=1e-5)
+            pre_action = n_actions[:, i:i + 1, ...]
+
+    def test_all_states_unsupported_model(self):
+        from algorithm.nn_models import ModelBaseGRURep
+
+        class ModelTwiceRep(ModelBaseGRURep):
+            def call(self, obs_list, pre_action, rnn_state):
+                obs = tf.concat([obs_list[0], pre_action], axis=-1)
+                _, rnn_state = self.gru(obs, initial_state=rnn_state)
+                return self.gru(obs, initial_state=rnn_state)
+
+        class ModelProjectedRep(ModelBaseGRURep):
+            def call(self, obs_list, pre_action, rnn_state):
+                obs = tf.concat([obs_list[0], pre_action], axis=-1)
+                outputs, next_rnn_state = self.gru(obs, initial_state=rnn_state[..., :self.rnn_units])
+                return outputs, tf.concat([next_rnn_state, next_rnn_state], axis=-1)
+
+        obs_list = [tf.random.normal((BATCH, 5, 10))]
+        pre_action = tf.random.normal((BATCH, 5, 2))
+
+        # A model calling its rnn more than once falls back to the step loop
+        model = ModelTwiceRep([(10,)], 2, 0, rnn_units=8)
+        *_, all_rnn_states = model(obs_list, pre_action, tf.zeros((BATCH, 8)), return_all_states=True)
+        self.assertIsNone(all_rnn_states)
+
+        # A model not returning the states of its rnn as the rnn state raises a clear error
+        model = ModelProjectedRep([(10,)], 2, 0, rnn_units=8)
+        with self.assertRaises(ValueError):
+            model(obs_list, pre_action, tf.zeros((BATCH, 16)), return_all_states=True)
+
+    def test_async_checkpoint(self):
+        from . import nn_vanilla
+
+        sac = SAC_Base(
+            obs_dims=[(10,), (8,), (30, 30, 3)],
+            d_action_dim=10,
+            c_action_dim=4,
+            model_abs_dir='tests/model/models_test_async_checkpoint',
+            model=nn_vanilla,
+            burn_in_step=0,
+            n_step=3,
+            use_rnn=False,
+            async_checkpoint=True
+        )
+
+        for _ in range(256):
+            sac.choose_action(gen_batch_obs())
+            sac.fill_replay_buffer(*gen_episode_trans(14))
+            sac.train()
+        sac.save_model(wait=True)
+
+        sac_restored = SAC_Base(
+            obs_dims=[(10,), (8,), (30, 30, 3)],
+            d_action_dim=10,
+            c_action_dim=4,
+            model_abs_dir='tests/model/models_test_async_checkpoint',
+            model=nn_vanilla,
+            train_mode=False,
+            burn_in_step=0,
+            n_step=3,
+            use_rnn=False
+        )
+
+        for v, v_ in zip(sac.get_policy_variables(), sac_restored.get_policy_variables()):
+            np.testing.assert_array_equal(v.numpy(), v_.numpy())